@@ -1,5 +1,7 @@
 #! /usr/bin/env python3
 from piconagent.piconagent import PiConAgent
+from piconagent.proxyagent import ProxyAgent, loadConfig
+import asyncio
 import argparse
 from daemonize import Daemonize
 import logging
@@ -11,6 +13,27 @@ parser.add_argument('--daemonize',action='store_true',help='Run in background [d
 
 parser.add_argument('--holdtime',type=int,help='Hold time: seconds for the server to wait before declaring this device unavailable [default: 300]', default=300)
 parser.add_argument('--interval',type=int,help='Interval: seconds between registrations [default: 60]',default=60)
+parser.add_argument('--heartbeat',type=int,help='Heartbeat: seconds between registrations when nothing changed [default: the larger of interval and holdtime/3 when watching for changes, otherwise interval]',default=None)
+parser.add_argument('--no-watch',dest='watch',action='store_false',help='Do not watch for interface and port changes, only register every interval')
+parser.add_argument('--gzip',action='store_true',help='Compress registration bodies, for metered or slow uplinks [default: False]')
+parser.add_argument('--timeout',type=float,help='Timeout: seconds to wait for each registration request [default: 2]',default=2)
+parser.add_argument('--tunnel-keepalive',type=int,help='Tunnel keepalive: seconds between SSH keepalives on the tunnel [default: 15]',default=15)
+parser.add_argument('--tunnel-timeout',type=int,help='Tunnel timeout: seconds without an answer from the tunnel server before the tunnel is reconnected [default: 45]',default=45)
+parser.add_argument('--no-forward-ports',dest='forward_ports',action='store_false',help='Do not expose each serial port on its own tunnel port, only forward SSH')
+parser.add_argument('--baud',type=int,help='Baud rate of the forwarded serial consoles [default: 9600]',default=9600)
+parser.add_argument('--capture',action='store_true',help='Read every console continuously, so console sessions attach to the live stream [default: False, implied by --logdir]')
+parser.add_argument('--logdir',type=str,help='Log directory: write the output of every console to timestamped, gzip-compressed files here [default: None]',default=None)
+parser.add_argument('--log-max-bytes',type=int,help='Start a new console log after this many bytes of output [default: 16777216]',default=16*1024*1024)
+parser.add_argument('--log-max-age',type=int,help='Start a new console log after this many seconds [default: 86400]',default=86400)
+parser.add_argument('--log-keep',type=int,help='Number of console logs kept per port [default: 14]',default=14)
+parser.add_argument('--ship-history',action='store_true',help='Ship the output of every console to the server, where it can be read back and searched [default: False]')
+parser.add_argument('--discover-ports',dest='discover',action='store_true',help='Probe serial ports for a live console and its speed; probing sends a carriage return to each new port [default: False]')
+parser.add_argument('--probe-workers',type=int,help='Number of serial ports probed at the same time [default: 8]',default=8)
+parser.add_argument('--probe-timeout',type=float,help='Seconds to wait for a console to answer at each speed tried [default: 0.5]',default=0.5)
+parser.add_argument('--proxy',type=str,help='Proxy: register the console lines of existing terminal servers listed in this JSON file, instead of this host\'s serial ports [default: None]',default=None)
+parser.add_argument('--max-connections',type=int,help='Connections open at the same time to each terminal server, when proxying [default: 8]',default=8)
+parser.add_argument('--check-timeout',type=float,help='Seconds a proxied line has to answer in to count as live [default: 2]',default=2)
+parser.add_argument('--check-workers',type=int,help='Proxied lines health-checked at the same time [default: 64]',default=64)
 parser.add_argument('--pidfile',type=str,help='PID File: PID file location, used only if daemonizing [default: /tmp/picon-agent.pid]',default='/tmp/picon-agent.pid')
 parser.add_argument('--logfile',type=str,help='Log File: log file location, [default: None]',default=None)
 parser.add_argument('-d',dest='debug',action='store_true',help='Debug: Maximum verbosity (overrides -v)')
@@ -42,9 +65,14 @@ def main():
 
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',level=logLevel,filename=args.logfile)
     logging.info('Starting PiCon Agent...')
-    a = PiConAgent(args.endpoint,holdtime=args.holdtime,interval=args.interval)
-    logging.info("Using endpoint %ss, holdtime %ss, reporting interval %s" % (args.endpoint,a.holdtime,a.interval))
-    a.run()
+    if args.proxy:
+        servers = loadConfig(args.proxy,maxConnections=args.max_connections)
+        a = ProxyAgent(args.endpoint,servers,checkTimeout=args.check_timeout,checkWorkers=args.check_workers,holdtime=args.holdtime,interval=args.interval,compress=args.gzip,timeout=args.timeout,heartbeat=args.heartbeat)
+        logging.info("Proxying %d console lines on %d terminal servers" % (len(a.lines),len(servers)))
+    else:
+        a = PiConAgent(args.endpoint,holdtime=args.holdtime,interval=args.interval,compress=args.gzip,timeout=args.timeout,watch=args.watch,heartbeat=args.heartbeat,keepaliveInterval=args.tunnel_keepalive,deadPeerTimeout=args.tunnel_timeout,forwardPorts=args.forward_ports,baudrate=args.baud,capture=args.capture,logdir=args.logdir,logOptions={'maxBytes': args.log_max_bytes,'maxAge': args.log_max_age,'keep': args.log_keep},shipHistory=args.ship_history,discover=args.discover,probeOptions={'workers': args.probe_workers,'timeout': args.probe_timeout})
+    logging.info("Using endpoint %ss, holdtime %ss, reporting interval %s, heartbeat %s" % (args.endpoint,a.holdtime,a.interval,a.heartbeat))
+    asyncio.run(a.run())
 
 
 if args.daemonize:
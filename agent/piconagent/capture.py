@@ -0,0 +1,320 @@
+import asyncio
+import functools
+import glob
+import gzip
+import logging
+import os
+import time
+import zlib
+import piconagent.serialport as serialport
+
+# bytes of recent output kept per port for attached readers
+RING_SIZE = 256*1024
+# largest single read from a port
+CHUNK_SIZE = 4096
+# after a short read, wait this long for more bytes so a port streaming at 115200 baud
+# costs a wakeup per ~100 bytes rather than per byte
+READ_COALESCE = 0.01
+# log rotation: whichever of size (uncompressed bytes) and age comes first
+LOG_MAX_BYTES = 16*1024*1024
+LOG_MAX_AGE = 24*60*60
+LOG_KEEP = 14
+# seconds between batched log writes, and the pending size that forces one earlier
+LOG_FLUSH_INTERVAL = 1
+LOG_FLUSH_BYTES = 64*1024
+COMPRESS_LEVEL = 6
+# seconds between chunks of console output shipped to the server's history store, and
+# how much unshipped output is kept while the server cannot be reached
+SHIP_INTERVAL = 10
+SHIP_MAX_PENDING = 4*1024*1024
+# seconds an unterminated line is held back waiting for its newline, e.g. a prompt
+SHIP_PARTIAL_AGE = 60
+# seconds before a port that could not be opened is tried again, doubled per attempt that
+# still fails; e.g. a ttyS with no UART behind it, when discovery does not rule it out
+REOPEN_INTERVAL = 60
+REOPEN_INTERVAL_MAX = 60*60
+
+class LineStamper():
+    # Prefixes every line of a port's output with the time its first byte was read, e.g.
+    # 2016-06-01T00:00:00.000Z, carrying over lines split across reads.
+    def __init__(self):
+        self.atLineStart = True
+    def stamp(self,data,now):
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(now)) + '.%03dZ ' % (now % 1 * 1000)
+        stamp = stamp.encode()
+        out = bytearray()
+        lines = bytes(data).split(b'\n')
+        for i, line in enumerate(lines):
+            if i > 0:
+                out += b'\n'
+                self.atLineStart = True
+            if line:
+                if self.atLineStart:
+                    out += stamp
+                    self.atLineStart = False
+                out += line
+        return out
+
+class RingBuffer():
+    # Preallocated ring of the most recent output of one port. Every byte ever written
+    # has an offset; a reader keeps its own offset and gets every byte in order, as long
+    # as it does not fall more than size bytes behind the writer.
+    def __init__(self,size=RING_SIZE):
+        self.buf = bytearray(size)
+        self.size = size
+        self.end = 0
+        self.closed = False
+        self.waiter = None
+    def start(self):
+        # oldest offset still in the ring
+        return max(0,self.end - self.size)
+    def write(self,data):
+        data = memoryview(data)
+        # of a write larger than the ring only the tail survives
+        self.end += max(0,len(data) - self.size)
+        data = data[-self.size:]
+        pos = self.end % self.size
+        first = min(len(data),self.size - pos)
+        self.buf[pos:pos+first] = data[:first]
+        self.buf[0:len(data)-first] = data[first:]
+        self.end += len(data)
+        self.wake()
+    def close(self):
+        # no more output will come; wakes up every waiting reader
+        self.closed = True
+        self.wake()
+    def wake(self):
+        if self.waiter is not None:
+            self.waiter.set_result(None)
+            self.waiter = None
+    def read(self,offset,size=CHUNK_SIZE):
+        # return (data, next offset); bytes already overwritten are skipped, which a caller
+        # can tell from offset moving by more than len(data)
+        offset = max(offset,self.start())
+        size = min(size,self.end - offset)
+        pos = offset % self.size
+        first = min(size,self.size - pos)
+        data = bytes(self.buf[pos:pos+first]) + bytes(self.buf[0:size-first])
+        return data, offset + size
+    async def wait(self,offset):
+        # wait until there is output past offset, returning False if there never will be
+        while self.end <= offset:
+            if self.closed:
+                return False
+            if self.waiter is None:
+                self.waiter = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self.waiter)
+        return True
+
+class RotatingLog():
+    # Timestamped, gzip-compressed log of one port. Stamped output is written out in
+    # batches; each batch ends with a sync flush, so the file written so far can always be
+    # decompressed. A new file is started once the current one holds maxBytes of output
+    # or is maxAge seconds old, keeping the newest keep files.
+    def __init__(self,logdir,name,maxBytes=LOG_MAX_BYTES,maxAge=LOG_MAX_AGE,keep=LOG_KEEP):
+        self.logdir = logdir
+        self.name = name
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.keep = keep
+        self.pending = bytearray()
+        self.file = None
+        self.compressor = None
+        self.opened = 0
+        self.written = 0
+    def append(self,stamped):
+        self.pending += stamped
+    def flush(self):
+        if not self.pending:
+            return
+        if self.file is None or self.written >= self.maxBytes or time.time() - self.opened >= self.maxAge:
+            self.rotate()
+        self.file.write(self.compressor.compress(self.pending))
+        self.file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.file.flush()
+        self.written += len(self.pending)
+        self.pending = bytearray()
+    def rotate(self):
+        self.close()
+        self.opened = time.time()
+        self.written = 0
+        path = os.path.join(self.logdir,'%s-%s.log.gz' % (self.name,time.strftime('%Y%m%dT%H%M%SZ',time.gmtime(self.opened))))
+        self.file = open(path,'ab')
+        # wbits 31 writes the gzip container, so the files open with zcat and gzip.open
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL,zlib.DEFLATED,31)
+        for old in sorted(glob.glob(os.path.join(self.logdir,self.name + '-*.log.gz')))[:-self.keep]:
+            os.remove(old)
+    def close(self):
+        if self.file is not None:
+            self.file.write(self.compressor.flush())
+            self.file.close()
+            self.file = None
+
+class HistoryShipper():
+    # Collects the stamped output of one port and hands it, gzip-compressed, to send() every
+    # interval seconds, along with the times of the first and last output in the chunk.
+    # Only complete lines are shipped: an unterminated last line is held back until its
+    # newline arrives or it is partialAge seconds old, so a line is rarely split between
+    # chunks. send(name,start,end,body) is a coroutine returning True once the server has
+    # stored the chunk; unshipped output is retried with the next chunk, up to
+    # SHIP_MAX_PENDING.
+    def __init__(self,name,send,interval=SHIP_INTERVAL,partialAge=SHIP_PARTIAL_AGE):
+        self.name = name
+        self.send = send
+        self.interval = interval
+        self.partialAge = partialAge
+        self.pending = bytearray()
+        self.start = None
+        self.end = None
+        # time the unterminated last line of pending was started, None if there is none
+        self.partialSince = None
+    def append(self,stamped,now):
+        if not stamped:
+            return
+        if self.start is None:
+            self.start = now
+        self.end = now
+        if stamped.endswith(b'\n'):
+            self.partialSince = None
+        elif self.partialSince is None or b'\n' in stamped:
+            self.partialSince = now
+        self.pending += stamped
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.ship()
+    async def ship(self):
+        if not self.pending:
+            return
+        start, end = self.start, self.end
+        if self.partialSince is not None and time.time() - self.partialSince < self.partialAge:
+            # ship up to the last newline; the complete lines all ended by partialSince
+            cut = self.pending.rfind(b'\n') + 1
+            if cut == 0:
+                return
+            end = self.partialSince
+            self.start = self.partialSince
+        else:
+            cut = len(self.pending)
+            self.start = None
+            self.partialSince = None
+        # output read while sending goes into the next chunk
+        shipped = self.pending[:cut]
+        del self.pending[:cut]
+        if await self.send(self.name,start,end,gzip.compress(shipped,COMPRESS_LEVEL)):
+            return
+        if len(shipped) + len(self.pending) > SHIP_MAX_PENDING:
+            logging.warning('Dropping %d bytes of unshipped console output of %s' % (len(shipped),self.name))
+            return
+        self.pending[:0] = shipped
+        self.start = start
+
+class ConsoleCapture():
+    # Reads one serial port continuously into its ring buffer and, if logging or shipping,
+    # its log and history shipper. Console sessions attach to the ring and write through
+    # write(), so capture never misses what an operator sees.
+    def __init__(self,name,baudrate=serialport.DEFAULT_BAUDRATE,logdir=None,ship=None,**logOptions):
+        self.name = name
+        self.port = serialport.SerialPort(name,baudrate)
+        self.ring = RingBuffer()
+        self.stamper = LineStamper()
+        self.log = RotatingLog(logdir,name,**logOptions) if logdir else None
+        self.shipper = HistoryShipper(name,ship) if ship else None
+        self.chunk = bytearray(CHUNK_SIZE)
+        self.opened = False
+    async def run(self):
+        flusher = None
+        shipping = None
+        view = memoryview(self.chunk)
+        try:
+            self.port.open()
+            self.opened = True
+            logging.info('Capturing console output of %s' % self.name)
+            if self.log is not None:
+                flusher = asyncio.ensure_future(self.flushLog())
+            if self.shipper is not None:
+                shipping = asyncio.ensure_future(self.shipper.run())
+            while True:
+                n = await self.port.readinto(view)
+                if n == 0:
+                    return
+                self.ring.write(view[:n])
+                if self.log is not None or self.shipper is not None:
+                    now = time.time()
+                    stamped = self.stamper.stamp(view[:n],now)
+                if self.log is not None:
+                    self.log.append(stamped)
+                    if len(self.log.pending) >= LOG_FLUSH_BYTES:
+                        self.log.flush()
+                if self.shipper is not None:
+                    self.shipper.append(stamped,now)
+                if n < CHUNK_SIZE:
+                    await asyncio.sleep(READ_COALESCE)
+        except OSError as exc:
+            # usually the USB adapter was unplugged
+            logging.warning('Stopped capturing %s: %s' % (self.name,str(exc)))
+        finally:
+            self.ring.close()
+            if flusher is not None:
+                flusher.cancel()
+                self.log.flush()
+                self.log.close()
+            if shipping is not None:
+                shipping.cancel()
+            self.port.close()
+    async def flushLog(self):
+        while True:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            self.log.flush()
+    async def write(self,data):
+        await self.port.write(data)
+
+class CaptureManager():
+    # Keeps one ConsoleCapture task running for every serial port present. A capture that
+    # stopped is restarted with the next setPorts(), unless its port could not be opened:
+    # those are tried again on a backoff, like discovery probes ports without a console.
+    def __init__(self,startTask,baudrate=serialport.DEFAULT_BAUDRATE,logdir=None,ship=None,**logOptions):
+        self.startTask = startTask
+        self.baudrate = baudrate
+        self.logdir = logdir
+        self.ship = ship
+        self.logOptions = logOptions
+        self.captures = {}
+        # port name -> attempts in a row that could not open the port
+        self.failures = {}
+        # port name -> time to try opening the port again
+        self.retry = {}
+        if logdir:
+            os.makedirs(logdir,exist_ok=True)
+    def setPorts(self,ports,speeds={}):
+        # speeds: port name -> detected baud rate, for ports not at the default
+        now = time.monotonic()
+        for name in ports:
+            entry = self.captures.get(name)
+            if (entry is None or entry[1].done()) and self.retry.get(name,0) <= now:
+                capture = ConsoleCapture(name,speeds.get(name,self.baudrate),self.logdir,self.ship,**self.logOptions)
+                task = self.startTask(capture.run())
+                task.add_done_callback(functools.partial(self.stopped,name,capture))
+                self.captures[name] = (capture,task)
+        for name in list(self.captures):
+            if name not in ports:
+                self.captures.pop(name)[1].cancel()
+                self.failures.pop(name,None)
+                self.retry.pop(name,None)
+    def stopped(self,name,capture,task):
+        # a port that was open is captured again straight away, one that could not be
+        # opened only once its backoff has passed
+        if capture.opened or task.cancelled():
+            self.failures.pop(name,None)
+            self.retry.pop(name,None)
+            return
+        self.failures[name] = self.failures.get(name,0) + 1
+        wait = min(REOPEN_INTERVAL*2**(self.failures[name]-1),REOPEN_INTERVAL_MAX)
+        self.retry[name] = time.monotonic() + wait
+        logging.info('Trying to capture %s again in %ds' % (name,wait))
+    def get(self,name):
+        # the running capture of a port, or None
+        entry = self.captures.get(name)
+        if entry is None or entry[1].done():
+            return None
+        return entry[0]
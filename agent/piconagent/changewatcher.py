@@ -0,0 +1,145 @@
+import ctypes, ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import socket
+import struct
+import asyncio
+import piconagent.utils as utils
+from pyroute2.netlink import rtnl
+
+# inotify(7) event masks
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# netlink multicast groups for link and address changes
+NETLINK_GROUPS = rtnl.RTMGRP_LINK | rtnl.RTMGRP_IPV4_IFADDR | rtnl.RTMGRP_IPV6_IFADDR
+# netlink(7) message header: length, type, flags, sequence number, port id
+NLMSG_HEADER = struct.Struct('=IHHII')
+RTM_EVENTS = {16: 'RTM_NEWLINK',17: 'RTM_DELLINK',20: 'RTM_NEWADDR',21: 'RTM_DELADDR'}
+
+class ChangeWatcher():
+    # Sets the changed event when an interface or address changes (netlink events) or a
+    # console port appears or disappears under /dev (inotify). Both sockets are read by
+    # the agent's event loop; where inotify is not available the port list is polled
+    # every pollInterval seconds instead.
+    def __init__(self,devdir='/dev',pollInterval=5):
+        self.devdir = devdir
+        self.pollInterval = pollInterval
+        self.changed = asyncio.Event()
+        self.netlink = None
+        self.inotifyFd = None
+        self.pollTask = None
+        self.ports = None
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.openNetlink()
+        if self.netlink is not None:
+            loop.add_reader(self.netlink.fileno(),self.readNetlink)
+        self.openInotify()
+        if self.inotifyFd is not None:
+            loop.add_reader(self.inotifyFd,self.readInotify)
+        else:
+            self.ports = set(utils.getPorts())
+            self.pollTask = loop.create_task(self.pollPorts())
+    async def wait(self,timeout):
+        # wait up to timeout seconds for a change, returning whether one happened
+        try:
+            await asyncio.wait_for(self.changed.wait(),timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+    def notify(self,reason):
+        logging.debug('Change detected: ' + reason)
+        self.changed.set()
+
+    def openNetlink(self):
+        # a plain rtnetlink socket: events are only told apart by their type, never parsed, and
+        # pyroute2's IPRoute cannot be read from inside a running event loop
+        try:
+            self.netlink = socket.socket(socket.AF_NETLINK,socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,socket.NETLINK_ROUTE)
+        except (OSError, AttributeError) as e:
+            logging.warning('Not watching interfaces, netlink subscription failed: ' + str(e))
+            return
+        try:
+            self.netlink.bind((0,NETLINK_GROUPS))
+        except OSError as e:
+            logging.warning('Not watching interfaces, netlink subscription failed: ' + str(e))
+            self.netlink.close()
+            self.netlink = None
+    def readNetlink(self):
+        try:
+            data = self.netlink.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno == errno.ENOBUFS:
+                # events were dropped because we fell behind; something changed all the same
+                self.notify('netlink events dropped')
+                return
+            logging.warning('Stopped watching interfaces, reading netlink events failed: ' + str(e))
+            self.closeNetlink()
+            return
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, kind, flags, seq, pid = NLMSG_HEADER.unpack_from(data,offset)
+            if length < NLMSG_HEADER.size:
+                break
+            self.notify('netlink ' + RTM_EVENTS.get(kind,str(kind)))
+            # messages are aligned to 4 bytes
+            offset += (length + 3) & ~3
+
+    def openInotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(),'inotify_init1 failed')
+            wd = libc.inotify_add_watch(fd,self.devdir.encode(),IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(),'inotify_add_watch failed')
+        except (OSError, AttributeError) as e:
+            logging.warning('inotify is not available, polling %s for ports every %ds: %s' % (self.devdir,self.pollInterval,str(e)))
+            return
+        self.inotifyFd = fd
+    def readInotify(self):
+        try:
+            buf = os.read(self.inotifyFd,4096)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf,offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset:offset+length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if any(fnmatch.fnmatch(name,pattern) for pattern in utils.PORT_PATTERNS):
+                self.notify('%s %s' % (name,'added' if mask & (IN_CREATE | IN_MOVED_TO) else 'removed'))
+
+    async def pollPorts(self):
+        while True:
+            await asyncio.sleep(self.pollInterval)
+            ports = set(utils.getPorts())
+            if ports != self.ports:
+                self.ports = ports
+                self.notify('port list changed')
+
+    def closeNetlink(self):
+        if self.netlink is not None:
+            asyncio.get_running_loop().remove_reader(self.netlink.fileno())
+            self.netlink.close()
+            self.netlink = None
+    def close(self):
+        self.closeNetlink()
+        if self.inotifyFd is not None:
+            asyncio.get_running_loop().remove_reader(self.inotifyFd)
+            os.close(self.inotifyFd)
+            self.inotifyFd = None
+        if self.pollTask is not None:
+            self.pollTask.cancel()
+            self.pollTask = None
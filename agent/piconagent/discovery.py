@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import time
+import piconagent.serialport as serialport
+
+# line speeds tried in order, most common console speeds first
+PROBE_BAUDRATES = (9600,115200,38400,19200,57600)
+# ports probed at the same time
+PROBE_WORKERS = 8
+# seconds to wait for an answer to a carriage return at each speed
+PROBE_TIMEOUT = 0.5
+# share of printable characters an answer needs for the speed to be taken as right
+PRINTABLE_RATIO = 0.9
+# seconds before a port found without a live console is probed again, doubled per probe
+# that still finds none; a console may have been powered off or cabled up later
+REPROBE_INTERVAL = 60
+REPROBE_INTERVAL_MAX = 60*60
+PRINTABLE = frozenset(range(0x20,0x7f)) | frozenset(b'\r\n\t\x08\x1b')
+
+def getIdentity(name,sysdir='/sys/class/tty'):
+    # identity of the hardware behind a port: vendor, product and serial number of a USB
+    # adapter, or the sysfs path of anything else. Replugging an adapter, even into another
+    # USB port, keeps its identity as long as it has a serial number
+    try:
+        path = os.path.realpath(os.path.join(sysdir,name,'device'))
+    except OSError:
+        return None
+    device = path
+    while device != '/':
+        if os.path.exists(os.path.join(device,'idVendor')):
+            ids = []
+            for attr in ('idVendor','idProduct','serial'):
+                try:
+                    with open(os.path.join(device,attr)) as f:
+                        ids.append(f.read().strip())
+                except OSError:
+                    # adapters without a serial number are told apart by where they are plugged in
+                    ids.append(os.path.basename(device))
+            return ':'.join(ids)
+        device = os.path.dirname(device)
+    return path
+
+def scoreAnswer(data):
+    # share of printable characters in an answer, 0 for none
+    if not data:
+        return 0
+    return sum(1 for b in data if b in PRINTABLE) / len(data)
+
+class PortDiscovery():
+    # Finds out which serial ports have a live console attached and at what speed, without
+    # holding up registration: update() returns what is known straight away and probes the
+    # rest in the background, at most workers ports at a time. A probe sends a carriage
+    # return at each of baudrates and takes the first speed answered with a readable prompt.
+    # Live results are cached per port and hardware identity, so only hotplugged ports are
+    # probed again; ports without a live console are probed again on a backoff, as long as
+    # no console session is using them. onChange() is called once probes have produced new
+    # results.
+    def __init__(self,startTask,onChange=None,baudrates=PROBE_BAUDRATES,workers=PROBE_WORKERS,timeout=PROBE_TIMEOUT):
+        self.startTask = startTask
+        self.onChange = onChange
+        self.baudrates = [b for b in baudrates if b in serialport.BAUDRATES]
+        self.timeout = timeout
+        self.workers = asyncio.Semaphore(workers)
+        # port name -> (identity, {'speed': ..., 'live': ...}, time to probe again or None)
+        self.cache = {}
+        # port name -> probes in a row that found no live console
+        self.failures = {}
+        # port name -> (identity, probe task)
+        self.probing = {}
+    def update(self,ports,busy=()):
+        # port name -> {'speed','live'} for ports, both None for ports still being probed;
+        # busy ports are in use by a console session and not probed again
+        info = {}
+        now = time.monotonic()
+        for name in ports:
+            identity = getIdentity(name)
+            cached = self.cache.get(name)
+            if cached is not None and cached[0] == identity and (cached[2] is None or cached[2] > now or name in busy or name in self.probing):
+                info[name] = cached[1]
+                continue
+            if cached is not None and cached[0] != identity:
+                # different hardware starts over with a short backoff
+                self.failures.pop(name,None)
+            running = self.probing.get(name)
+            if running is None or running[0] != identity:
+                if running is not None:
+                    running[1].cancel()
+                self.probing[name] = (identity,self.startTask(self.probe(name,identity)))
+            info[name] = cached[1] if cached is not None and cached[0] == identity else {'speed': None,'live': None}
+        for name in list(self.cache):
+            if name not in ports:
+                del self.cache[name]
+                self.failures.pop(name,None)
+        for name in list(self.probing):
+            if name not in ports:
+                self.probing.pop(name)[1].cancel()
+        return info
+    def speed(self,name):
+        # detected speed of a port, or None
+        cached = self.cache.get(name)
+        return cached[1]['speed'] if cached is not None else None
+    async def probe(self,name,identity):
+        try:
+            async with self.workers:
+                started = time.monotonic()
+                result = await self.probeSpeeds(name)
+            logging.info('Probed %s in %.1fs: %s' % (name,time.monotonic() - started,'live at %s baud' % result['speed'] if result['live'] else 'no console'))
+            if result['live']:
+                self.failures.pop(name,None)
+                retry = None
+            else:
+                self.failures[name] = self.failures.get(name,0) + 1
+                retry = time.monotonic() + min(REPROBE_INTERVAL*2**(self.failures[name]-1),REPROBE_INTERVAL_MAX)
+            previous = self.cache.get(name)
+            self.cache[name] = (identity,result,retry)
+            if self.onChange is not None and (previous is None or previous[1] != result):
+                self.onChange()
+        finally:
+            if self.probing.get(name,(None,None))[1] is asyncio.current_task():
+                del self.probing[name]
+    async def probeSpeeds(self,name):
+        # a port that answers only with garbage is live, at a speed we do not know
+        live = False
+        for baudrate in self.baudrates:
+            try:
+                answer = await self.probeSpeed(name,baudrate)
+            except OSError as exc:
+                # e.g. a ttyS with no UART behind it
+                logging.debug('Cannot probe %s: %s' % (name,str(exc)))
+                break
+            if answer:
+                live = True
+                if scoreAnswer(answer) >= PRINTABLE_RATIO:
+                    return {'speed': baudrate,'live': True}
+        return {'speed': None,'live': live}
+    async def probeSpeed(self,name,baudrate):
+        # send a carriage return and collect what comes back within the timeout
+        port = serialport.SerialPort(name,baudrate).open()
+        answer = bytearray()
+        try:
+            await port.write(b'\r')
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            while deadline > loop.time():
+                try:
+                    data = await asyncio.wait_for(port.read(),deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    break
+                answer += data
+        finally:
+            port.close()
+        return bytes(answer)
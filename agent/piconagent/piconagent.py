@@ -1,75 +1,272 @@
 import traceback
-import piconagent.sshchannelthread as sshchannelthread
+import piconagent.sshtunnel as sshtunnel
+import piconagent.serialport as serialport
+import piconagent.capture as consolecapture
+import piconagent.changewatcher as changewatcher
+import piconagent.discovery as discovery
 import piconagent.utils as utils
-from time import sleep
+import asyncio
 import logging
 import math
-import json,requests
+import random
+import time
+import gzip
+import json
+import aiohttp
+
+# seconds to wait before the first retry of a failed registration, doubled per retry
+RETRY_BACKOFF = 1
+RETRY_BACKOFF_MAX = 16
+# smaller bodies are not worth compressing
+GZIP_MIN_SIZE = 256
+# seconds to let a burst of change events settle before registering once for all of them
+DEBOUNCE = 2
 
 class PiConAgent():
-    def __init__(self,endpoint='http://localhost/api/',headers={'content-type': 'application/json'},holdtime=300,interval=60):
-        # requests is too noisy for INFO
+    def __init__(self,endpoint='http://localhost/api/',headers={'content-type': 'application/json'},holdtime=300,interval=60,compress=False,timeout=2,retries=3,watch=True,heartbeat=None,debounce=DEBOUNCE,keepaliveInterval=sshtunnel.KEEPALIVE_INTERVAL,deadPeerTimeout=sshtunnel.DEAD_PEER_TIMEOUT,forwardPorts=True,baudrate=serialport.DEFAULT_BAUDRATE,capture=False,logdir=None,logOptions={},shipHistory=False,discover=False,probeOptions={}):
         logging.basicConfig(level=logging.INFO)
-        logging.getLogger('requests').setLevel(logging.WARN)
         self.endpoint = endpoint
         self.headers = headers
         self.holdtime = holdtime
         self.interval = interval
-        self.sshChannelThread = None
-    def register(self):
+        self.compress = compress
+        self.timeout = timeout
+        self.retries = retries
+        # with change watching, registrations go out as soon as the inventory changes, so the
+        # periodic registration only has to keep the server from declaring us dead
+        self.watch = watch
+        if heartbeat is None:
+            heartbeat = max(interval,holdtime/3) if watch else interval
+        self.heartbeat = heartbeat
+        self.debounce = debounce
+        self.changeWatcher = None
+        # one session for every registration, so the TCP (and TLS) connection is kept alive
+        # and reused; created in run(), on the agent's event loop
+        self.session = None
+        self.keepaliveInterval = keepaliveInterval
+        self.deadPeerTimeout = deadPeerTimeout
+        # expose every serial port on its own remote port, allocated by the server
+        self.forwardPorts = forwardPorts
+        self.baudrate = baudrate
+        self.consolePorts = {}
+        # read every console continuously, logging it to logdir if one is given
+        # ship the output of every console to the server's history store
+        self.shipHistory = shipHistory
+        self.capture = capture or logdir is not None or shipHistory
+        self.logdir = logdir
+        self.logOptions = logOptions
+        self.captures = None
+        # probe serial ports for a live console and its speed; see discovery.PortDiscovery
+        self.discover = discover
+        self.probeOptions = probeOptions
+        self.discovery = None
+        self.tunnel = None
+        self.tunnelTask = None
+        # registration, tunnel and console coroutines, cancelled together on shutdown
+        self.tasks = set()
+        self.tunnelserver = None
+        self.tunnelport = None
+        # digest of the last inventory the server acknowledged
+        self.inventoryDigest = None
+    async def register(self,onlyIfChanged=False):
         body = {}
         body['hostname'] = utils.getHostname()
         body['sn'] = utils.getSerial()
+        collectStart = time.monotonic()
         try:
-            body['interfaces'] = utils.getInterfaces()
+            interfaces = await utils.collectInterfaces()
         except Exception as e:
             logging.error('Skipping this registration attempt because:  ' + str(e))
-            logging.error("%d failed attempts in a row will result in the server declaring us dead (holdtime: %d, registration interval: %d)" % (math.ceil(self.holdtime/self.interval),self.holdtime,self.interval))
+            logging.error("%d failed attempts in a row will result in the server declaring us dead (holdtime: %d, heartbeat: %d)" % (math.ceil(self.holdtime/self.heartbeat),self.holdtime,self.heartbeat))
             return False
-        body['ports'] = utils.getPorts()
+        ports = utils.getPorts()
+        portInfo = None
+        if self.discovery is not None:
+            # never probe a console an operator is connected to
+            portInfo = self.discovery.update(ports,self.tunnel.consolesInUse if self.tunnel is not None else ())
+        if self.captures is not None:
+            if portInfo is None:
+                self.captures.setPorts(ports)
+            else:
+                # only consoles found live are captured, at the speed they answered at
+                self.captures.setPorts([p for p in ports if portInfo[p]['live']],dict((p,i['speed']) for p, i in portInfo.items() if i['speed']))
+        logging.debug('Collected %d interfaces and %d ports in %.1fms' % (len(interfaces),len(ports),(time.monotonic() - collectStart)*1000))
         body['holdtime'] = self.holdtime
-        jsonbody = json.dumps(body,sort_keys=True,indent=2)
-        try:
-            r = requests.post(self.endpoint+'register', data = jsonbody, headers = self.headers,timeout=2)
-        except Exception as e:
-            logging.error('PiCon registration attempt failed: ' + str(e))
-            return False
-        else:
-            logging.info('Successfully registered with endpoint ' + self.endpoint+'register')
-            logging.debug('Sent JSON in POST body:' + "\n" +  jsonbody)
-            logging.debug('Received JSON in POST response:' + "\n" +  r.text)
-            rjson = r.json()
-            if rjson is not None and 'tunnel' in rjson  and 'server' in rjson['tunnel']:
-                self.tunnelserver=rjson['tunnel']['server']
-            if rjson is not None and 'tunnel' in rjson  and 'port' in rjson['tunnel']:
-                self.tunnelport=rjson['tunnel']['port']
+        if self.tunnel is not None:
+            body['tunnel_state'] = self.tunnel.state()
+        if self.forwardPorts:
+            body['forward_ports'] = True
+        digest = utils.getInventoryDigest(interfaces,ports,portInfo)
+        body['inventory_digest'] = digest
+        if onlyIfChanged and digest == self.inventoryDigest:
+            logging.debug('Inventory unchanged, not registering')
             return True
+        # only send the full inventory when it changed since the server last acknowledged it
+        if digest != self.inventoryDigest:
+            body['interfaces'] = interfaces
+            body['ports'] = ports
+            if portInfo is not None:
+                body['port_info'] = portInfo
+        rjson = await self.post(body)
+        if rjson is None:
+            return False
+        if rjson.get('send_inventory') and 'interfaces' not in body:
+            logging.info('Server requested full inventory, resending')
+            body['interfaces'] = interfaces
+            body['ports'] = ports
+            if portInfo is not None:
+                body['port_info'] = portInfo
+            rjson = await self.post(body)
+            if rjson is None:
+                return False
+        if not rjson.get('send_inventory'):
+            self.inventoryDigest = digest
+        if 'tunnel' in rjson and 'server' in rjson['tunnel']:
+            self.tunnelserver=rjson['tunnel']['server']
+        if 'tunnel' in rjson and 'port' in rjson['tunnel']:
+            self.tunnelport=rjson['tunnel']['port']
+        if 'tunnel' in rjson and 'ports' in rjson['tunnel']:
+            self.consolePorts=rjson['tunnel']['ports']
+            if self.tunnel is not None:
+                self.tunnel.setConsolePorts(self.consolePorts)
+        return True
+
+    async def post(self,body,path='register'):
+        # POST a registration body to endpoint+path, returning the decoded JSON response or None on failure.
+        # Failed attempts are retried with backoff, but only while the retry still fits in
+        # half the registration interval, so the next registration is never held up
+        jsonbody = json.dumps(body,separators=(',',':'))
+        data = jsonbody.encode('utf-8')
+        headers = {}
+        if self.compress and len(data) >= GZIP_MIN_SIZE:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        deadline = time.monotonic() + self.interval/2
+        delay = RETRY_BACKOFF
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self.session.post(self.endpoint+path, data = data, headers = headers) as r:
+                    status = r.status
+                    text = await r.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            else:
+                if status < 500:
+                    break
+                error = 'server returned HTTP %d' % status
+            wait = delay * random.uniform(0.5,1)
+            if attempt > self.retries or time.monotonic() + wait + self.timeout > deadline:
+                logging.error('PiCon registration attempt failed: ' + error)
+                return None
+            logging.warning('PiCon registration attempt %d failed (%s), retrying in %.1fs' % (attempt,error,wait))
+            await asyncio.sleep(wait)
+            delay = min(delay*2,RETRY_BACKOFF_MAX)
+        logging.info('Successfully registered with endpoint ' + self.endpoint+path)
+        logging.debug('Sent JSON in POST body (%d bytes on the wire):' % len(data) + "\n" +  jsonbody)
+        logging.debug('Received JSON in POST response:' + "\n" +  text)
+        try:
+            rjson = json.loads(text)
+        except ValueError as e:
+            logging.error('PiCon registration response was not valid JSON: ' + str(e))
+            return None
+        if rjson is None:
+            return {}
+        return rjson
+
+    async def postHistory(self,port,start,end,body):
+        # POST a gzip-compressed chunk of console output to the server's history store,
+        # returning True once it is stored; a failed chunk is retried with the next one
+        url = self.endpoint + 'history/%s/%s' % (utils.getSerial(),port)
+        params = {'start': '%.3f' % start,'end': '%.3f' % end}
+        try:
+            async with self.session.post(url,params=params,data=body,headers={'content-type': 'application/gzip'}) as r:
+                if r.status < 500:
+                    # a chunk the server refused would only be refused again
+                    if r.status != 200:
+                        logging.error('Server refused console output of %s: HTTP %d' % (port,r.status))
+                    return True
+                error = 'server returned HTTP %d' % r.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        logging.warning('Shipping console output of %s failed: %s' % (port,error))
+        return False
 
-    def run(self):
+    async def run(self):
+        # runs registration, tunnel supervision and change watching on one event loop until cancelled
+        self.openSession()
+        if self.discover:
+            self.discovery = discovery.PortDiscovery(self.startTask,self.portsProbed,**self.probeOptions)
+        if self.capture:
+            ship = self.postHistory if self.shipHistory else None
+            self.captures = consolecapture.CaptureManager(self.startTask,self.baudrate,self.logdir,ship,**self.logOptions)
+        if self.watch:
+            self.changeWatcher = changewatcher.ChangeWatcher()
+            self.changeWatcher.start()
+        try:
+            await self.registrationLoop()
+        finally:
+            if self.changeWatcher is not None:
+                self.changeWatcher.close()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks,return_exceptions=True)
+            await self.session.close()
+    def portsProbed(self):
+        # report probe results straight away rather than with the next heartbeat
+        if self.changeWatcher is not None:
+            self.changeWatcher.notify('serial ports probed')
+    def openSession(self):
+        self.session = aiohttp.ClientSession(headers=self.headers,timeout=aiohttp.ClientTimeout(total=self.timeout))
+    async def registrationLoop(self):
+        loop = asyncio.get_running_loop()
+        nextHeartbeat = 0
         while True:
-            regStatus = self.register()
-            if regStatus and (not self.sshChannelThread or not self.sshChannelThread.is_alive()) and self.tunnelport and self.tunnelserver:
-                if self.sshChannelThread is None and self.tunnelport and self.tunnelserver:
-                    self.connectSSH()
-                elif regStatus:
-                    logging.error("SSH tunnel connection closed unexpectedly, restarting connection to %s:%d" % (self.tunnelserver,self.tunnelport) )
-                    self.connectSSH(restart=True)
-            sleep(self.interval)
+            changed = False
+            wait = nextHeartbeat - loop.time()
+            if self.changeWatcher is not None and wait > 0 and await self.changeWatcher.wait(wait):
+                # let a burst of events settle (a cable plug-in produces several) and register once
+                await asyncio.sleep(self.debounce)
+                changed = True
+            else:
+                await asyncio.sleep(max(0,nextHeartbeat - loop.time()))
+                # keep to the heartbeat even when a registration was slow or retried
+                nextHeartbeat = loop.time() + self.heartbeat
+            if self.changeWatcher is not None:
+                # this registration collects everything that changed up to now
+                self.changeWatcher.changed.clear()
+            regStatus = await self.register(onlyIfChanged=changed)
+            # the tunnel supervises its own reconnects; it is only replaced when the server moves it
+            if regStatus and self.tunnelport and self.tunnelserver and (self.tunnel is None or (self.tunnel.tunnelserver,self.tunnel.tunnelport) != (self.tunnelserver,self.tunnelport)):
+                self.connectSSH(restart=self.tunnel is not None)
+    def startTask(self,coro):
+        # run a coroutine alongside registration, cancelling it when the agent stops
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
     def connectSSH(self,restart=False):
         if restart:
             logging.info("Retarting SSH tunnel connection to %s:%d" % (self.tunnelserver,self.tunnelport) )
         else:
             logging.info("Starting SSH tunnel connection to %s:%d" % (self.tunnelserver,self.tunnelport) )
-        self.sshChannelThread=sshchannelthread.sshChannelThread(tunnelserver=self.tunnelserver,tunnelport=self.tunnelport)
-        self.sshChannelThread.start()
+        if self.tunnelTask is not None:
+            self.tunnelTask.cancel()
+        self.tunnel = sshtunnel.SSHTunnel(self.startTask,tunnelserver=self.tunnelserver,tunnelport=self.tunnelport,keepaliveInterval=self.keepaliveInterval,deadPeerTimeout=self.deadPeerTimeout,consolePorts=self.consolePorts,baudrate=self.baudrate,captures=self.captures,discovery=self.discovery)
+        self.tunnelTask = self.startTask(self.tunnel.run())
 
 
 def main():
-    # create an agent and register
+    # create an agent and register once
     a = PiConAgent('http://199.187.221.170:5000/api/')
-    a.register()
-    sys.stderr.write(PiConAgent.jsonbody)
+    async def registerOnce():
+        a.openSession()
+        try:
+            await a.register()
+        finally:
+            await a.session.close()
+    asyncio.run(registerOnce())
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import time
+import piconagent.utils as utils
+import piconagent.discovery as discovery
+from piconagent.piconagent import PiConAgent
+
+# connections open at the same time to one terminal server; most limit their sessions
+MAX_CONNECTIONS = 8
+# seconds to wait for a terminal server to accept a connection
+CONNECT_TIMEOUT = 5
+# seconds an idle line connection is kept for the next health check. 0 closes it after
+# every check, leaving the line free for operators connecting to the terminal server
+# directly; raise it for terminal servers that allow several sessions per line
+IDLE_TIMEOUT = 0
+# seconds a line has to answer a carriage return in to count as live
+CHECK_TIMEOUT = 2
+# lines health-checked at the same time, across every terminal server
+CHECK_WORKERS = 64
+# telnet commands (RFC 854) that reverse-telnet lines send as soon as they are connected
+IAC = 255
+SB = 250
+SE = 240
+WILL, WONT, DO, DONT = 251, 252, 253, 254
+
+def stripTelnet(data):
+    # remove telnet command and option negotiation sequences, keeping the line's own output
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        b = data[i]
+        if b != IAC:
+            out.append(b)
+            i += 1
+        elif i + 1 >= len(data):
+            break
+        elif data[i+1] == IAC:
+            out.append(IAC)
+            i += 2
+        elif data[i+1] in (WILL,WONT,DO,DONT):
+            i += 3
+        elif data[i+1] == SB:
+            end = data.find(bytes((IAC,SE)),i+2)
+            if end < 0:
+                break
+            i = end + 2
+        else:
+            i += 2
+    return bytes(out)
+
+class ConsoleLine():
+    # One console port of a terminal server, reached at server.host:port and registered
+    # as a device of its own: name is its hostname and port name, sn defaults to host-port.
+    def __init__(self,server,port,name=None,sn=None):
+        self.server = server
+        self.port = port
+        self.name = name or '%s-%d' % (server.host,port)
+        self.sn = sn or '%s-%d' % (server.host,port)
+        self.live = None
+        # digest of the inventory the server last acknowledged for this line
+        self.inventoryDigest = None
+
+class TerminalServer():
+    # An existing console server (Cisco, Digi, Avocent, ...) whose lines are reached over
+    # TCP, one port per line. Connections to it are pooled: at most maxConnections are open
+    # at once, and with an idleTimeout a line's connection is kept and reused for its next
+    # check rather than reopened. An idle connection is closed early when its slot is
+    # needed for another line.
+    def __init__(self,host,lines=(),maxConnections=MAX_CONNECTIONS,connectTimeout=CONNECT_TIMEOUT,idleTimeout=IDLE_TIMEOUT):
+        self.host = host
+        self.connectTimeout = connectTimeout
+        self.idleTimeout = idleTimeout
+        self.slots = asyncio.Semaphore(maxConnections)
+        # port -> (reader, writer, time released)
+        self.idle = {}
+        # acquire() calls waiting for a slot; while there are any, nothing is kept idle
+        self.waiting = 0
+        self.lines = [ConsoleLine(self,**line) for line in lines]
+    async def acquire(self,port):
+        # return (reader, writer) connected to port, reusing an idle connection if there is one
+        loop = asyncio.get_running_loop()
+        idle = self.idle.pop(port,None)
+        if idle is not None:
+            reader, writer, released = idle
+            if not reader.at_eof() and loop.time() - released < self.idleTimeout:
+                return reader, writer
+            writer.close()
+            self.slots.release()
+        while self.slots.locked() and self.idle:
+            self.closeIdle(next(iter(self.idle)))
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host,port),self.connectTimeout)
+        except:
+            self.slots.release()
+            raise
+    def release(self,port,reader,writer,reuse=True):
+        # give back a connection from acquire(); reuse=False when it is in an unknown state
+        if reuse and self.idleTimeout > 0 and not self.waiting and port not in self.idle and not reader.at_eof():
+            self.idle[port] = (reader,writer,asyncio.get_running_loop().time())
+            return
+        writer.close()
+        self.slots.release()
+    def closeIdle(self,port):
+        reader, writer, released = self.idle.pop(port)
+        writer.close()
+        self.slots.release()
+    def close(self):
+        for port in list(self.idle):
+            self.closeIdle(port)
+
+def loadConfig(path,**serverOptions):
+    # read the terminal servers and their lines from a JSON file:
+    # {"servers": [{"host": "ts1.example.net", "max_connections": 4,
+    #               "lines": [{"port": 2001, "name": "core1-console"}, ...]}, ...]}
+    with open(path) as f:
+        config = json.load(f)
+    servers = []
+    for entry in config['servers']:
+        options = dict(serverOptions)
+        if 'max_connections' in entry:
+            options['maxConnections'] = entry['max_connections']
+        if 'idle_timeout' in entry:
+            options['idleTimeout'] = entry['idle_timeout']
+        servers.append(TerminalServer(entry['host'],entry.get('lines',[]),**options))
+    return servers
+
+class ProxyAgent(PiConAgent):
+    # Fronts the console lines of existing terminal servers from one process: every line is
+    # health-checked concurrently (at most checkWorkers at a time, and no more connections
+    # per terminal server than its pool allows) and all of them are registered with one
+    # request to register/batch per cycle. Like a Pi agent, a line only sends its full
+    # inventory when it changed since the server last acknowledged it.
+    def __init__(self,endpoint,servers,checkTimeout=CHECK_TIMEOUT,checkWorkers=CHECK_WORKERS,**agentOptions):
+        agentOptions['watch'] = False
+        PiConAgent.__init__(self,endpoint,**agentOptions)
+        self.servers = servers
+        self.checkTimeout = checkTimeout
+        self.checkWorkers = checkWorkers
+        self.lines = [line for server in servers for line in server.lines]
+        self.linesBySn = dict((line.sn,line) for line in self.lines)
+        if len(self.linesBySn) != len(self.lines):
+            raise ValueError('Two console lines have the same serial number')
+    async def register(self,onlyIfChanged=False):
+        collectStart = time.monotonic()
+        workers = asyncio.Semaphore(self.checkWorkers)
+        await asyncio.gather(*[self.checkLine(line,workers) for line in self.lines])
+        logging.debug('Checked %d lines, %d live, in %.1fms' % (len(self.lines),sum(1 for l in self.lines if l.live),(time.monotonic() - collectStart)*1000))
+        bodies = dict((line.sn,self.lineBody(line)) for line in self.lines)
+        rjson = await self.post({'devices': list(bodies.values())},'register/batch')
+        if rjson is None:
+            return False
+        resend = []
+        for result in rjson.get('results',[]):
+            body = bodies.get(result.get('sn'))
+            if body is None:
+                continue
+            if result.get('status') != 'ok':
+                logging.error('Registration of line %s failed: %s' % (body['hostname'],result.get('error')))
+            elif result.get('send_inventory') and 'ports' not in body:
+                resend.append(body)
+            elif not result.get('send_inventory'):
+                self.linesBySn[body['sn']].inventoryDigest = body['inventory_digest']
+        if resend:
+            logging.info('Server requested full inventory of %d lines, resending' % len(resend))
+            for body in resend:
+                self.addInventory(body,self.linesBySn[body['sn']])
+            rjson = await self.post({'devices': resend},'register/batch')
+            if rjson is None:
+                return False
+            for result in rjson.get('results',[]):
+                if result.get('status') == 'ok' and not result.get('send_inventory') and result.get('sn') in bodies:
+                    self.linesBySn[result['sn']].inventoryDigest = bodies[result['sn']]['inventory_digest']
+        return True
+    def lineBody(self,line):
+        body = {
+            'hostname': line.name,
+            'sn': line.sn,
+            'holdtime': self.holdtime,
+            # lines are reached through their terminal server and need no tunnel port
+            'proxied': True,
+            'inventory_digest': utils.getInventoryDigest({},[line.name],self.portInfo(line))
+        }
+        if body['inventory_digest'] != line.inventoryDigest:
+            self.addInventory(body,line)
+        return body
+    def addInventory(self,body,line):
+        body['interfaces'] = {}
+        body['ports'] = [line.name]
+        body['port_info'] = self.portInfo(line)
+    def portInfo(self,line):
+        # the terminal server sets the line speed; only liveness is known here
+        return {line.name: {'speed': None,'live': line.live}}
+    async def checkLine(self,line,workers):
+        # a line is live when it answers a carriage return with readable text, e.g. a
+        # prompt; telnet negotiation from the terminal server itself does not count
+        async with workers:
+            server = line.server
+            try:
+                reader, writer = await server.acquire(line.port)
+            except (OSError, asyncio.TimeoutError) as exc:
+                logging.debug('Cannot connect to line %s at %s:%d: %s' % (line.name,server.host,line.port,str(exc) or type(exc).__name__))
+                line.live = False
+                return
+            reuse = False
+            answer = b''
+            try:
+                writer.write(b'\r')
+                await writer.drain()
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + self.checkTimeout
+                while not answer and deadline > loop.time():
+                    try:
+                        data = await asyncio.wait_for(reader.read(4096),deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                    if not data:
+                        break
+                    answer = stripTelnet(data)
+                reuse = not reader.at_eof()
+            except OSError:
+                pass
+            finally:
+                server.release(line.port,reader,writer,reuse)
+            line.live = discovery.scoreAnswer(answer) >= discovery.PRINTABLE_RATIO
+    async def run(self):
+        try:
+            await PiConAgent.run(self)
+        finally:
+            for server in self.servers:
+                server.close()
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import termios
+import tty
+
+# line speeds termios can set, by bits per second
+BAUDRATES = dict((int(name[1:]),getattr(termios,name)) for name in dir(termios) if name[0] == 'B' and name[1:].isdigit())
+DEFAULT_BAUDRATE = 9600
+
+class SerialPort():
+    # A console port opened raw and non-blocking, read and written from the agent's event
+    # loop without a thread per port.
+    def __init__(self,name,baudrate=DEFAULT_BAUDRATE,devdir='/dev'):
+        if baudrate not in BAUDRATES:
+            raise ValueError('Unsupported baud rate: %d' % baudrate)
+        self.name = name
+        self.path = os.path.join(devdir,name)
+        self.baudrate = baudrate
+        self.fd = None
+    def open(self):
+        self.fd = os.open(self.path,os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(self.fd)
+            attrs = termios.tcgetattr(self.fd)
+            attrs[4] = attrs[5] = BAUDRATES[self.baudrate]
+            # ignore modem control lines, so a console without DCD still talks to us
+            attrs[2] |= termios.CLOCAL | termios.CREAD
+            termios.tcsetattr(self.fd,termios.TCSANOW,attrs)
+        except:
+            self.close()
+            raise
+        return self
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    async def read(self,size=4096):
+        # return the next chunk of console output; b'' once the port has gone away
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return os.read(self.fd,size)
+            except BlockingIOError:
+                await self.ready(loop.add_reader,loop.remove_reader)
+    async def readinto(self,view):
+        # read into a preallocated buffer, returning the number of bytes read; 0 once the port has gone away
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                return os.readv(self.fd,[view])
+            except BlockingIOError:
+                await self.ready(loop.add_reader,loop.remove_reader)
+    async def write(self,data):
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.fd,view):]
+            except BlockingIOError:
+                await self.ready(loop.add_writer,loop.remove_writer)
+    async def ready(self,add,remove):
+        # wait until add() reports the port ready, e.g. loop.add_reader for readable
+        waiter = asyncio.get_running_loop().create_future()
+        add(self.fd,lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            remove(self.fd)
@@ -0,0 +1,187 @@
+import asyncio, asyncssh
+import functools
+import logging
+import math
+import piconagent.serialport as serialport
+import random
+import time
+
+# seconds between SSH keepalives, and how long the tunnel server may stay silent before
+# the connection is considered dead
+KEEPALIVE_INTERVAL = 15
+DEAD_PEER_TIMEOUT = 45
+# reconnect backoff in seconds, doubled per failed attempt
+RECONNECT_BACKOFF = 1
+RECONNECT_BACKOFF_MAX = 60
+
+class SSHTunnel():
+    # Remote-forwards tunnelport on the tunnel server to the local sshd. run() is a
+    # coroutine on the agent's event loop that keeps the tunnel up until cancelled:
+    # keepalives detect a dead tunnel server within deadPeerTimeout, and a dropped
+    # connection is reopened straight away, backing off exponentially (with full jitter,
+    # so a fleet behind one flapping uplink does not reconnect in lockstep) while
+    # attempts keep failing.
+    #
+    # Each serial port in consolePorts (port name -> remote port, as allocated by the
+    # server) is also exposed as a raw TCP stream on its own remote-forwarded port,
+    # multiplexed over the same SSH connection, so operators reach a console directly.
+    # Consoles have no authentication of their own, so their forwards only listen on the
+    # tunnel server's loopback, where the server's console broker connects to them.
+    # Consoles being captured (see capture.CaptureManager) are attached to rather than
+    # opened a second time; others are opened at the speed discovery detected, if any.
+    def __init__(self,startTask,tunnelserver='localhost',tunnelport=2222,keepaliveInterval=KEEPALIVE_INTERVAL,deadPeerTimeout=DEAD_PEER_TIMEOUT,consolePorts=None,baudrate=serialport.DEFAULT_BAUDRATE,captures=None,discovery=None):
+        self.startTask = startTask
+        self.tunnelserver=tunnelserver
+        self.tunnelport=tunnelport
+        self.consolePorts = dict(consolePorts or {})
+        self.baudrate = baudrate
+        self.captures = captures
+        self.discovery = discovery
+        self.conn = None
+        # port name -> (remote port, SSHListener) for the forwards open on conn
+        self.consoleListeners = {}
+        # syncConsoleForwards() run for an allocation that changed while connected
+        self.syncTask = None
+        self.consolesInUse = set()
+        self.keepaliveInterval = keepaliveInterval
+        self.keepaliveCountMax = max(1,math.ceil(deadPeerTimeout/keepaliveInterval))
+        self.up = False
+        self.upSince = None
+        self.connects = 0
+    def state(self):
+        # tunnel state as reported in the registration payload
+        return {
+            'up': self.up,
+            'up_since': self.upSince,
+            'reconnects': max(0,self.connects-1)
+        }
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        delay = RECONNECT_BACKOFF
+        while True:
+            started = loop.time()
+            await self.connect()
+            # a tunnel that stayed up for a while starts over with a short backoff
+            if loop.time() - started > RECONNECT_BACKOFF_MAX:
+                delay = RECONNECT_BACKOFF
+            wait = random.uniform(0,delay)
+            logging.warning("SSH tunnel to %s:%d is down, reconnecting in %.1fs" % (self.tunnelserver,self.tunnelport,wait))
+            await asyncio.sleep(wait)
+            delay = min(delay*2,RECONNECT_BACKOFF_MAX)
+    async def connect(self):
+        # open the tunnel and return once it has gone down
+        try:
+            async with asyncssh.connect(self.tunnelserver,keepalive_interval=self.keepaliveInterval,keepalive_count_max=self.keepaliveCountMax) as conn:
+                await conn.forward_remote_port("", self.tunnelport, 'localhost', 22)
+                self.conn = conn
+                self.syncTask = self.startTask(self.syncConsoleForwards())
+                await self.syncTask
+                self.up = True
+                self.upSince = time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime())
+                self.connects += 1
+                logging.info("SSH tunnel connection to %s localhost:%d is now open" % (self.tunnelserver,self.tunnelport) )
+                await conn.wait_closed()
+        except (OSError, asyncssh.Error) as exc:
+            logging.critical('Failed to open SSH port forwarding channel: '+str(exc))
+        finally:
+            if self.syncTask is not None:
+                self.syncTask.cancel()
+                self.syncTask = None
+            self.conn = None
+            self.consoleListeners = {}
+            self.up = False
+            self.upSince = None
+
+    def setConsolePorts(self,consolePorts):
+        # update the console forwards to a new allocation, on the live connection if there is one
+        if consolePorts == self.consolePorts:
+            return
+        self.consolePorts = dict(consolePorts)
+        # a sync already running picks the new allocation up when it is done with the old one
+        if self.conn is not None and (self.syncTask is None or self.syncTask.done()):
+            self.syncTask = self.startTask(self.syncConsoleForwards())
+    async def syncConsoleForwards(self):
+        conn = self.conn
+        consolePorts = None
+        while consolePorts is not self.consolePorts:
+            consolePorts = self.consolePorts
+            for name, (remotePort, listener) in list(self.consoleListeners.items()):
+                if consolePorts.get(name) != remotePort:
+                    listener.close()
+                    del self.consoleListeners[name]
+            for name, remotePort in consolePorts.items():
+                if name in self.consoleListeners:
+                    continue
+                try:
+                    listener = await conn.start_server(functools.partial(self.consoleSession,name),'localhost',remotePort)
+                except (OSError, asyncssh.Error) as exc:
+                    logging.error('Failed to forward console %s to %s:%d: %s' % (name,self.tunnelserver,remotePort,str(exc)))
+                    continue
+                if conn is not self.conn:
+                    # the connection went down while we were setting up
+                    listener.close()
+                    return
+                self.consoleListeners[name] = (remotePort,listener)
+                logging.info('Console %s is reachable on %s localhost:%d' % (name,self.tunnelserver,remotePort))
+    def consoleSession(self,name,origHost,origPort):
+        # asyncssh handler factory: each connection to a console forward is served by bridgeConsole
+        return functools.partial(self.bridgeConsole,name)
+    async def bridgeConsole(self,name,reader,writer):
+        # one operator at a time per console; bytes are passed through untouched
+        if name in self.consolesInUse:
+            writer.write(b'Console %s is in use\r\n' % name.encode())
+            writer.close()
+            return
+        capture = self.captures.get(name) if self.captures is not None else None
+        if capture is not None:
+            port = None
+            toConsole = asyncio.ensure_future(self.copyToConsole(reader,capture))
+            fromConsole = asyncio.ensure_future(self.copyFromCapture(capture.ring,writer))
+        else:
+            try:
+                baudrate = self.discovery.speed(name) if self.discovery is not None else None
+                port = serialport.SerialPort(name,baudrate or self.baudrate).open()
+            except OSError as exc:
+                writer.write(('Cannot open console %s: %s\r\n' % (name,str(exc))).encode())
+                writer.close()
+                return
+            toConsole = asyncio.ensure_future(self.copyToConsole(reader,port))
+            fromConsole = asyncio.ensure_future(self.copyFromConsole(port,writer))
+        self.consolesInUse.add(name)
+        logging.info('Console session on %s opened' % name)
+        try:
+            await asyncio.wait([toConsole,fromConsole],return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # both copies have to let go of the port before it is closed
+            toConsole.cancel()
+            fromConsole.cancel()
+            await asyncio.gather(toConsole,fromConsole,return_exceptions=True)
+            self.consolesInUse.discard(name)
+            if port is not None:
+                port.close()
+            writer.close()
+            logging.info('Console session on %s closed' % name)
+    async def copyToConsole(self,reader,port):
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                return
+            await port.write(data)
+    async def copyFromConsole(self,port,writer):
+        while True:
+            try:
+                data = await port.read()
+            except OSError:
+                # the USB adapter was unplugged
+                return
+            if not data:
+                return
+            writer.write(data)
+            await writer.drain()
+    async def copyFromCapture(self,ring,writer):
+        # follow the capture's ring buffer from the moment of attaching
+        offset = ring.end
+        while await ring.wait(offset):
+            data, offset = ring.read(offset)
+            writer.write(data)
+            await writer.drain()
@@ -0,0 +1,34 @@
+from unittest import IsolatedAsyncioTestCase
+from ..capture import CaptureManager
+import asyncio
+import time
+
+class TestCaptureManager(IsolatedAsyncioTestCase):
+    async def test_unopenable_port_backs_off(self):
+        tasks = []
+        def startTask(coro):
+            task = asyncio.get_running_loop().create_task(coro)
+            tasks.append(task)
+            return task
+        captures = CaptureManager(startTask)
+        # no such device: opening it fails straight away
+        ports = ['ttyPICONTEST0']
+        captures.setPorts(ports)
+        await asyncio.gather(*tasks)
+        self.assertIsNone(captures.get('ttyPICONTEST0'))
+        self.assertEqual(captures.failures,{'ttyPICONTEST0': 1})
+        # heartbeats within the backoff leave it alone
+        captures.setPorts(ports)
+        captures.setPorts(ports)
+        self.assertEqual(len(tasks),1)
+        # once it has passed the port is tried again, and waited for twice as long after
+        first = captures.retry['ttyPICONTEST0']
+        captures.retry['ttyPICONTEST0'] = time.monotonic()
+        captures.setPorts(ports)
+        await asyncio.gather(*tasks)
+        self.assertEqual(len(tasks),2)
+        self.assertEqual(captures.failures,{'ttyPICONTEST0': 2})
+        self.assertGreater(captures.retry['ttyPICONTEST0'],first)
+        # a port that is gone starts over
+        captures.setPorts([])
+        self.assertEqual((captures.failures,captures.retry),({},{}))
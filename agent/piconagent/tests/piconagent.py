@@ -0,0 +1,35 @@
+from unittest import IsolatedAsyncioTestCase
+from ..piconagent import PiConAgent
+from ..changewatcher import ChangeWatcher
+import asyncio
+
+class TestPiConAgent(IsolatedAsyncioTestCase):
+    def makeAgent(self):
+        agent = PiConAgent('http://localhost/api/',watch=False,forwardPorts=False)
+        self.posted = []
+        async def post(body,path='register'):
+            self.posted.append((path,body))
+            return {'status': 'ok'}
+        agent.post = post
+        return agent
+    async def test_register_in_running_loop(self):
+        # interfaces are collected over netlink while the agent's event loop is running
+        agent = self.makeAgent()
+        self.assertTrue(await agent.register())
+        self.assertEqual(len(self.posted),1)
+        path, body = self.posted[0]
+        self.assertEqual(path,'register')
+        self.assertIn('lo',body['interfaces'])
+        self.assertEqual(body['interfaces']['lo']['addrs'],[])
+        # the acknowledged inventory is not sent again
+        self.assertTrue(await agent.register())
+        self.assertNotIn('interfaces',self.posted[1][1])
+    async def test_change_watcher_subscribes(self):
+        watcher = ChangeWatcher(pollInterval=60)
+        watcher.start()
+        try:
+            self.assertIsNotNone(watcher.netlink)
+            self.assertFalse(await watcher.wait(0.01))
+        finally:
+            watcher.close()
+        self.assertIsNone(watcher.netlink)
@@ -0,0 +1,97 @@
+from unittest import IsolatedAsyncioTestCase
+from ..proxyagent import ProxyAgent, TerminalServer, stripTelnet
+import asyncio
+
+# what a reverse-telnet port sends as soon as it is connected: WILL ECHO, WILL SUPPRESS-GO-AHEAD
+NEGOTIATION = bytes((255,251,1,255,251,3))
+
+class TestProxyAgent(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # stand-ins for two lines of a terminal server: one with a router answering at a
+        # prompt, one with nothing attached that only negotiates telnet options
+        self.connections = 0
+        self.open = 0
+        self.maxOpen = 0
+        async def answering(reader,writer):
+            await self.serve(reader,writer,NEGOTIATION,b'\r\nrouter> ')
+        async def silent(reader,writer):
+            await self.serve(reader,writer,NEGOTIATION,b'')
+        self.answering = await asyncio.start_server(answering,'127.0.0.1',0)
+        self.silent = await asyncio.start_server(silent,'127.0.0.1',0)
+        self.answeringPort = self.answering.sockets[0].getsockname()[1]
+        self.silentPort = self.silent.sockets[0].getsockname()[1]
+    async def serve(self,reader,writer,greeting,answer):
+        self.connections += 1
+        self.open += 1
+        self.maxOpen = max(self.maxOpen,self.open)
+        try:
+            writer.write(greeting)
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                if b'\r' in data:
+                    writer.write(answer)
+                    await writer.drain()
+        finally:
+            self.open -= 1
+            writer.close()
+    async def asyncTearDown(self):
+        for server in (self.answering,self.silent):
+            server.close()
+            await server.wait_closed()
+    def makeAgent(self,**serverOptions):
+        server = TerminalServer('127.0.0.1',[{'port': self.answeringPort,'name': 'core1'},{'port': self.silentPort}],**serverOptions)
+        agent = ProxyAgent('http://localhost/api/',[server],checkTimeout=0.2)
+        self.posted = []
+        async def post(body,path='register'):
+            self.posted.append((path,body))
+            return {'status': 'ok','results': [{'sn': d['sn'],'status': 'ok'} for d in body['devices']]}
+        agent.post = post
+        return server, agent
+    async def test_register_batch(self):
+        server, agent = self.makeAgent()
+        self.assertTrue(await agent.register())
+        self.assertEqual([(l.name,l.live) for l in agent.lines],[('core1',True),('127.0.0.1-%d' % self.silentPort,False)])
+        self.assertEqual(len(self.posted),1)
+        path, body = self.posted[0]
+        self.assertEqual(path,'register/batch')
+        self.assertEqual([d['hostname'] for d in body['devices']],['core1','127.0.0.1-%d' % self.silentPort])
+        device = body['devices'][0]
+        self.assertTrue(device['proxied'])
+        self.assertEqual(device['ports'],['core1'])
+        self.assertEqual(device['port_info'],{'core1': {'speed': None,'live': True}})
+        # unchanged lines only send their digest the next time
+        self.assertTrue(await agent.register())
+        self.assertEqual([sorted(d) for d in self.posted[1][1]['devices']],[['holdtime','hostname','inventory_digest','proxied','sn']]*2)
+    async def test_pool(self):
+        # without an idle timeout every check opens and closes its own connection
+        server, agent = self.makeAgent(maxConnections=1)
+        await agent.register()
+        await agent.register()
+        self.assertEqual(self.connections,4)
+        self.assertEqual(self.maxOpen,1)
+        self.assertEqual(server.idle,{})
+        # with one, a line's connection is reused for its next check
+        self.connections = 0
+        server, agent = self.makeAgent(maxConnections=2,idleTimeout=30)
+        await agent.register()
+        await agent.register()
+        self.assertEqual(self.connections,2)
+        self.assertEqual(sorted(server.idle),sorted((self.answeringPort,self.silentPort)))
+        server.close()
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.open,0)
+        # and closed early when its slot is needed for another line
+        self.connections = 0
+        self.maxOpen = 0
+        server, agent = self.makeAgent(maxConnections=1,idleTimeout=30)
+        await agent.register()
+        self.assertEqual(self.connections,2)
+        self.assertEqual(self.maxOpen,1)
+        self.assertEqual(len(server.idle),1)
+        server.close()
+    def test_strip_telnet(self):
+        self.assertEqual(stripTelnet(NEGOTIATION),b'')
+        self.assertEqual(stripTelnet(NEGOTIATION + b'login: ' + bytes((255,255))),b'login: \xff')
+        self.assertEqual(stripTelnet(bytes((255,250,24,1,255,240)) + b'ok'),b'ok')
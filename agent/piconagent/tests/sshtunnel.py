@@ -0,0 +1,42 @@
+from unittest import IsolatedAsyncioTestCase
+from ..sshtunnel import SSHTunnel
+import asyncio
+
+class FakeListener():
+    def __init__(self,host,port):
+        self.host = host
+        self.port = port
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+class FakeConnection():
+    # stands in for an asyncssh connection, recording the forwards asked for
+    def __init__(self):
+        self.listeners = []
+    async def start_server(self,factory,host,port):
+        await asyncio.sleep(0.01)
+        listener = FakeListener(host,port)
+        self.listeners.append(listener)
+        return listener
+
+class TestSSHTunnel(IsolatedAsyncioTestCase):
+    async def test_console_forwards(self):
+        tasks = []
+        def startTask(coro):
+            task = asyncio.get_running_loop().create_task(coro)
+            tasks.append(task)
+            return task
+        tunnel = SSHTunnel(startTask)
+        tunnel.conn = FakeConnection()
+        tunnel.setConsolePorts({'ttyUSB0': 10001,'ttyUSB1': 10002})
+        while not tunnel.consoleListeners:
+            await asyncio.sleep(0.001)
+        # an allocation changing while the forwards are set up is picked up by the same task
+        tunnel.setConsolePorts({'ttyUSB0': 10001,'ttyUSB1': 10003})
+        self.assertEqual(len(tasks),1)
+        await tasks[0]
+        self.assertEqual(dict((n,p) for n, (p,l) in tunnel.consoleListeners.items()),{'ttyUSB0': 10001,'ttyUSB1': 10003})
+        # raw consoles are only reachable from the tunnel server itself
+        self.assertEqual(set(l.host for l in tunnel.conn.listeners),{'localhost'})
+        self.assertEqual([l.port for l in tunnel.conn.listeners if l.closed],[10002])
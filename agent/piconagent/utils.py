@@ -1,56 +1,95 @@
-import requests,sys,os
-import netifaces
-import ipaddress
+import sys,os
+import asyncio
+import concurrent.futures
 import socket
 import json
 import glob
+import hashlib
+import functools
 from pyroute2 import IPRoute
 import logging
 
+# device names under /dev that are reported as console ports
+PORT_PATTERNS = ('ttyS*','ttyUSB*','ttyACM*')
+
 def getPorts():
     # scan for available ports. return a list of port names with /dev/ stripped off
-    ports = glob.glob('/dev/ttyS*') + glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*')
+    ports = []
+    for pattern in PORT_PATTERNS:
+        ports += glob.glob('/dev/' + pattern)
     ports = [ port.replace('/dev/','') for port in ports ]
     return ports
 
-def getInterfaceState(ifname):
+# netlink socket reused across collection cycles, see getInterfaces()
+_ipr = None
+# pyroute2's IPRoute cannot be used from a thread running an event loop (since 0.9 it runs
+# one of its own), so coroutines collect interfaces on this thread; being the only one, the
+# shared socket never moves between threads
+_netlinkThread = concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix='netlink')
+
+# address scopes (rtnetlink.h) that are never reported: loopback and link-local
+RT_SCOPE_LINK = 253
+RT_SCOPE_HOST = 254
+
+def getNetlink():
+    # return the shared IPRoute socket, opening it on first use
+    global _ipr
+    if _ipr is None:
+        _ipr = IPRoute()
+    return _ipr
+
+def closeNetlink():
+    global _ipr
+    if _ipr is not None:
+        _ipr.close()
+        _ipr = None
+
+def getInterfaces():
+    # one links dump and one addresses dump over a single netlink socket, however many interfaces there are
     try:
-        ip = IPRoute()
-        state = ip.get_links(ip.link_lookup(ifname=ifname))[0].get_attr('IFLA_OPERSTATE')
-        ip.close()
+        ip = getNetlink()
+        links = ip.get_links()
+        ifaddrs = ip.get_addr()
     except Exception as e:
-        raise Exception("getInterfaceState: Collecting interface status for %s failed: %s" % (ifname,str(e)))
-    else:
-        if state == "UP":
-            return True
-    return False
-def getInterfaces():
+        # a broken socket is not reused; the next cycle opens a fresh one
+        closeNetlink()
+        raise Exception("getInterfaces: Collecting interfaces over netlink failed: %s" % str(e))
     addrs = {}
-    for iface in netifaces.interfaces():
+    names = {}
+    for link in links:
+        iface = link.get_attr('IFLA_IFNAME')
+        names[link['index']] = iface
         addrs[iface] = {}
-        addrs[iface]['addrs'] = [] 
-        afs = netifaces.ifaddresses(iface)
-        addrs[iface]['state'] = getInterfaceState(iface)
-        for af in afs:
-            if af == netifaces.AF_LINK:
-                continue
-            for addr in afs[af]:
-                # create ipaddress object out of the address
-                # however, link-locals have an interface from netifaces
-                # and ipaddress does not understand that, so we only take the address
-                address = ipaddress.ip_address(addr['addr'].split('%')[0])
-
-	# ipaddress greatly simplifies implementing this logic
-                if address.is_loopback or address.is_link_local:
-                    continue
-                addrs[iface]['addrs'].append(str(address))
+        addrs[iface]['addrs'] = []
+        addrs[iface]['state'] = link.get_attr('IFLA_OPERSTATE') == "UP"
+    for addr in ifaddrs:
+        iface = names.get(addr['index'])
+        if iface is None or addr['scope'] in (RT_SCOPE_LINK,RT_SCOPE_HOST):
+            continue
+        # on point-to-point links IFA_ADDRESS is the peer, IFA_LOCAL our own address
+        address = addr.get_attr('IFA_LOCAL') or addr.get_attr('IFA_ADDRESS')
+        if address is not None:
+            addrs[iface]['addrs'].append(address)
     return addrs
 
+async def collectInterfaces():
+    # getInterfaces() for coroutines, run off the event loop
+    return await asyncio.get_running_loop().run_in_executor(_netlinkThread,getInterfaces)
+
+def getInventoryDigest(interfaces,ports,portInfo=None):
+    # stable digest of the inventory, so the server can tell whether anything changed
+    inventory = {'interfaces': interfaces, 'ports': sorted(ports)}
+    if portInfo is not None:
+        inventory['port_info'] = portInfo
+    inventory = json.dumps(inventory,sort_keys=True,separators=(',',':'))
+    return hashlib.sha1(inventory.encode('utf-8')).hexdigest()
+
 def getHostname():
     return socket.gethostname()
     
+@functools.lru_cache(maxsize=None)
 def getSerial():
-    # Extract serial from cpuinfo file
+    # Extract serial from cpuinfo file; it cannot change while we run, so it is read once
     cpuserial = "0000000000000000"
     try:
         f = open('/proc/cpuinfo','r')
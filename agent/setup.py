@@ -14,6 +14,6 @@ setuptools.setup(
     keywords = "RaspberryPi Terminal Server Console",
     url = "http://nanog.org",
     packages=pkgs,
-    install_requires = ['daemonize','pyroute2','ipaddress','netifaces'],
+    install_requires = ['daemonize','pyroute2','asyncssh','aiohttp'],
     long_description="See PiCon README",
 )
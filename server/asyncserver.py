@@ -0,0 +1,394 @@
+#! /usr/bin/env python3
+"""
+Asyncio API server for the PiCon registry.
+
+Serves /api/register, /api/register/batch, /api/devices and /metrics with
+the same Registry and DB logic as the Flask app in server.py, without a
+thread per connection.
+
+Worker model:
+    - One process runs one asyncio event loop, which accepts every agent
+      connection and parses requests.
+    - Heartbeats that change nothing are answered on the loop from the
+      in-memory HeartbeatBuffer and never touch SQLite.
+    - Everything else runs on a bounded thread pool with one thread per
+      pooled DB connection (--pool-size), so the number of threads does not
+      grow with the number of agents.
+    - For more CPU, run one process per core on the same port with
+      --reuse-port.  SQLite serializes writers across processes; WAL keeps
+      readers unblocked.  Each process keeps its own heartbeat buffer.
+
+Console access: /console/<dev_id>/<port> is a websocket relaying a device's
+serial console, through the port its agent forwards the console to on the
+tunnel server.  Viewers of the same console share one upstream connection
+(see console.py).  Binary messages carry console bytes in both directions;
+the first message from the server is a JSON text message saying whether the
+viewer may write (ask with ?write=1; one writer per console at a time).
+
+Console history: agents ship captured console output to
+POST /api/history/<sn>/<port>; GET on the same path reads a time range back
+and /api/history/search finds lines across every console (see history.py).
+Store operations run on the default executor, as they read and write files.
+
+The web UI (/, /devices, /device/<id>) is still served by server.py.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import aiohttp
+import time
+from aiohttp import web
+from console import ConsoleBroker, CONSOLE_HOST, VIEWER_BUFFER
+from db import DB, DBPool, QueryProfile, DBFILE, POOL_SIZE
+from heartbeat import HeartbeatBuffer, FLUSH_INTERVAL
+from history import (HistoryStore, parse_limit, parse_time,
+                     parse_time_range, RETENTION)
+from metrics import RegistryMetrics
+from registry import Registry, MAX_BODY_SIZE, PAGE_SIZE, PAGE_SIZE_MAX
+
+
+class AsyncDB:
+    """
+    Async-safe access layer over a DBPool.  Calls run on a thread pool with
+    one worker per pooled connection; each call borrows a connection for its
+    duration, so a connection is never shared between threads.
+
+    Attributes:
+        pool:       DBPool the connections are borrowed from
+        slow_ms:    Slow statement threshold for profiled calls
+    """
+    def __init__(self, pool, workers=POOL_SIZE, slow_ms=50):
+        self.pool = pool
+        self.slow_ms = slow_ms
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='picon-db')
+
+    async def run(self, fn, *args, profile=None):
+        """
+        Run fn(db, *args) on the DB thread pool.
+        :param fn: callable taking a DB object as its first argument
+        :param profile: QueryProfile to record the call's statements into
+        :return: what fn returned
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn,
+                                          args, profile)
+
+    def _call(self, fn, args, profile):
+        db = self.pool.acquire()
+        if profile is not None:
+            db.start_profile(profile)
+        try:
+            return fn(db, *args)
+        finally:
+            if profile is not None:
+                db.stop_profile()
+                profile.finish(db, self.slow_ms)
+            self.pool.release(db)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = [t.strip() for t in header.split(',')]
+    return any(t.replace('W/', '', 1).strip('"') == etag for t in tags)
+
+
+async def read_json(request):
+    # aiohttp already undoes Content-Encoding: gzip on request bodies, and
+    # client_max_size bounds the decompressed size
+    try:
+        return await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="request body is not valid JSON")
+
+
+async def register(request):
+    registry = request.app['registry']
+    data = await read_json(request)
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest(text="expected a JSON object")
+    response = registry.refresh(data)
+    if response is None:
+        response = await request.app['db'].run(
+            registry.register, data, profile=request.get('sql_profile'))
+    return web.json_response(response)
+
+
+async def register_batch(request):
+    registry = request.app['registry']
+    try:
+        dev_list = registry.check_batch(await read_json(request))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    results = registry.refresh_batch(dev_list)
+    if None in results:
+        body = await request.app['db'].run(
+            registry.complete_batch, dev_list, results,
+            profile=request.get('sql_profile'))
+    else:
+        body = registry.complete_batch(None, dev_list, results)
+    return web.json_response(body)
+
+
+async def api_devices(request):
+    registry = request.app['registry']
+    try:
+        query = registry.parse_device_query(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    if_none_match = request.headers.get('If-None-Match')
+
+    def load(db):
+        etag = registry.device_etag(db, query)
+        if etag_matches(if_none_match, etag):
+            return etag, None, None
+        return (etag, ) + registry.list_devices(db, query)
+
+    etag, devices, next_after = await request.app['db'].run(
+        load, profile=request.get('sql_profile'))
+    headers = {'ETag': '"%s"' % etag}
+    if devices is None:
+        return web.Response(status=304, headers=headers)
+    if next_after is not None:
+        headers['Link'] = '<%s>; rel="next"' % request.rel_url.update_query(
+            {'after': next_after})
+    return web.json_response(devices, headers=headers)
+
+
+async def console(request):
+    dev_id = int(request.match_info['dev_id'])
+    port_name = request.match_info['port']
+    devices = await request.app['db'].run(
+        lambda db: db.get_device_details(dev_id=dev_id))
+    if not devices or port_name not in devices[0]['console_ports']:
+        raise web.HTTPNotFound(text="no forwarded console %s on device %d" % (
+            port_name, dev_id))
+    try:
+        viewer = await request.app['consoles'].attach(
+            devices[0]['console_ports'][port_name],
+            write=request.query.get('write') in ('1', 'true'))
+    except OSError as e:
+        raise web.HTTPBadGateway(text="console is not reachable: %s" % e)
+    ws = web.WebSocketResponse(heartbeat=30)
+    try:
+        await ws.prepare(request)
+        await ws.send_json({'console': port_name, 'write': viewer.writer})
+        relay = asyncio.ensure_future(relay_console(viewer, ws))
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.BINARY and viewer.writer:
+                    await viewer.send(msg.data)
+                elif msg.type == aiohttp.WSMsgType.TEXT and viewer.writer:
+                    await viewer.send(msg.data.encode('utf-8'))
+        finally:
+            relay.cancel()
+    finally:
+        viewer.detach()
+    return ws
+
+
+async def relay_console(viewer, ws):
+    # console output to one viewer; a viewer that fell behind is told why
+    while True:
+        data = await viewer.read()
+        if data is None:
+            break
+        await ws.send_bytes(data)
+    await ws.close(code=4000 if viewer.lagged else 1000,
+                   message=b'fell behind' if viewer.lagged else b'')
+
+
+async def upload_history(request):
+    try:
+        start = parse_time(request.query['start'])
+        end = parse_time(request.query['end'])
+    except (KeyError, ValueError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    data = await request.read()
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, request.app['history'].append, request.match_info['sn'],
+            request.match_info['port'], start, end, data)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response({"status": "ok"})
+
+
+async def read_history(request):
+    try:
+        start, end = parse_time_range(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    body = await asyncio.get_running_loop().run_in_executor(
+        None, request.app['history'].read, request.match_info['sn'],
+        request.match_info['port'], start, end)
+    return web.Response(body=body, content_type='text/plain')
+
+
+async def search_history(request):
+    q = request.query.get('q')
+    if not q:
+        raise web.HTTPBadRequest(text="q is required")
+    try:
+        start, end = parse_time_range(request.query)
+        limit = parse_limit(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    found = await asyncio.get_running_loop().run_in_executor(
+        None, request.app['history'].search, q.encode('utf-8'), start, end,
+        limit)
+    return web.json_response([{'sn': sn, 'port': port,
+                               'line': line.decode('utf-8', 'replace')}
+                              for sn, port, line in found])
+
+
+async def metrics_endpoint(request):
+    metrics = request.app['metrics']
+    body = await request.app['db'].run(metrics.render)
+    return web.Response(body=body.encode('utf-8'), headers={
+        'Content-Type': metrics.content_type})
+
+
+@web.middleware
+async def observe_requests(request, handler):
+    start = time.perf_counter()
+    status = 500
+    profile = None
+    if request.app['profile_sql']:
+        profile = request['sql_profile'] = QueryProfile()
+    try:
+        response = await handler(request)
+        status = response.status
+        if profile is not None:
+            response.headers['X-DB-Queries'] = str(profile.count)
+            response.headers['X-DB-Time-Ms'] = '%.3f' % (profile.seconds *
+                                                         1000)
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        request.app['metrics'].observe_request(route, request.method, status,
+                                               time.perf_counter() - start)
+
+
+def create_app(dbfile=DBFILE, pool_size=POOL_SIZE,
+               flush_interval=FLUSH_INTERVAL, page_size=PAGE_SIZE,
+               page_size_max=PAGE_SIZE_MAX, profile_sql=False, slow_ms=50,
+               console_host=CONSOLE_HOST, viewer_buffer=VIEWER_BUFFER,
+               history_dir='./history', history_retention=RETENTION):
+    """
+    Build the API application.  The schema is validated here, before the
+    server starts accepting connections.
+    :return: aiohttp.web.Application
+    """
+    metrics = RegistryMetrics()
+    DB.observer = metrics.observe_db
+    pool = DBPool(dbfile, pool_size)
+    heartbeats = HeartbeatBuffer(pool, flush_interval)
+    app = web.Application(middlewares=[observe_requests],
+                          client_max_size=MAX_BODY_SIZE)
+    app['db'] = AsyncDB(pool, pool_size, slow_ms)
+    app['profile_sql'] = profile_sql
+    app['metrics'] = metrics
+    app['registry'] = Registry(heartbeats, page_size, page_size_max, metrics)
+    app['consoles'] = ConsoleBroker(console_host, viewer_buffer)
+    app['history'] = HistoryStore(history_dir, retention=history_retention)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_post('/api/register', register)
+    app.router.add_post('/api/register/batch', register_batch)
+    app.router.add_get('/api/devices', api_devices)
+    app.router.add_get(r'/console/{dev_id:\d+}/{port}', console)
+    app.router.add_get('/api/history/search', search_history)
+    app.router.add_post('/api/history/{sn}/{port}', upload_history)
+    app.router.add_get('/api/history/{sn}/{port}', read_history)
+
+    async def start(app):
+        heartbeats.start()
+
+    async def stop(app):
+        app['consoles'].close()
+        # writes out buffered heartbeats before the pool goes away
+        await asyncio.get_running_loop().run_in_executor(None,
+                                                         heartbeats.stop)
+        app['db'].close()
+        pool.close()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the PiCon registry API on an asyncio event loop')
+    parser.add_argument('--host', type=str, default='::',
+                        help='Address to listen on [default: ::]')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Port to listen on [default: 5000]')
+    parser.add_argument('--dbfile', type=str, default=DBFILE,
+                        help='SQLite database file [default: %s]' % DBFILE)
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='DB connections and DB worker threads '
+                             '[default: %d]' % POOL_SIZE)
+    parser.add_argument('--flush-interval', type=float,
+                        default=FLUSH_INTERVAL,
+                        help='Seconds between heartbeat buffer flushes '
+                             '[default: %d]' % FLUSH_INTERVAL)
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help='Listen backlog [default: 1024]')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='Allow several server processes to share the '
+                             'port (SO_REUSEPORT)')
+    parser.add_argument('--access-log', action='store_true',
+                        help='Log every request [default: off]')
+    parser.add_argument('--profile-sql', action='store_true',
+                        help='Profile the SQL run by each request, adding '
+                             'X-DB-Queries and X-DB-Time-Ms headers')
+    parser.add_argument('--slow-ms', type=float, default=50,
+                        help='Log statements slower than this, with query '
+                             'plans, when profiling [default: 50]')
+    parser.add_argument('--console-host', type=str, default=CONSOLE_HOST,
+                        help='Host the agents\' console forwards listen on, '
+                             'i.e. the tunnel server [default: %s]' %
+                             CONSOLE_HOST)
+    parser.add_argument('--viewer-buffer', type=int, default=VIEWER_BUFFER,
+                        help='Bytes of console output buffered per viewer '
+                             'before a slow viewer is disconnected '
+                             '[default: %d]' % VIEWER_BUFFER)
+    parser.add_argument('--history-dir', type=str, default='./history',
+                        help='Directory console history is stored in '
+                             '[default: ./history]')
+    parser.add_argument('--history-retention', type=int, default=RETENTION,
+                        help='Seconds console history is kept '
+                             '[default: %d]' % RETENTION)
+    parser.add_argument('-v', dest='verbose', action='store_true',
+                        help='Log at INFO level')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    app = create_app(args.dbfile, args.pool_size, args.flush_interval,
+                     profile_sql=args.profile_sql, slow_ms=args.slow_ms,
+                     console_host=args.console_host,
+                     viewer_buffer=args.viewer_buffer,
+                     history_dir=args.history_dir,
+                     history_retention=args.history_retention)
+    web.run_app(app, host=args.host, port=args.port, backlog=args.backlog,
+                reuse_port=args.reuse_port,
+                access_log=logging.getLogger('aiohttp.access')
+                if args.access_log else None)
+
+
+if __name__ == "__main__":
+    main()
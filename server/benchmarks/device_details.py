@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+"""
+Benchmark for DB.get_device_details().
+
+Seeds a temporary database with a synthetic fleet and reports the number of
+SQL statements and the wall time needed to load the full device list, for
+increasing fleet sizes.  Both should stay flat (statements) or grow linearly
+with the amount of data returned (time), never with one round trip per device.
+
+Usage: python3 server/benchmarks/device_details.py [--sizes 100,1000,10000]
+"""
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from db import DB
+
+
+def seed_devices(db, count, ifaces=3, ports=2):
+    """
+    Insert a synthetic fleet directly into the database.
+    :param db: DB object to seed
+    :param count: number of devices to create
+    :param ifaces: interfaces per device, each with one IPv4 address
+    :param ports: serial ports per device
+    :return: None
+    """
+    now = datetime.datetime.utcnow()
+    c = db._conn.cursor()
+    c.executemany("""
+        insert into devices (dev_id, hostname, sn, first_seen, last_updated,
+                             holdtime, expires)
+        values (?, ?, ?, ?, ?, ?, ?);""",
+        [(i, 'picon-%05d' % i, 'sn%014d' % i, now, now, 300,
+          now + datetime.timedelta(seconds=300))
+         for i in range(1, count + 1)])
+    c.executemany("""
+        insert into interfaces (dev_id, int_name, state, addr, ip_version)
+        values (?, ?, ?, ?, ?);""",
+        [(i, 'eth%d' % n, 1, '10.%d.%d.%d' % (n, i // 256 % 256, i % 256), 4)
+         for i in range(1, count + 1) for n in range(ifaces)])
+    c.executemany("insert into serialports (dev_id, port_name) values (?, ?);",
+                  [(i, 'ttyUSB%d' % n)
+                   for i in range(1, count + 1) for n in range(ports)])
+    db._conn.commit()
+
+
+def run(size, rounds):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DB(os.path.join(tmp, 'bench.db'))
+        seed_devices(db, size)
+        statements = []
+        db._conn.set_trace_callback(statements.append)
+        timings = []
+        for _ in range(rounds):
+            del statements[:]
+            start = time.perf_counter()
+            devices = db.get_device_details()
+            timings.append(time.perf_counter() - start)
+        db._conn.set_trace_callback(None)
+        db.close()
+    assert len(devices) == size
+    timings.sort()
+    return len(statements), timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark DB.get_device_details() against a seeded fleet')
+    parser.add_argument('--sizes', type=str, default='100,1000,10000',
+                        help='Comma separated fleet sizes [default: '
+                             '100,1000,10000]')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Timed rounds per fleet size [default: 5]')
+    args = parser.parse_args()
+
+    print("%8s %10s %12s %14s" % ('devices', 'queries', 'median ms',
+                                  'us/device'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        queries, median = run(size, args.rounds)
+        print("%8d %10d %12.1f %14.2f" % (size, queries, median * 1000,
+                                          median * 1e6 / size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#! /usr/bin/env python3
+"""
+Fleet-scale load generator and benchmark for the PiCon registry.
+
+Simulates N agents registering with the Flask app the way
+PiConAgent.register() does: a full inventory on first contact, then
+digest-only heartbeats, with a fraction of agents changing their inventory
+every round.  Between heartbeat rounds it polls /api/devices and renders
+/devices.  Every fleet size runs in a fresh process against a temporary
+database.
+
+Reports p50/p95/p99 latency per endpoint and the database file size after
+the initial registration and after all rounds.
+
+Usage: python3 server/benchmarks/fleet.py [--sizes 100,1000,10000,50000]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ENDPOINTS = ('/api/register', '/api/devices', '/devices')
+
+
+class SimulatedAgent:
+    """
+    Builds registration bodies like PiConAgent.register() for one synthetic
+    device.
+    """
+    def __init__(self, n, holdtime):
+        self.n = n
+        self.holdtime = holdtime
+        self.generation = 0
+        self.acknowledged = None
+
+    def inventory(self):
+        interfaces = {
+            'eth0': {'state': True,
+                     'addrs': ['10.%d.%d.%d' % (self.n // 65536 % 256,
+                                                self.n // 256 % 256,
+                                                self.n % 256)]},
+            'wlan0': {'state': self.generation % 2 == 0,
+                      'addrs': ['2001:db8::%x:%x' % (self.n, self.generation)]}
+        }
+        ports = ['ttyUSB%d' % p for p in range(2)]
+        return interfaces, ports
+
+    def body(self, full=False):
+        interfaces, ports = self.inventory()
+        inventory = json.dumps({'interfaces': interfaces, 'ports': ports},
+                               sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha1(inventory.encode('utf-8')).hexdigest()
+        body = {
+            'hostname': 'picon-%06d' % self.n,
+            'sn': '%016x' % self.n,
+            'holdtime': self.holdtime,
+            'inventory_digest': digest
+        }
+        if full or digest != self.acknowledged:
+            body['interfaces'] = interfaces
+            body['ports'] = ports
+        return body
+
+
+def percentile(samples, p):
+    if not samples:
+        return float('nan')
+    return samples[max(0, int(math.ceil(p / 100.0 * len(samples))) - 1)]
+
+
+def dbsize(path):
+    return sum(os.path.getsize(f) for f in (path, path + '-wal')
+               if os.path.exists(f))
+
+
+def run_fleet(size, args):
+    """
+    Runs the benchmark for one fleet size.  Meant to be called in a fresh
+    process, since the Flask app keeps its pool in module state.
+    :return: dict() of latency samples per endpoint and database sizes
+    """
+    sys.path.insert(0, SERVER_DIR)
+    import server
+
+    tmpdir = tempfile.mkdtemp(prefix='picon-bench-')
+    dbfile = os.path.join(tmpdir, 'bench.db')
+    server.app.config['DBFILE'] = dbfile
+    server.app.config['HEARTBEAT_FLUSH_INTERVAL'] = args.flush_interval
+    local = threading.local()
+    samples = dict((e, list()) for e in ENDPOINTS)
+    lock = threading.Lock()
+
+    def request(method, url, body=None):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = server.app.test_client()
+        start = time.perf_counter()
+        if method == 'POST':
+            r = client.post(url, data=json.dumps(body),
+                            content_type='application/json')
+        else:
+            r = client.get(url)
+        elapsed = time.perf_counter() - start
+        if r.status_code != 200:
+            raise Exception("%s %s returned %d" % (method, url,
+                                                   r.status_code))
+        with lock:
+            samples[url.split('?')[0]].append(elapsed)
+        return r
+
+    def register(agent):
+        body = agent.body()
+        rjson = json.loads(request('POST', '/api/register', body).data)
+        if rjson.get('send_inventory'):
+            rjson = json.loads(request('POST', '/api/register',
+                                       agent.body(full=True)).data)
+        if not rjson.get('send_inventory'):
+            agent.acknowledged = body['inventory_digest']
+
+    def heartbeat_round(agents):
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            start = time.perf_counter()
+            futures = list()
+            for i, agent in enumerate(agents):
+                if args.rate:
+                    delay = start + i / args.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(pool.submit(register, agent))
+            for f in futures:
+                f.result()
+
+    agents = [SimulatedAgent(n, args.holdtime) for n in range(size)]
+    heartbeat_round(agents)
+    initial_size = dbsize(dbfile)
+    for k in ENDPOINTS:
+        del samples[k][:]
+    for _ in range(args.rounds):
+        for agent in agents[:int(size * args.changed)]:
+            agent.generation += 1
+        heartbeat_round(agents)
+        for _ in range(args.views):
+            url = '/api/devices?limit=%d' % args.page_size
+            while url:
+                r = request('GET', url)
+                link = r.headers.get('Link')
+                url = link[link.index('<') + 1:link.index('>')] if link \
+                    else None
+            request('GET', '/devices')
+    server.get_heartbeats().stop()
+    result = {
+        'samples': dict((k, sorted(v)) for k, v in samples.items()),
+        'initial_size': initial_size,
+        'final_size': dbsize(dbfile)
+    }
+    server.get_pool().close()
+    for f in os.listdir(tmpdir):
+        os.unlink(os.path.join(tmpdir, f))
+    os.rmdir(tmpdir)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a fleet of PiCon agents against the registry')
+    parser.add_argument('--sizes', type=str, default='100,1000,10000,50000',
+                        help='Comma separated fleet sizes [default: '
+                             '100,1000,10000,50000]')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Heartbeat rounds after the initial '
+                             'registration [default: 3]')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Registrations per second, 0 for as fast as '
+                             'possible [default: 0]')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Concurrent simulated agents [default: 4]')
+    parser.add_argument('--changed', type=float, default=0.01,
+                        help='Fraction of agents changing inventory each '
+                             'round [default: 0.01]')
+    parser.add_argument('--views', type=int, default=2,
+                        help='Device list and page views per round '
+                             '[default: 2]')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='/api/devices page size [default: 1000]')
+    parser.add_argument('--holdtime', type=int, default=300,
+                        help='Agent holdtime [default: 300]')
+    parser.add_argument('--flush-interval', type=float, default=1,
+                        help='Heartbeat buffer flush interval [default: 1]')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    print("%8s %-14s %8s %9s %9s %9s" % ('devices', 'endpoint', 'requests',
+                                         'p50 ms', 'p95 ms', 'p99 ms'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_fleet, (size, args))
+        for endpoint in ENDPOINTS:
+            s = result['samples'][endpoint]
+            print("%8d %-14s %8d %9.2f %9.2f %9.2f" % (
+                size, endpoint, len(s), percentile(s, 50) * 1000,
+                percentile(s, 95) * 1000, percentile(s, 99) * 1000))
+        print("%8d %-14s %.1f MB after registration, %.1f MB after %d "
+              "rounds" % (size, 'db size', result['initial_size'] / 1e6,
+                          result['final_size'] / 1e6, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
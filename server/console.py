@@ -0,0 +1,262 @@
+"""
+Console broker: relays the byte stream of a device's serial console, as
+forwarded by its agent to a port on the tunnel server, to any number of
+viewers.
+
+Each console has at most one upstream TCP connection, however many viewers
+are attached.  Output is fanned out to every viewer; input is only accepted
+from the one viewer holding the console for writing.  Every viewer has a
+bounded buffer: a viewer that falls further behind than that is detached,
+so one slow client can neither stall the console for the others nor grow
+memory without limit.
+"""
+import asyncio
+import collections
+import logging
+
+
+# host the agents' console forwards listen on, i.e. the tunnel server
+CONSOLE_HOST = 'localhost'
+# bytes of console output buffered per viewer before it is detached
+VIEWER_BUFFER = 1024 * 1024
+READ_SIZE = 4096
+
+
+class Viewer:
+    """
+    One client attached to a console session.
+
+    Attributes:
+        session:    ConsoleSession the viewer is attached to
+        writer:     True if this viewer holds the console for writing
+        lagged:     True once the viewer was detached for falling behind
+    """
+    def __init__(self, session, limit, writer=False):
+        self.session = session
+        self.limit = limit
+        self.writer = writer
+        self.lagged = False
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._closed = False
+        self._ready = asyncio.Event()
+
+    def offer(self, chunk):
+        """
+        Queues console output for the viewer.
+        :param chunk: bytes read from the console
+        :return: False if the viewer's buffer is full
+        """
+        if self._buffered + len(chunk) > self.limit:
+            return False
+        self._chunks.append(chunk)
+        self._buffered += len(chunk)
+        self._ready.set()
+        return True
+
+    def close(self, lagged=False):
+        """
+        Ends the viewer's stream once what is already queued has been read;
+        a lagged viewer loses its queue straight away.
+        :param lagged: True if the viewer is detached for falling behind
+        :return: None
+        """
+        self._closed = True
+        self.lagged = lagged
+        if lagged:
+            self._chunks.clear()
+            self._buffered = 0
+        self._ready.set()
+
+    async def read(self):
+        """
+        Waits for console output.  Everything queued is returned at once,
+        so a viewer that is briefly behind catches up in one message.
+        :return: bytes, or None once the stream has ended
+        """
+        while not self._chunks:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self._buffered = 0
+        return data
+
+    async def send(self, data):
+        """
+        Sends input to the console.
+        :param data: bytes to write
+        :return: None
+        """
+        await self.session.send(self, data)
+
+    def detach(self):
+        """
+        Leaves the session.
+        :return: None
+        """
+        self.session.detach(self)
+
+
+class ConsoleSession:
+    """
+    One upstream console connection and the viewers attached to it.
+
+    Attributes:
+        port:       port the console is forwarded to
+        viewers:    attached Viewer objects
+        owner:      Viewer holding the console for writing, if any
+    """
+    def __init__(self, broker, port, reader, writer):
+        self.broker = broker
+        self.port = port
+        self.viewers = set()
+        self.owner = None
+        self.closed = False
+        self._reader = reader
+        self._writer = writer
+        self._pump = asyncio.ensure_future(self._run())
+
+    def attach(self, write=False):
+        """
+        Adds a viewer.  The first viewer asking to write gets the console;
+        later ones are attached read-only until it leaves.
+        :param write: True to ask for write access
+        :return: Viewer
+        """
+        viewer = Viewer(self, self.broker.viewer_buffer,
+                        write and self.owner is None)
+        if viewer.writer:
+            self.owner = viewer
+        self.viewers.add(viewer)
+        return viewer
+
+    def detach(self, viewer, lagged=False):
+        """
+        Removes a viewer, closing the upstream connection with the last one.
+        :param viewer: Viewer to remove
+        :param lagged: True if the viewer is detached for falling behind
+        :return: None
+        """
+        if viewer not in self.viewers:
+            return
+        self.viewers.discard(viewer)
+        viewer.close(lagged)
+        if viewer is self.owner:
+            self.owner = None
+        if not self.viewers:
+            self.close()
+
+    async def send(self, viewer, data):
+        """
+        Writes input from a viewer to the console.
+        :param viewer: Viewer sending the input
+        :param data: bytes to write
+        :return: None
+        """
+        if viewer is not self.owner:
+            raise PermissionError("console is attached read-only")
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                chunk = await self._reader.read(READ_SIZE)
+                if not chunk:
+                    break
+                for viewer in list(self.viewers):
+                    if not viewer.offer(chunk):
+                        logging.warning("Detaching a console viewer of port "
+                                        "%d that fell behind", self.port)
+                        self.detach(viewer, lagged=True)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            logging.warning("Console on port %d failed: %s", self.port, e)
+        finally:
+            for viewer in list(self.viewers):
+                viewer.close()
+            self.viewers.clear()
+            self.owner = None
+            self.close()
+
+    def close(self):
+        """
+        Closes the upstream connection.
+        :return: None
+        """
+        self.closed = True
+        self.broker.forget(self)
+        self._writer.close()
+        if self._pump is not asyncio.current_task():
+            self._pump.cancel()
+
+
+class ConsoleBroker:
+    """
+    Shares console connections between viewers.
+
+    Attributes:
+        host:           host the console forwards listen on
+        viewer_buffer:  bytes buffered per viewer before it is detached
+    """
+    def __init__(self, host=CONSOLE_HOST, viewer_buffer=VIEWER_BUFFER):
+        self.host = host
+        self.viewer_buffer = viewer_buffer
+        self._sessions = dict()
+        self._connecting = dict()
+        # port -> viewers waiting for its connection to be set up
+        self._waiting = collections.Counter()
+
+    async def attach(self, port, write=False):
+        """
+        Attaches a viewer to the console forwarded to port, connecting to it
+        unless another viewer already has.
+        :param port: port the console is forwarded to
+        :param write: True to ask for write access
+        :return: Viewer
+        """
+        session = self._sessions.get(port)
+        if session is None:
+            # viewers arriving while the connection is being set up share it
+            connecting = self._connecting.get(port)
+            if connecting is None:
+                connecting = asyncio.ensure_future(self._connect(port))
+                self._connecting[port] = connecting
+            self._waiting[port] += 1
+            try:
+                session = await asyncio.shield(connecting)
+            finally:
+                self._waiting[port] -= 1
+                if not self._waiting[port]:
+                    del self._waiting[port]
+        if session.closed:
+            # the console hung up before the viewer could be attached
+            raise ConnectionResetError("console on port %d closed the "
+                                       "connection" % port)
+        return session.attach(write)
+
+    async def _connect(self, port):
+        try:
+            reader, writer = await asyncio.open_connection(self.host, port)
+        finally:
+            del self._connecting[port]
+        session = ConsoleSession(self, port, reader, writer)
+        self._sessions[port] = session
+        if not self._waiting[port]:
+            # every viewer waiting for the connection gave up meanwhile
+            session.close()
+        return session
+
+    def forget(self, session):
+        if self._sessions.get(session.port) is session:
+            del self._sessions[session.port]
+
+    def close(self):
+        """
+        Closes every console connection.
+        :return: None
+        """
+        for session in list(self._sessions.values()):
+            session.close()
@@ -1,14 +1,162 @@
 import os
 import sqlite3
+import contextlib
+import functools
+import logging
+import queue
+import time
 import datetime
 import ipaddress
+import json
 import sys
 
 
 LISTENER_PORT_BASE = 10000
+LISTENER_PORT_MAX = 19999
+# seconds past its holdtime before a dead device's tunnel port is reclaimed
+TUNNEL_RECLAIM_GRACE = 3600
 DBFILE = r'./server.db'
+POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 256
 TUNNEL_SERVER = '2620:0:ce0:101:a00:27ff:feb0:faef'
 
+# WAL lets readers (the web UI) proceed while a registration is being
+# written, and with WAL synchronous=NORMAL only fsyncs at checkpoints while
+# remaining crash-safe.
+SQLITE_PRAGMAS = [
+    "pragma journal_mode=WAL;",
+    "pragma synchronous=NORMAL;",
+    "pragma busy_timeout=5000;",
+    "pragma foreign_keys=ON;",
+]
+
+
+class QueryProfile:
+    """
+    Statements executed on a DB connection while profiling is enabled.
+
+    Attributes:
+        queries:    list of dicts with the statement text ('sql'), the number
+                    of bound parameters ('params'), the number of parameter
+                    sets for executemany ('batch'), rows returned or changed
+                    ('rows'), wall time including fetches ('seconds') and,
+                    once explained, the query plan ('plan')
+    """
+    def __init__(self):
+        self.queries = list()
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def seconds(self):
+        return sum(q['seconds'] for q in self.queries)
+
+    def worst(self, n):
+        return sorted(self.queries, key=lambda q: q['seconds'],
+                      reverse=True)[:n]
+
+    def finish(self, db, slow_ms, explain_worst=3):
+        """
+        Logs statements slower than slow_ms and captures the query plan of
+        the worst of them.  Must be called before the connection is reused.
+        :param db: DB object the statements ran on
+        :param slow_ms: threshold in milliseconds
+        :param explain_worst: number of slow statements to explain
+        :return: None
+        """
+        slow = [q for q in self.worst(len(self.queries))
+                if q['seconds'] * 1000 >= slow_ms]
+        for i, q in enumerate(slow):
+            if i < explain_worst and q['sql'].lower().startswith(
+                    ('select', 'update', 'delete', 'insert', 'with')):
+                try:
+                    q['plan'] = db.explain(q['sql'], q.pop('args'))
+                except sqlite3.Error as e:
+                    q['plan'] = ['explain failed: %s' % e]
+            logging.warning("Slow query (%.1f ms, %d params, %d rows): %s%s",
+                            q['seconds'] * 1000, q['params'], q['rows'],
+                            q['sql'], ''.join('\n    ' + p
+                                              for p in q.get('plan', [])))
+        for q in self.queries:
+            q.pop('args', None)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor recording every statement into a QueryProfile.  Fetches are
+    charged to the statement that produced the rows.
+    """
+    profile = None
+
+    def _record(self, sql, args, batch, start):
+        self._query = {
+            'sql': ' '.join(sql.split()),
+            'params': len(args) if args else 0,
+            'batch': batch,
+            'rows': max(self.rowcount, 0),
+            'seconds': time.perf_counter() - start,
+            'args': args
+        }
+        self.profile.queries.append(self._query)
+
+    def _fetched(self, rows, start):
+        query = getattr(self, '_query', None)
+        if query is not None:
+            query['rows'] += rows
+            query['seconds'] += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        result = super(ProfilingCursor, self).execute(sql, parameters)
+        self._record(sql, parameters, 1, start)
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        result = super(ProfilingCursor, self).executemany(sql,
+                                                          seq_of_parameters)
+        self._record(sql, seq_of_parameters[0] if seq_of_parameters else (),
+                     len(seq_of_parameters), start)
+        return result
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super(ProfilingCursor, self).fetchone()
+        self._fetched(1 if row is not None else 0, start)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super(ProfilingCursor, self).fetchall()
+        self._fetched(len(rows), start)
+        return rows
+
+
+def observed(method):
+    """
+    Reports the wall time of a DB method to DB.observer, if one is set.
+    Nested calls to the same method (the optional cursor pattern) are only
+    reported once.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        observer = self.observer
+        if observer is None or name in self._observing:
+            return method(self, *args, **kwargs)
+        self._observing.add(name)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            observer(name, time.perf_counter() - start)
+            self._observing.discard(name)
+    return wrapper
+
 
 class DB:
     """
@@ -16,44 +164,178 @@ class DB:
 
     Attributes:
         dbfile:     Location of the database file
+        observer:   Optional callable(method_name, seconds), called after
+                    every DB method; set on the class to observe all
+                    connections
+        profile:    QueryProfile collecting statements, or None when
+                    profiling is off (see start_profile())
     """
-    def __init__(self):
+    observer = None
+
+    def __init__(self, dbfile=DBFILE, check_schema=True):
         self._conn = None
-        self.dbfile = DBFILE
+        self.profile = None
+        self._observing = set()
+        self.dbfile = dbfile
         self.listener_port_base = LISTENER_PORT_BASE
-        self.initialize()
+        self.listener_port_max = LISTENER_PORT_MAX
+        self.reclaim_grace = TUNNEL_RECLAIM_GRACE
+        self.initialize(check_schema)
 
-    def initialize(self):
+    def initialize(self, check_schema=True):
         """
         Initialize the database connection.  If the database file does not
         exist, create it and initialize the schema.
+        :param check_schema: False to skip schema validation, for connections
+            opened against a file that has already been validated
         :return: None
         """
         dbfile_exists = os.path.isfile(self.dbfile)
-        self._conn = sqlite3.connect(self.dbfile)
+        # Connections are handed between threads by DBPool, which guarantees
+        # only one thread uses a connection at a time.
+        self._conn = sqlite3.connect(self.dbfile, check_same_thread=False,
+                                     cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in SQLITE_PRAGMAS:
+            self._conn.execute(pragma)
+        if not check_schema:
+            return
         if dbfile_exists:
             if not self.is_schema_installed():
                 raise Exception("server.db does not have schema configured")
+        self.upgrade_schema()
+
+    def cursor(self):
+        """
+        Returns a cursor on this connection, recording statements when
+        profiling is enabled.
+        :return: sqlite3.Cursor
+        """
+        if self.profile is None:
+            return self._conn.cursor()
+        c = self._conn.cursor(ProfilingCursor)
+        c.profile = self.profile
+        return c
+
+    def start_profile(self, profile=None):
+        """
+        Start recording the statements run on this connection.
+        :param profile: QueryProfile to append to, or None for a new one
+        :return: the QueryProfile
+        """
+        self.profile = profile if profile is not None else QueryProfile()
+        return self.profile
+
+    def stop_profile(self):
+        """
+        Stop recording statements.
+        :return: the QueryProfile that was being recorded, or None
+        """
+        profile, self.profile = self.profile, None
+        return profile
+
+    def explain(self, sql, parameters=()):
+        """
+        Returns the query plan of a statement.
+        :param sql: statement text
+        :param parameters: parameters the statement ran with
+        :return: list of plan lines
+        """
+        c = self._conn.cursor()
+        c.execute("explain query plan " + sql, parameters or ())
+        return [r[-1] for r in c.fetchall()]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run a block of statements as one atomic transaction.  The write lock
+        is taken up front so concurrent registrations serialize instead of
+        deadlocking on lock upgrade.  Commits when the block completes and
+        rolls back if it raises.
+        :return: cursor to execute the statements with
+        """
+        c = self.cursor()
+        c.execute("begin immediate;")
+        try:
+            yield c
+        except BaseException:
+            self._conn.rollback()
+            raise
         else:
-            self.create_schema()
+            self._conn.commit()
 
     def is_schema_installed(self):
         """
         Returns true if tables are found in the database file, false if not.
         :return: None
         """
-        c = self._conn.cursor()
+        c = self.cursor()
         c.execute("""
             select name from sqlite_master where type='table';
         """)
         return len(c.fetchall()) > 0
 
-    def create_schema(self):
+    def get_schema_version(self, c=None):
+        """
+        Returns the version of the schema installed in the database file.
+        Databases created before schema versioning report version 1.
+        :param c: cursor of an open transaction, if any
+        :return: schema version, 0 for a blank database
         """
-        Creates database schema in a blank database.
+        if c is None:
+            c = self.cursor()
+        c.execute("""
+            select name from sqlite_master
+            where type='table' and name in ('schema_version', 'devices');
+        """)
+        tables = [r[0] for r in c.fetchall()]
+        if 'schema_version' in tables:
+            c.execute("select max(version) from schema_version;")
+            return c.fetchone()[0] or 0
+        if 'devices' in tables:
+            return 1
+        return 0
+
+    @observed
+    def upgrade_schema(self):
+        """
+        Applies the migrations in MIGRATIONS the database has not seen yet,
+        in order and in one transaction, recording each in schema_version.
+        Then lines the tunnel port free list up with the configured range.
+        :return: None
+        """
+        with self.transaction() as c:
+            version = self.get_schema_version(c)
+            if version > len(self.MIGRATIONS):
+                raise Exception("Database schema version %d is newer than "
+                                "this server supports (%d)" % (
+                                    version, len(self.MIGRATIONS)))
+            c.execute("""
+                create table if not exists schema_version (
+                    version integer primary key,
+                    description text,
+                    applied datetime);
+            """)
+            now = datetime.datetime.utcnow()
+            if version == 1:
+                c.execute("""
+                    insert or ignore into schema_version
+                    values (1, 'schema created before versioning', ?);
+                """, [now])
+            for number in range(version + 1, len(self.MIGRATIONS) + 1):
+                description, migration = self.MIGRATIONS[number - 1]
+                logging.info("Migrating database schema to version %d: %s",
+                             number, description)
+                migration(self, c)
+                c.execute("insert into schema_version values (?, ?, ?);",
+                          [number, description, now])
+            self.sync_tunnelports(c)
+
+    def create_schema(self, c):
+        """
+        Schema version 1: creates the original tables in a blank database.
+        :param c: cursor of an open transaction
         :return: None
         """
-        c = self._conn.cursor()
         c.execute("""
             create table devices (
                 dev_id integer primary key,
@@ -73,103 +355,406 @@ class DB:
                 addr text,
                 ip_version integer);
         """)
-        self._conn.commit()
 
-    def update_device(self, dev_data):
+    def migrate_unique_sn(self, c):
+        """
+        Schema version 2: one device per serial number, which registration
+        upserts on.  Duplicates are dropped in favour of the device updated
+        last; rows without a serial number are left alone, as the unique
+        index allows any number of them.  Databases from before tunnel ports
+        also get the tunnelport column here.
+        """
+        if self.add_column(c, 'devices', 'tunnelport', 'int'):
+            c.execute("""
+                create unique index devices_tunnelport
+                on devices (tunnelport);
+            """)
+        c.execute("""
+            delete from devices where sn is not null and exists (
+                select 1 from devices newer
+                where newer.sn = devices.sn
+                and (coalesce(newer.last_updated, '') >
+                        coalesce(devices.last_updated, '')
+                    or (coalesce(newer.last_updated, '') =
+                            coalesce(devices.last_updated, '')
+                        and newer.dev_id > devices.dev_id)));
+        """)
+        c.execute("""
+            create unique index if not exists devices_sn on devices (sn);
+        """)
+
+    def migrate_inventory_digest(self, c):
+        """
+        Schema version 3: digest of the last inventory stored per device.
+        """
+        self.add_column(c, 'devices', 'inventory_digest', 'text')
+
+    def migrate_expires(self, c):
+        """
+        Schema version 4: liveness as an indexed expiry timestamp,
+        last_updated + holdtime.
+        """
+        self.add_column(c, 'devices', 'expires', 'datetime')
+        c.execute("""
+            update devices set expires=strftime('%Y-%m-%d %H:%M:%f',
+                last_updated, '+' || coalesce(holdtime, 0) || ' seconds')
+            where expires is null;
+        """)
+        c.execute("""
+            create index if not exists devices_expires on devices (expires);
+        """)
+
+    def migrate_free_tunnelports(self, c):
+        """
+        Schema version 5: free list of tunnel ports.  Every port in the
+        listener range is either in here or assigned to exactly one device.
+        """
+        c.execute("""
+            create table if not exists free_tunnelports (
+                port integer primary key);
+        """)
+
+    def migrate_fleet_version(self, c):
+        """
+        Schema version 6: change counter for the device list, used for
+        conditional GETs.
+        """
+        c.execute("""
+            create table if not exists fleet_version (
+                id integer primary key check (id = 1),
+                version integer not null);
+        """)
+        c.execute("""
+            insert or ignore into fleet_version (id, version) values (1, 0);
+        """)
+
+    def migrate_foreign_keys(self, c):
+        """
+        Schema version 7: interfaces and serial ports reference their device
+        and go away with it, and every hot lookup column is indexed.  SQLite
+        cannot add a foreign key to an existing table, so both tables are
+        rebuilt; rows of devices that no longer exist are dropped.
+        """
+        c.execute("""
+            create table interfaces_new (
+                dev_id integer not null
+                    references devices (dev_id) on delete cascade,
+                int_name text,
+                state integer,
+                addr text,
+                ip_version integer);
+        """)
+        c.execute("""
+            insert into interfaces_new
+            select dev_id, int_name, state, addr, ip_version from interfaces
+            where dev_id in (select dev_id from devices);
+        """)
+        c.execute("""
+            create table serialports_new (
+                dev_id integer not null
+                    references devices (dev_id) on delete cascade,
+                port_name text);
+        """)
+        c.execute("""
+            insert into serialports_new
+            select dev_id, port_name from serialports
+            where dev_id in (select dev_id from devices);
+        """)
+        for table in ('interfaces', 'serialports'):
+            c.execute("drop table %s;" % table)
+            c.execute("alter table %s_new rename to %s;" % (table, table))
+        c.execute("create index interfaces_dev_id on interfaces (dev_id);")
+        c.execute("create index interfaces_addr on interfaces (addr);")
+        c.execute("create index serialports_dev_id on serialports (dev_id);")
+        c.execute("""
+            create index serialports_port_name on serialports (port_name);
+        """)
+        c.execute("create index devices_hostname on devices (hostname);")
+
+    def migrate_tunnel_state(self, c):
+        """
+        Schema version 8: state of the device's SSH tunnel as last reported
+        by its agent.
+        """
+        self.add_column(c, 'devices', 'tunnel_up', 'integer')
+        self.add_column(c, 'devices', 'tunnel_up_since', 'datetime')
+        self.add_column(c, 'devices', 'tunnel_reconnects', 'integer')
+
+    def migrate_serialport_tunnelports(self, c):
+        """
+        Schema version 9: serial ports can hold a tunnel port of their own,
+        from the same free list as device tunnel ports.
+        """
+        self.add_column(c, 'serialports', 'tunnelport', 'int')
+        c.execute("""
+            create unique index if not exists serialports_tunnelport
+            on serialports (tunnelport);
+        """)
+
+    def migrate_serialport_probes(self, c):
+        """
+        Schema version 10: line speed and liveness of serial ports, as
+        detected by agents probing them.
+        """
+        self.add_column(c, 'serialports', 'speed', 'int')
+        self.add_column(c, 'serialports', 'live', 'integer')
+
+    def migrate_liveness_version(self, c):
+        """
+        Schema version 11: a change counter for liveness-only writes, kept
+        apart from the fleet change counter so that heartbeats do not change
+        device list ETags that do not show liveness.
+        """
+        self.add_column(c, 'fleet_version', 'liveness',
+                        'integer not null default 0')
+
+    # Ordered schema migrations: entry N upgrades the schema to version N+1.
+    # Never change a migration that has been released; append a new one.
+    MIGRATIONS = [
+        ('create tables', create_schema),
+        ('unique device serial numbers', migrate_unique_sn),
+        ('inventory digests', migrate_inventory_digest),
+        ('indexed liveness expiry', migrate_expires),
+        ('tunnel port free list', migrate_free_tunnelports),
+        ('fleet change counter', migrate_fleet_version),
+        ('foreign keys and lookup indexes', migrate_foreign_keys),
+        ('tunnel state', migrate_tunnel_state),
+        ('serial port tunnel ports', migrate_serialport_tunnelports),
+        ('serial port probes', migrate_serialport_probes),
+        ('liveness change counter', migrate_liveness_version),
+    ]
+
+    def sync_tunnelports(self, c):
+        """
+        Lines the tunnel port free list up with the configured listener
+        range: ports outside the range are dropped and ports inside it that
+        no device holds are added.
+        :param c: cursor of an open transaction
+        :return: None
+        """
+        c.execute("""
+            delete from free_tunnelports where port < ? or port > ?
+                or port in (select tunnelport from devices)
+                or port in (select tunnelport from serialports);
+        """, [self.listener_port_base, self.listener_port_max])
+        c.execute("""
+            insert or ignore into free_tunnelports (port)
+            with recursive
+                ports(port) as (
+                    select ?
+                    union all
+                    select port+1 from ports where port < ?)
+            select port from ports
+            where port not in (select tunnelport from devices
+                               where tunnelport is not null)
+                and port not in (select tunnelport from serialports
+                                 where tunnelport is not null);
+        """, [self.listener_port_base, self.listener_port_max])
+
+    @staticmethod
+    def add_column(c, table, column, decl):
+        """
+        Adds a column to a table unless it is already present.
+        :param c: cursor to execute with
+        :param table: name of the table
+        :param column: name of the new column
+        :param decl: column type and constraints
+        :return: True if the column was added
+        """
+        c.execute("pragma table_info(%s);" % table)
+        if column in [r[1] for r in c.fetchall()]:
+            return False
+        c.execute("alter table %s add column %s %s;" % (table, column, decl))
+        return True
+
+    @observed
+    def update_device(self, dev_data, c=None):
         """
         Takes registration data transmitted by the Picon device and stores it
-        in the database.
+        in the database.  The device row, its interfaces, its serial ports
+        and its tunnel port are written in a single transaction, so a
+        half-applied registration is never visible.
+
+        Devices may send an inventory_digest of their interfaces and ports.
+        When it matches the stored digest the interface and serial port rows
+        are left alone; when the device sent only the digest and it does not
+        match, the response asks for the full inventory with send_inventory.
+
+        Agents that run an SSH tunnel report its state as tunnel_state, a
+        dict() with up, up_since and reconnects, which is stored as sent.
+        Agents that set forward_ports also get a tunnel port for each serial
+        port, returned as tunnel['ports'].  Agents that probe their serial
+        ports send what they found as port_info, see update_serialports().
+        Console lines registered by a proxy agent set proxied; they are
+        reached through their terminal server, so they hold no tunnel port
+        and the response has no tunnel.
         :param dev_data: Data dictionary from the device, converted from JSON
             format
+        :param c: cursor of an open transaction, if any
         :return: Returns tunnel port info as assigned by assign_tunnelport()
         """
-        dev_id = self.get_devid_by_sn(dev_data['sn'])
-        c = self._conn.cursor()
+        if c is None:
+            with self.transaction() as c:
+                return self.update_device(dev_data, c)
         now = datetime.datetime.utcnow()
-        if dev_id is not None:
+        digest = dev_data.get('inventory_digest')
+        has_inventory = 'interfaces' in dev_data and 'ports' in dev_data
+        send_inventory = False
+        c.execute("""
+        insert into devices (
+            hostname
+            , sn
+            , first_seen
+            , last_updated
+            , holdtime
+            , expires
+        )
+        values (?, ?, ?, ?, ?, ?)
+        on conflict (sn) do update set
+            hostname=excluded.hostname
+            , last_updated=excluded.last_updated
+            , holdtime=excluded.holdtime
+            , expires=excluded.expires;
+        """, [dev_data['hostname'], dev_data['sn'], now, now,
+              dev_data['holdtime'],
+              now + datetime.timedelta(seconds=dev_data['holdtime'])])
+        c.execute("""
+            select dev_id, inventory_digest, first_seen=last_updated
+            from devices where sn=?;
+        """, [dev_data['sn']])
+        dev_id, stored_digest, new = c.fetchone()
+        if digest is None or digest != stored_digest:
+            if has_inventory:
+                self.update_interfaces(dev_id, dev_data['interfaces'], c)
+                self.update_serialports(dev_id, dev_data['ports'], c,
+                                        dev_data.get('port_info'))
+                c.execute("""
+                    update devices set inventory_digest=? where dev_id=?;
+                """, [digest, dev_id])
+            else:
+                send_inventory = True
+        tunnel_state = dev_data.get('tunnel_state')
+        if isinstance(tunnel_state, dict):
             c.execute("""
-            update devices set
-                hostname=?
-                , sn=?
-                , last_updated=?
-                , holdtime=?
-            where dev_id=?;
-            """, [dev_data['hostname'], dev_data['sn'], now,
-                  dev_data['holdtime'], dev_id])
-            self._conn.commit()
+                update devices set tunnel_up=?, tunnel_up_since=?,
+                    tunnel_reconnects=?
+                where dev_id=?;
+            """, [bool(tunnel_state.get('up')), tunnel_state.get('up_since'),
+                  int(tunnel_state.get('reconnects') or 0), dev_id])
+        resp = {"status": "ok"}
+        if dev_data.get('proxied'):
+            self.delete_listener_port_by_devid(dev_id, c)
         else:
-            c.execute("""
-            insert into devices (
-                hostname
-                , sn
-                , first_seen
-                , last_updated
-                , holdtime
-            )
-            values (?, ?, ?, ?, ?);
-            """, [dev_data['hostname'], dev_data['sn'], now, now,
-                  dev_data['holdtime']])
-            self._conn.commit()
-        dev_id = self.get_devid_by_sn(dev_data['sn'])
-        self.update_interfaces(dev_id, dev_data['interfaces'])
-        self.update_serialports(dev_id, dev_data['ports'])
-        tunnel = self.assign_tunnelport(dev_id)
-        resp = {
-            "status": "ok",
-            "tunnel": tunnel
-        }
+            tunnel = self.assign_tunnelport(dev_id, c)
+            if dev_data.get('forward_ports'):
+                tunnel['ports'] = self.assign_serialport_tunnelports(dev_id, c)
+            resp['tunnel'] = tunnel
+        self.bump_fleet_version(c)
+        if send_inventory:
+            resp['send_inventory'] = True
+        if new:
+            resp['new'] = True
         return resp
 
-    #def	allocate_tunnelport(dev_id, highport,lowport):
-    #    """
-    #    Assigns a new TCP tunnel port to the specified existing device.
-    #    :param dev_id: ID of target device
-    #    :return: None
-    #    """
-    #    c = self._conn.cursor()
-    #    now = datetime.datetime.utcnow()
-    #    if dev_id is not None:
-    #        c.execute("""
-    #            UPDATE devices set tunnelport=(
-    #                WITH RECURSIVE
-    #                cnt(tunnelport) AS (
-    #                SELECT 2220
-    #                UNION ALL
-    #            SELECT tunnelport+1 FROM cnt
-    #            LIMIT 200
-    #      ) SELECT tunnelport
-    #        FROM cnt
-    #        WHERE tunnelport
-    #        NOT IN (SELECT
-    #            tunnelport
-    #            FROM devices
-    #            WHERE tunnelport IS NOT NULL )
-    #            LIMIT 1 )
-    #            WHERE dev_id=6
-    #        """, [dev_data['hostname'], dev_data['sn'], now,
-    #              dev_data['holdtime'], dev_id])
-    #        self._conn.commit()
-    #    else:
-    #        c.execute("""
-    #        insert into devices (
-    #            hostname
-    #            , sn
-    #            , first_seen
-    #            , last_updated
-    #            , holdtime
-    #        )
-    #        values (?, ?, ?, ?, ?);
-    #        """, [dev_data['hostname'], dev_data['sn'], now, now,
-    #              dev_data['holdtime']])
-    #        self._conn.commit()
+    @observed
+    def update_devices(self, dev_list):
+        """
+        Registers many devices in a single transaction, for hosts that front
+        many consoles.  Each device is applied under its own savepoint, so a
+        bad record is rolled back and reported without affecting the others.
+        :param dev_list: list of registration data dictionaries
+        :return: list of responses in the same order, each carrying the
+            device's sn; failed devices get status 'error' and an error message
+        """
+        results = list()
+        with self.transaction() as c:
+            for dev_data in dev_list:
+                sn = dev_data.get('sn') if isinstance(dev_data, dict) else None
+                c.execute("savepoint device;")
+                try:
+                    resp = self.update_device(dev_data, c)
+                except Exception as e:
+                    c.execute("rollback to savepoint device;")
+                    resp = {
+                        "status": "error",
+                        "error": "%s: %s" % (type(e).__name__, e)
+                    }
+                c.execute("release savepoint device;")
+                resp['sn'] = sn
+                results.append(resp)
+        return results
+
+    @staticmethod
+    def bump_fleet_version(c):
+        """
+        Records that the device list changed.
+        :param c: cursor of an open transaction
+        :return: None
+        """
+        c.execute("update fleet_version set version=version+1 where id=1;")
 
+    @observed
+    def get_fleet_state(self):
+        """
+        Describes the current state of the device list cheaply: the change
+        counter, the liveness change counter, plus the next time a device's
+        status flips from alive to dead without any write happening.
+        :return: tuple of (version, liveness version, next expiry)
+        """
+        c = self.cursor()
+        c.execute("select version, liveness from fleet_version where id=1;")
+        version, liveness = c.fetchone()
+        c.execute("select min(expires) from devices where expires > ?;",
+                  [datetime.datetime.utcnow()])
+        return version, liveness, c.fetchone()[0]
+
+    @observed
+    def touch_devices(self, heartbeats, c=None):
+        """
+        Batch-updates last_updated for devices whose registration carried no
+        changes.  A timestamp never moves last_updated backwards.  Devices
+        that were deleted, or dead long enough for their tunnel ports to be
+        reclaimed, are not updated: the response cached for them is stale.
+        :param heartbeats: list of (sn, last_updated, holdtime) tuples
+        :param c: cursor of an open transaction, if any
+        :return: list of serial numbers that have to register again
+        """
+        if c is None:
+            with self.transaction() as c:
+                return self.touch_devices(heartbeats, c)
+        cutoff = (datetime.datetime.utcnow() -
+                  datetime.timedelta(seconds=self.reclaim_grace))
+        missed = list()
+        for sn, ts, holdtime in heartbeats:
+            c.execute("""
+            update devices set
+                last_updated=?
+                , holdtime=?
+                , expires=?
+            where sn=? and last_updated < ? and expires >= ?;
+            """, [ts, holdtime, ts + datetime.timedelta(seconds=holdtime), sn,
+                  ts, cutoff])
+            if c.rowcount == 0:
+                missed.append(sn)
+        c.execute("update fleet_version set liveness=liveness+1 where id=1;")
+        if not missed:
+            return []
+        # a newer registration already moved last_updated on; those are fine
+        c.execute("""
+            select sn from devices
+            where sn in (select value from json_each(?)) and expires >= ?;
+        """, [json.dumps(missed), cutoff])
+        current = set(r[0] for r in c.fetchall())
+        return [sn for sn in missed if sn not in current]
+
+    @observed
     def get_interface_details(self, dev_id):
         """
         Get interface details for a particular device.
         :param dev_id: dev_id of the device
         :return: dict() containing items keyed by interface name
         """
-        c = self._conn.cursor()
+        c = self.cursor()
         c.execute("""select int_name, state, addr, ip_version from
                   interfaces where dev_id=?""", [dev_id])
         results = c.fetchall()
@@ -183,54 +768,171 @@ class DB:
             if_list[r[0]]['addrs'].append(r[2])
         return if_list
 
+    @observed
     def get_serialport_details(self, dev_id):
         """
         Get available serial port details for a particular device.
         :param dev_id: dev_id of the device
         :return: list of serial port device names ("ttyUSB0, ttyUSB1")
         """
-        c = self._conn.cursor()
+        c = self.cursor()
         c.execute("select port_name from serialports where dev_id=?", [dev_id])
         results = c.fetchall()
         return [r[0] for r in results]
 
-    def get_device_details(self, dev_id=None):
+    @observed
+    def get_device_details(self, dev_id=None, status=None, after=None,
+                           limit=None, hostname=None, sn=None, port_name=None,
+                           addr=None):
         """
         Get all available details for a particular device, or from all devices
-        if a device id is not provided.
+        if a device id is not provided.  Devices, interfaces and serial ports
+        are each fetched with a single query and assembled in one pass, so the
+        number of queries does not grow with the number of devices.
         :param dev_id: ID of a particular device, or None to return all devices
+        :param status: 'alive' or 'dead' to only return devices in that state,
+            answered from the index on the expiry timestamp
+        :param after: only return devices with a dev_id greater than this,
+            used as a pagination cursor
+        :param limit: maximum number of devices to return
+        :param hostname: only return devices whose hostname starts with this
+        :param sn: only return the device with this serial number
+        :param port_name: only return devices with this serial port
+        :param addr: only return devices with this interface address
         :return: List of dicts() describing all devices
         """
+        c = self.cursor()
+        now = datetime.datetime.utcnow()
+        conditions, params = list(), list()
+        if dev_id is not None:
+            conditions.append('dev_id=?')
+            params.append(dev_id)
+        if status == 'alive':
+            conditions.append('expires > ?')
+            params.append(now)
+        elif status == 'dead':
+            conditions.append('expires <= ?')
+            params.append(now)
+        if after is not None:
+            conditions.append('dev_id > ?')
+            params.append(after)
+        if hostname:
+            # prefix match as a range, so an index on hostname can be used
+            conditions.append('hostname >= ? and hostname < ?')
+            params.extend([hostname,
+                           hostname[:-1] + chr(ord(hostname[-1]) + 1)])
+        if sn is not None:
+            conditions.append('sn=?')
+            params.append(sn)
+        if port_name is not None:
+            conditions.append(
+                'dev_id in (select dev_id from serialports where port_name=?)')
+            params.append(port_name)
+        if addr is not None:
+            conditions.append(
+                'dev_id in (select dev_id from interfaces where addr=?)')
+            params.append(addr)
+        query = ('select dev_id, hostname, sn, first_seen, last_updated, '
+                 'holdtime, expires, '
+                 "case when expires > ? then 'alive' else 'dead' end, "
+                 'tunnel_up, tunnel_up_since, tunnel_reconnects '
+                 'from devices')
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        query += ' order by dev_id'
+        if limit is not None:
+            query += ' limit ?'
+            params.append(limit)
+        c.execute(query + ';', [now] + params)
         devlist = list()
-        c = self._conn.cursor()
-        if dev_id is None:
-            c.execute('select dev_id, hostname, sn, first_seen, last_updated, '
-                      'holdtime from devices;')
-        else:
-            c.execute('select dev_id, hostname, sn, first_seen, last_updated, '
-                      'holdtime from devices where dev_id=?', [dev_id])
-        results = c.fetchall()
-        for r in results:
-            dev_dict = dict()
-            dev_id = r[0]
-            dev_dict['dev_id'] = r[0]
-            dev_dict['hostname'] = r[1]
-            dev_dict['sn'] = r[2]
-            dev_dict['first_seen'] = r[3]
-            dev_dict['last_updated'] = r[4]
-            dev_dict['holdtime'] = r[5]
-            dev_dict['interfaces'] = self.get_interface_details(dev_id)
-            dev_dict['ports'] = self.get_serialport_details(dev_id)
+        devices = dict()
+        for r in c.fetchall():
+            dev_dict = {
+                'dev_id': r[0],
+                'hostname': r[1],
+                'sn': r[2],
+                'first_seen': r[3],
+                'last_updated': r[4],
+                'holdtime': r[5],
+                'expires': r[6],
+                'status': r[7],
+                'tunnel_state': None,
+                'interfaces': dict(),
+                'ports': list(),
+                'console_ports': dict(),
+                'port_info': dict()
+            }
+            if r[8] is not None:
+                dev_dict['tunnel_state'] = {
+                    'up': bool(r[8]),
+                    'up_since': r[9],
+                    'reconnects': r[10]
+                }
+            devices[r[0]] = dev_dict
             devlist.append(dev_dict)
+        if not devices:
+            return devlist
+
+        # the children of exactly the devices returned, however sparse, with
+        # one query per table: the ids go in as a single JSON array
+        where = ' where dev_id in (select value from json_each(?))'
+        params = [json.dumps(list(devices))]
+        c.execute('select dev_id, int_name, state, addr from interfaces' +
+                  where + ';', params)
+        for r in c.fetchall():
+            dev_dict = devices.get(r[0])
+            if dev_dict is None:
+                continue
+            if_list = dev_dict['interfaces']
+            if r[1] not in if_list:
+                if_list[r[1]] = {
+                    'addrs': [],
+                    'state': r[2]
+                }
+            if_list[r[1]]['addrs'].append(r[3])
+
+        c.execute('select dev_id, port_name, tunnelport, speed, live '
+                  'from serialports' + where + ';', params)
+        for r in c.fetchall():
+            dev_dict = devices.get(r[0])
+            if dev_dict is not None:
+                dev_dict['ports'].append(r[1])
+                if r[2] is not None:
+                    dev_dict['console_ports'][r[1]] = r[2]
+                if r[3] is not None or r[4] is not None:
+                    dev_dict['port_info'][r[1]] = {
+                        'speed': r[3],
+                        'live': None if r[4] is None else bool(r[4])
+                    }
         return devlist
 
-    def get_devid_by_sn(self, sn):
+    @observed
+    def get_status_counts(self):
+        """
+        Count alive and dead devices with two range scans on the expiry index.
+        :return: dict() with 'alive' and 'dead' counts
+        """
+        c = self.cursor()
+        now = datetime.datetime.utcnow()
+        c.execute("select count(*) from devices where expires > ?;", [now])
+        alive = c.fetchone()[0]
+        c.execute("select count(*) from devices where expires <= ?;", [now])
+        dead = c.fetchone()[0]
+        return {
+            'alive': alive,
+            'dead': dead
+        }
+
+    @observed
+    def get_devid_by_sn(self, sn, c=None):
         """
         Obtain a device id given a device serial number.
         :param sn: string containing the serial number
+        :param c: cursor of an open transaction, if any
         :return: device ID if found, None otherwise
         """
-        c = self._conn.cursor()
+        if c is None:
+            c = self.cursor()
         c.execute("""
             select
                 dev_id
@@ -242,14 +944,19 @@ class DB:
             return results[0][0]
         return None
 
-    def update_interfaces(self, dev_id, iflist):
+    @observed
+    def update_interfaces(self, dev_id, iflist, c=None):
         """
         Adds interfaces to the database for a particular device.
         :param dev_id: Device ID of the unit
         :param iflist: Data dict() describing the interfaces
+        :param c: cursor of an open transaction, if any
         :return: None
         """
-        self.delete_interfaces_by_devid(dev_id)
+        if c is None:
+            with self.transaction() as c:
+                return self.update_interfaces(dev_id, iflist, c)
+        self.delete_interfaces_by_devid(dev_id, c)
         ifstates = [(dev_id, ifname, iflist[ifname]['state'])
                     for ifname in iflist]
         insert_list = list()
@@ -257,7 +964,6 @@ class DB:
             insert_list.extend([(i[0], i[1], i[2], addr,
                                  self.ip_version(addr))
                                 for addr in iflist[i[1]]['addrs']])
-        c = self._conn.cursor()
         c.executemany("""
         insert into interfaces (
             dev_id
@@ -268,62 +974,108 @@ class DB:
         )
         values (?, ?, ?, ?, ?);
             """, insert_list)
-        self._conn.commit()
 
-    def delete_device_by_devid(self, dev_id):
+    @observed
+    def delete_device_by_devid(self, dev_id, c=None):
         """
         Deletes a device from all tables.
         :param dev_id: Device id to delete
+        :param c: cursor of an open transaction, if any
         :return: None
         """
-        self.delete_interfaces_by_devid(dev_id)
-        self.delete_serialports_by_devid(dev_id)
-        self.delete_listener_port_by_devid(dev_id)
-        c = self._conn.cursor()
+        if c is None:
+            with self.transaction() as c:
+                return self.delete_device_by_devid(dev_id, c)
+        self.delete_interfaces_by_devid(dev_id, c)
+        self.delete_serialports_by_devid(dev_id, c)
+        self.delete_listener_port_by_devid(dev_id, c)
         c.execute("delete from devices where dev_id=?;", [dev_id])
-        self._conn.commit()
+        self.bump_fleet_version(c)
 
-    def delete_interfaces_by_devid(self, dev_id):
+    @observed
+    def delete_interfaces_by_devid(self, dev_id, c=None):
         """
         Deletes a device's interfaces from interface table.
         :param dev_id: Device id to delete
+        :param c: cursor of an open transaction, if any
         :return: None
         """
-        c = self._conn.cursor()
+        if c is None:
+            with self.transaction() as c:
+                return self.delete_interfaces_by_devid(dev_id, c)
         c.execute("""
         delete from interfaces where dev_id=?;
         """, [dev_id])
-        self._conn.commit()
 
-    def update_serialports(self, dev_id, portlist):
+    @observed
+    def update_serialports(self, dev_id, portlist, c=None, port_info=None):
         """
-        Add serial ports to the database.
+        Replaces a device's serial ports with the ports in portlist.  Ports
+        the device still has keep their row and tunnel port; the tunnel
+        ports of removed ports go back to the free list.
         :param dev_id: Device id of the owning device
         :param portlist: List of str()'s describing the port names
+        :param c: cursor of an open transaction, if any
+        :param port_info: dict() of port name to a dict() with the detected
+            speed (bits per second) and live flag of the port; either may be
+            None if the port has not been probed
         :return: None
         """
-        self.delete_serialports_by_devid(dev_id)
-        c = self._conn.cursor()
-        insert_list = [(dev_id, p) for p in portlist]
+        if c is None:
+            with self.transaction() as c:
+                return self.update_serialports(dev_id, portlist, c, port_info)
+        c.execute("""
+            select port_name, tunnelport from serialports where dev_id=?;
+        """, [dev_id])
+        existing = dict(c.fetchall())
+        removed = [p for p in existing if p not in portlist]
+        c.executemany("""
+            delete from serialports where dev_id=? and port_name=?;
+        """, [(dev_id, p) for p in removed])
+        self.release_tunnelports([existing[p] for p in removed
+                                  if existing[p] is not None], c)
+        port_info = port_info or dict()
+        probes = dict()
+        for p in portlist:
+            info = port_info.get(p) or dict()
+            live = info.get('live')
+            probes[p] = (info.get('speed'),
+                         None if live is None else bool(live))
+        insert_list = [(dev_id, p) + probes[p] for p in dict.fromkeys(portlist)
+                       if p not in existing]
         c.executemany("""
         insert into serialports (
             dev_id
             , port_name
+            , speed
+            , live
         )
-        values (?, ?);""", insert_list)
-        self._conn.commit()
+        values (?, ?, ?, ?);""", insert_list)
+        c.executemany("""
+            update serialports set speed=?, live=?
+            where dev_id=? and port_name=?;
+        """, [probes[p] + (dev_id, p) for p in existing if p in probes])
 
-    def delete_serialports_by_devid(self, dev_id):
+    @observed
+    def delete_serialports_by_devid(self, dev_id, c=None):
         """
         Deletes a device's serial ports from serialports table.
         :param dev_id: Device id to delete
+        :param c: cursor of an open transaction, if any
         :return: None
         """
-        c = self._conn.cursor()
+        if c is None:
+            with self.transaction() as c:
+                return self.delete_serialports_by_devid(dev_id, c)
+        c.execute("""
+            select tunnelport from serialports
+            where dev_id=? and tunnelport is not null;
+        """, [dev_id])
+        ports = [r[0] for r in c.fetchall()]
         c.execute("""
         delete from serialports where dev_id=?;
         """, [dev_id])
-        self._conn.commit()
+        self.release_tunnelports(ports, c)
 
     @staticmethod
     def ip_version(addr):
@@ -343,85 +1095,183 @@ class DB:
             return 6
         return None
 
-    def assign_tunnelport(self, dev_id):
+    @observed
+    def assign_tunnelport(self, dev_id, c=None):
         """
         Assigns a TCP listening port to a device for a reverse SSH tunnel.
+        Devices keep their port for as long as they hold it; new ports are
+        taken from the free list in constant time.
         Args:
             dev_id: device requesting a port
+            c: cursor of an open transaction, if any
 
-        Returns: assigned port number
+        Returns: dict() with the tunnel server and the assigned port
         """
-        current_port = self.get_tunnelport_by_devid(dev_id)
-        if current_port is not None:
-            return {
-                "server": TUNNEL_SERVER,
-                "port": current_port
-            }
-        c = self._conn.cursor()
-        c.execute("BEGIN EXCLUSIVE TRANSACTION;")   # locks database while we are looking for a port
-        assigned_port = 0
-        last_port = self.get_last_tunnelport_from_db(c)
-        if last_port is not None:
-            assigned_port = last_port + 1
-        else:
-            assigned_port = LISTENER_PORT_BASE
+        if c is None:
+            # the write lock is held while we are looking for a port
+            with self.transaction() as c:
+                return self.assign_tunnelport(dev_id, c)
+        port = self.get_tunnelport_by_devid(dev_id, c)
+        if port is None:
+            port = self.take_tunnelport(c)
             c.execute("""
-                UPDATE devices set tunnelport=(
-                    WITH RECURSIVE
-                    cnt(tunnelport) AS (
-                    SELECT 2220
-                    UNION ALL
-                SELECT tunnelport+1 FROM cnt
-                LIMIT 200
-          ) SELECT tunnelport
-            FROM cnt
-            WHERE tunnelport
-            NOT IN (SELECT
-                tunnelport
-                FROM devices
-                WHERE tunnelport IS NOT NULL )
-                LIMIT 1 )
-                WHERE dev_id=?;""", [ dev_id ])
-#        c.execute("""
-#        update devices set
-#            tunnelport=?
-#        WHERE dev_id=?;""", [assigned_port, dev_id])
-        self._conn.commit()
+            update devices set
+                tunnelport=?
+            WHERE dev_id=?;""", [port, dev_id])
         return {
-            "tunnelserver": TUNNEL_SERVER,
-            "tunnelport": assigned_port
+            "server": TUNNEL_SERVER,
+            "port": port
         }
 
-    def get_tunnelport_by_devid(self, dev_id):
-        c = self._conn.cursor()
-        c.execute("select tunnelport from devices where dev_id=?;", [dev_id])
+    @observed
+    def assign_serialport_tunnelports(self, dev_id, c):
+        """
+        Assigns a tunnel port to each of a device's serial ports that does
+        not have one yet, so the agent can forward every console separately.
+        :param dev_id: device owning the serial ports
+        :param c: cursor of an open transaction
+        :return: dict() of port name to tunnel port
+        """
+        c.execute("""
+            select rowid, port_name, tunnelport from serialports
+            where dev_id=? order by rowid;
+        """, [dev_id])
+        ports = dict()
+        for rowid, port_name, port in c.fetchall():
+            if port is None:
+                port = self.take_tunnelport(c)
+                c.execute("update serialports set tunnelport=? where rowid=?;",
+                          [port, rowid])
+            ports[port_name] = port
+        return ports
+
+    def take_tunnelport(self, c):
+        """
+        Allocates a tunnel port, reclaiming the ports of long dead devices
+        if the free list has run dry.
+        :param c: cursor of an open transaction
+        :return: port number
+        """
+        port = self.allocate_tunnelport(c)
+        if port is None:
+            self.reclaim_tunnelports(c=c)
+            port = self.allocate_tunnelport(c)
+        if port is None:
+            raise Exception("No free tunnel ports between %d and %d" % (
+                self.listener_port_base, self.listener_port_max))
+        return port
+
+    @observed
+    def allocate_tunnelport(self, c):
+        """
+        Takes the lowest port off the tunnel port free list.
+        :param c: cursor of an open transaction
+        :return: port number, or None if the free list is empty
+        """
+        c.execute("select port from free_tunnelports order by port limit 1;")
+        result = c.fetchone()
+        if result is None:
+            return None
+        c.execute("delete from free_tunnelports where port=?;", result)
+        return result[0]
+
+    @observed
+    def release_tunnelports(self, ports, c):
+        """
+        Returns ports to the tunnel port free list.  Ports outside the
+        configured listener range are dropped.
+        :param ports: list of port numbers
+        :param c: cursor of an open transaction
+        :return: None
+        """
+        c.executemany("""
+            insert or ignore into free_tunnelports (port) values (?);
+        """, [(p, ) for p in ports
+              if self.listener_port_base <= p <= self.listener_port_max])
+
+    @observed
+    def reclaim_tunnelports(self, grace=None, c=None):
+        """
+        Takes tunnel ports back from devices that have been dead for longer
+        than their holdtime plus a grace period, including the tunnel ports
+        of their serial ports.
+        :param grace: seconds past holdtime, defaults to reclaim_grace
+        :param c: cursor of an open transaction, if any
+        :return: list of (sn, port) tuples that were reclaimed
+        """
+        if c is None:
+            with self.transaction() as c:
+                return self.reclaim_tunnelports(grace, c)
+        if grace is None:
+            grace = self.reclaim_grace
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace)
+        c.execute("""
+            select dev_id, sn, tunnelport from devices
+            where expires < ? and tunnelport is not null;
+        """, [cutoff])
         results = c.fetchall()
-        if len(results) > 0:
-            return results[0][0]
-        return None
+        c.executemany("update devices set tunnelport=NULL where dev_id=?;",
+                      [(r[0], ) for r in results])
+        self.release_tunnelports([r[2] for r in results], c)
+        c.execute("""
+            select rowid, tunnelport from serialports
+            where tunnelport is not null and dev_id in (
+                select dev_id from devices where expires < ?);
+        """, [cutoff])
+        serial = c.fetchall()
+        c.executemany("update serialports set tunnelport=NULL where rowid=?;",
+                      [(r[0], ) for r in serial])
+        self.release_tunnelports([r[1] for r in serial], c)
+        return [(r[1], r[2]) for r in results]
 
-    def get_last_tunnelport_from_db(self, c=None):
+    @observed
+    def get_tunnelport_usage(self):
+        """
+        Counts allocated and free tunnel ports.
+        :return: dict() with 'allocated' and 'free' counts
+        """
+        c = self.cursor()
+        c.execute("select count(*) from devices where tunnelport is not null;")
+        allocated = c.fetchone()[0]
+        c.execute("""
+            select count(*) from serialports where tunnelport is not null;
+        """)
+        allocated += c.fetchone()[0]
+        c.execute("select count(*) from free_tunnelports;")
+        return {
+            'allocated': allocated,
+            'free': c.fetchone()[0]
+        }
+
+    @observed
+    def get_tunnelport_by_devid(self, dev_id, c=None):
         if c is None:
-            c = self._conn.cursor()
-        c.execute("select tunnelport from devices order by tunnelport desc limit 1;")
+            c = self.cursor()
+        c.execute("select tunnelport from devices where dev_id=?;", [dev_id])
         results = c.fetchall()
         if len(results) > 0:
             return results[0][0]
-        else:
-            return None
+        return None
 
-    def delete_listener_port_by_devid(self, dev_id):
+    @observed
+    def delete_listener_port_by_devid(self, dev_id, c=None):
         """
-        Removes a device's SSH tunnel port from devices table.
+        Removes a device's SSH tunnel port from devices table and returns it
+        to the free list.
         :param dev_id: Device id to delete
+        :param c: cursor of an open transaction, if any
         :return: None
         """
-        c = self._conn.cursor()
+        if c is None:
+            with self.transaction() as c:
+                return self.delete_listener_port_by_devid(dev_id, c)
+        port = self.get_tunnelport_by_devid(dev_id, c)
         c.execute("""
         update devices set
             tunnelport=NULL
         WHERE dev_id=?;""", [dev_id])
-        self._conn.commit()
+        if port is not None:
+            self.release_tunnelports([port], c)
 
     def close(self):
         """
@@ -430,3 +1280,57 @@ class DB:
         """
         self._conn.close()
 
+
+class DBPool:
+    """
+    Thread-safe pool of persistent DB connections.  The schema is validated
+    once, when the pool opens its first connection; connections are then
+    reused across requests, keeping their prepared statement caches warm.
+
+    Attributes:
+        dbfile:     Location of the database file
+        size:       Maximum number of idle connections kept open
+    """
+    def __init__(self, dbfile=DBFILE, size=POOL_SIZE):
+        self.dbfile = dbfile
+        self.size = size
+        # LIFO so the most recently used (warmest) connection is reused first
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._idle.put(DB(self.dbfile))
+
+    def acquire(self):
+        """
+        Take a connection from the pool, opening a new one if all pooled
+        connections are in use.
+        :return: DB object
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return DB(self.dbfile, check_schema=False)
+
+    def release(self, db):
+        """
+        Return a connection to the pool.  Any transaction left open by the
+        caller is rolled back; surplus connections are closed.
+        :param db: DB object obtained from acquire()
+        :return: None
+        """
+        db.profile = None
+        if db._conn.in_transaction:
+            db._conn.rollback()
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        :return: None
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
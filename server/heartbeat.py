@@ -0,0 +1,188 @@
+import atexit
+import datetime
+import logging
+import threading
+
+
+FLUSH_INTERVAL = 5
+
+
+class HeartbeatBuffer:
+    """
+    Write-behind liveness table for registered devices.
+
+    A registration that only confirms a device is still alive (same
+    hostname, holdtime, inventory digest and tunnel state as the last one
+    written to the database, and no gap longer than the holdtime since the
+    previous one) is answered from memory and queued here.  A device that
+    went silent is sent back through the database, since its tunnel port
+    may have been reclaimed.  A background thread writes the queued
+    last_updated values to the database in one transaction every flush
+    interval, so request latency does not depend on disk syncs.
+
+    Attributes:
+        pool:       DBPool used by the flusher
+        interval:   Seconds between flushes
+        generation: Counter bumped by every buffered heartbeat, so callers
+                    can tell whether merge() would produce a different view
+    """
+    def __init__(self, pool, interval=FLUSH_INTERVAL):
+        self.pool = pool
+        self.interval = interval
+        self.generation = 0
+        self._lock = threading.Lock()
+        # sn -> [hostname, holdtime, inventory_digest, tunnel_state,
+        #        response, last_seen]
+        self._known = dict()
+        # sn -> (last_updated, holdtime), waiting to be written
+        self._pending = dict()
+        # batch currently being written by flush()
+        self._flushing = dict()
+        # held for a whole flush, so a caller that has to see every buffered
+        # heartbeat written waits for a batch already being written
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background flusher thread.
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='heartbeat-flusher')
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the flusher thread and write anything still queued.
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Flushing heartbeats failed")
+
+    def refresh(self, dev_data):
+        """
+        Record a heartbeat in memory if it carries no changes.
+        :param dev_data: registration data from the device
+        :return: the response to send to the device, or None if the
+            registration has to go through DB.update_device()
+        """
+        sn = dev_data.get('sn')
+        known = self._known.get(sn)
+        if known is None or dev_data.get('inventory_digest') is None:
+            return None
+        hostname, holdtime, digest, tunnel_state, response, last_seen = known
+        if (dev_data.get('hostname') != hostname
+                or dev_data.get('holdtime') != holdtime
+                or dev_data['inventory_digest'] != digest
+                or dev_data.get('tunnel_state') != tunnel_state):
+            return None
+        now = datetime.datetime.utcnow()
+        if (now - last_seen).total_seconds() > holdtime:
+            return None
+        with self._lock:
+            known[5] = now
+            self._pending[sn] = (now, holdtime)
+            self.generation += 1
+        return response
+
+    def remember(self, dev_data, response):
+        """
+        Cache the outcome of a registration written to the database, so the
+        next unchanged heartbeat from the same device can be buffered.
+        :param dev_data: registration data from the device
+        :param response: response returned by DB.update_device()
+        :return: None
+        """
+        sn = dev_data.get('sn')
+        with self._lock:
+            self._pending.pop(sn, None)
+            if (dev_data.get('inventory_digest') is None
+                    or response.get('send_inventory')):
+                self._known.pop(sn, None)
+                return
+            # later heartbeats are not new registrations
+            response = dict((k, v) for k, v in response.items() if k != 'new')
+            self._known[sn] = [dev_data.get('hostname'),
+                               dev_data.get('holdtime'),
+                               dev_data['inventory_digest'],
+                               dev_data.get('tunnel_state'), response,
+                               datetime.datetime.utcnow()]
+
+    def forget(self, sn):
+        """
+        Drop a device from the cache, e.g. after it was deleted or its tunnel
+        port was reclaimed.  flush() does this for devices the database no
+        longer has, so their next registration goes through the database.
+        :param sn: serial number of the device
+        :return: None
+        """
+        with self._lock:
+            self._known.pop(sn, None)
+            self._pending.pop(sn, None)
+
+    def flush(self):
+        """
+        Write all queued heartbeats to the database in one transaction.
+        Returns once every heartbeat buffered before the call is written,
+        including any batch another thread was writing at the time.
+        :return: number of devices written
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._flushing, self._pending = self._pending, dict()
+            batch = [(sn, ts, holdtime)
+                     for sn, (ts, holdtime) in self._flushing.items()]
+            db = self.pool.acquire()
+            try:
+                stale = db.touch_devices(batch)
+            except Exception:
+                # put the batch back unless newer heartbeats arrived meanwhile
+                with self._lock:
+                    for sn, value in self._flushing.items():
+                        self._pending.setdefault(sn, value)
+                raise
+            finally:
+                self.pool.release(db)
+                with self._lock:
+                    self._flushing = dict()
+            for sn in stale:
+                logging.info("Device %s was deleted or its tunnel port "
+                             "reclaimed, dropping its cached registration", sn)
+                self.forget(sn)
+            return len(batch) - len(stale)
+
+    def merge(self, devices):
+        """
+        Overlay heartbeats that have not been written yet onto device details
+        read from the database.
+        :param devices: list of device dicts from DB.get_device_details()
+        :return: the same list, updated in place
+        """
+        with self._lock:
+            if not self._pending and not self._flushing:
+                return devices
+            for device in devices:
+                pending = (self._pending.get(device['sn'])
+                           or self._flushing.get(device['sn']))
+                if pending is not None:
+                    device['last_updated'] = str(pending[0])
+                    device['holdtime'] = pending[1]
+                    device['expires'] = str(
+                        pending[0] + datetime.timedelta(seconds=pending[1]))
+                    device['status'] = 'alive'
+        return devices
@@ -0,0 +1,449 @@
+"""
+Console history: console output shipped by the agents, stored so it can be
+read back by time range and searched.
+
+Output arrives in chunks, each a gzip stream of timestamped lines covering a
+known time range.  Chunks are appended, still compressed, to segment files
+kept per device (serial number) and console port:
+
+    <root>/<sn>/<port>/<seq>.seg    concatenated gzip chunks
+    <root>/<sn>/<port>/<seq>.idx    sparse time index, one entry per chunk:
+                                    start, end, offset and length
+    <root>/<sn>/<port>/<seq>.tok    optional token index: every word of three
+                                    or more characters printed in the segment
+
+A segment is sealed once it is SEGMENT_BYTES large or SEGMENT_AGE old, and
+retention drops whole segments once everything in them is older than the
+retention period, so nothing is ever rewritten.  A time range query only
+decompresses the chunks the index says overlap it; a search first skips the
+segments whose token index rules the string out.
+
+The store keeps its segment list in memory and expects to be the only
+writer of its directory.
+"""
+import datetime
+import math
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+
+SEGMENT_BYTES = 4 * 1024 * 1024
+SEGMENT_AGE = 60 * 60
+RETENTION = 30 * 24 * 60 * 60
+# seconds between retention passes, which run from append()
+EXPIRE_INTERVAL = 10 * 60
+INDEX_ENTRY = struct.Struct('<ddQI')
+# stream names end up in paths
+NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+TOKEN = re.compile(rb'[A-Za-z0-9_]{3,}')
+WORD_BYTE = re.compile(rb'[A-Za-z0-9_]')
+# largest chunk accepted, once decompressed
+CHUNK_LIMIT = 16 * 1024 * 1024
+# longest unterminated line carried over to the next chunk for the token index
+TAIL_LIMIT = 64 * 1024
+# times accepted: from the epoch to the end of year 9999
+TIME_MAX = 253402300800
+# agents stamp every line with its time, e.g. 2016-06-01T00:00:00.000Z
+STAMP = re.compile(rb'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z ', re.M)
+STAMP_LENGTH = 24
+# lines returned by a search unless the client asks for fewer or more
+SEARCH_LIMIT = 100
+
+
+def format_stamp(ts):
+    """
+    Formats a time the way agents stamp console lines.
+    :param ts: seconds since the epoch
+    :return: str()
+    """
+    t = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+    return t.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (t.microsecond // 1000)
+
+
+def tokens(data):
+    """
+    Words of three or more characters in data, lowercased.  Line stamps are
+    left out, as every line has one.
+    :param data: bytes
+    :return: set() of bytes
+    """
+    return set(TOKEN.findall(STAMP.sub(b'', data).lower()))
+
+
+def query_tokens(text):
+    """
+    Tokens that every line containing text must contain too.  A word at the
+    edge of text may be part of a longer word in the line, so edge words
+    only count when text has a word boundary there.
+    :param text: bytes searched for
+    :return: set() of bytes
+    """
+    found = [m for m in TOKEN.finditer(text.lower())]
+    return set(m.group() for m in found
+               if (m.start() > 0 or not WORD_BYTE.match(text[:1]))
+               and (m.end() < len(text) or not WORD_BYTE.match(text[-1:])))
+
+
+def decompress(data, limit=CHUNK_LIMIT):
+    """
+    Decompresses a shipped chunk, refusing chunks that expand beyond limit.
+    :param data: gzip compressed bytes
+    :param limit: largest decompressed size accepted
+    :return: bytes
+    """
+    decompressor = zlib.decompressobj(47)
+    try:
+        text = decompressor.decompress(data, limit)
+    except zlib.error as e:
+        raise ValueError("chunk is not gzip compressed: %s" % e)
+    if decompressor.unconsumed_tail:
+        raise ValueError("chunk is larger than %d bytes decompressed" % limit)
+    if not decompressor.eof:
+        raise ValueError("chunk is truncated")
+    return text
+
+
+def check_time(ts):
+    """
+    Rejects times that are not finite or outside the range stamps can show.
+    :param ts: seconds since the epoch
+    :return: ts
+    """
+    if not math.isfinite(ts) or not 0 <= ts < TIME_MAX:
+        raise ValueError("time out of range: %r" % (ts, ))
+    return ts
+
+
+class Segment:
+    """
+    One segment file and its index.
+
+    Attributes:
+        path:       path of the segment without extension
+        start, end: time range covered by the chunks in the segment
+        size:       bytes of compressed output in the segment
+        created:    time the segment was started
+    """
+    def __init__(self, path, created):
+        self.path = path
+        self.created = created
+        self.start = None
+        self.end = None
+        self.size = 0
+        self.entries = list()
+        self._tokens = None
+
+    @classmethod
+    def load(cls, path):
+        segment = cls(path, os.path.getmtime(path + '.seg'))
+        with open(path + '.idx', 'rb') as f:
+            index = f.read()
+        # a torn last entry from a crash is ignored
+        for i in range(len(index) // INDEX_ENTRY.size):
+            segment.add_entry(INDEX_ENTRY.unpack_from(index,
+                                                      i * INDEX_ENTRY.size))
+        return segment
+
+    def add_entry(self, entry):
+        start, end, offset, length = entry
+        self.entries.append(entry)
+        self.start = start if self.start is None else min(self.start, start)
+        self.end = end if self.end is None else max(self.end, end)
+        self.size = max(self.size, offset + length)
+
+    def overlaps(self, start, end):
+        return (self.start is not None and self.start <= end
+                and self.end >= start)
+
+    def tokens(self):
+        """
+        The segment's token index, or None if it has none.
+        :return: set() of bytes, or None
+        """
+        if self._tokens is None and os.path.exists(self.path + '.tok'):
+            try:
+                with open(self.path + '.tok', 'rb') as f:
+                    self._tokens = set(f.read().split())
+            except FileNotFoundError:
+                # removed by expire() since the segment list was read
+                pass
+        return self._tokens
+
+    def append(self, start, end, data, words=None):
+        with open(self.path + '.seg', 'ab') as f:
+            # the end of the file, past anything a crash left unindexed
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+        entry = (start, end, offset, len(data))
+        with open(self.path + '.idx', 'ab') as f:
+            f.write(INDEX_ENTRY.pack(*entry))
+        self.add_entry(entry)
+        if words is not None:
+            known = self.tokens() or set()
+            new = words - known
+            if new or self._tokens is None:
+                with open(self.path + '.tok', 'ab') as f:
+                    f.write(b''.join(w + b'\n' for w in sorted(new)))
+                self._tokens = known | new
+
+    def chunks(self, start, end):
+        """
+        Decompressed chunks overlapping a time range.  A segment removed by
+        expire() since the caller found it has none.
+        :return: generator of bytes
+        """
+        try:
+            f = open(self.path + '.seg', 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            for c_start, c_end, offset, length in self.entries:
+                if c_start <= end and c_end >= start:
+                    f.seek(offset)
+                    yield zlib.decompress(f.read(length), 47)
+
+    def remove(self):
+        for ext in ('.seg', '.idx', '.tok'):
+            if os.path.exists(self.path + ext):
+                os.remove(self.path + ext)
+
+
+class HistoryStore:
+    """
+    Append-only, segment based store of console output.
+
+    Attributes:
+        root:           directory the segments are kept in
+        segment_bytes:  size at which a segment is sealed
+        segment_age:    seconds after which a segment is sealed
+        retention:      seconds console output is kept
+        token_index:    whether segments get a token index
+    """
+    def __init__(self, root, segment_bytes=SEGMENT_BYTES,
+                 segment_age=SEGMENT_AGE, retention=RETENTION,
+                 token_index=True):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.retention = retention
+        self.token_index = token_index
+        self._lock = threading.Lock()
+        # (sn, port) -> list of Segment, oldest first
+        self._streams = dict()
+        # (sn, port) -> unterminated last line of the stream's last chunk
+        self._tails = dict()
+        self._expired = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        for sn in os.listdir(self.root):
+            if not os.path.isdir(os.path.join(self.root, sn)):
+                continue
+            for port in os.listdir(os.path.join(self.root, sn)):
+                directory = os.path.join(self.root, sn, port)
+                names = sorted(n[:-4] for n in os.listdir(directory)
+                               if n.endswith('.idx'))
+                self._streams[(sn, port)] = [
+                    Segment.load(os.path.join(directory, n)) for n in names]
+
+    @staticmethod
+    def check_name(name):
+        if not isinstance(name, str) or not NAME.match(name):
+            raise ValueError("invalid device or port name: %r" % (name, ))
+        return name
+
+    def append(self, sn, port, start, end, data):
+        """
+        Stores one chunk of console output.
+        :param sn: serial number of the device
+        :param port: console port name
+        :param start: time of the first line in the chunk
+        :param end: time of the last line in the chunk
+        :param data: gzip compressed, timestamped console output
+        :return: None
+        """
+        self.check_name(sn)
+        self.check_name(port)
+        check_time(start)
+        check_time(end)
+        if start > end:
+            raise ValueError("chunk starts after it ends")
+        text = decompress(data)
+        with self._lock:
+            # a line split across chunks is indexed as a whole
+            tail = self._tails.get((sn, port), b'')
+            words = tokens(tail + text) if self.token_index else None
+            tail = (tail + text).rpartition(b'\n')[2]
+            self._tails[(sn, port)] = tail[-TAIL_LIMIT:]
+            segments = self._streams.setdefault((sn, port), list())
+            now = time.time()
+            current = segments[-1] if segments else None
+            if (current is None or current.size >= self.segment_bytes
+                    or now - current.created >= self.segment_age):
+                directory = os.path.join(self.root, sn, port)
+                os.makedirs(directory, exist_ok=True)
+                seq = int(os.path.basename(current.path)) + 1 if current else 1
+                current = Segment(os.path.join(directory, '%010d' % seq), now)
+                segments.append(current)
+            current.append(start, end, data, words)
+        if now - self._expired >= EXPIRE_INTERVAL:
+            self._expired = now
+            self.expire(now)
+
+    def read(self, sn, port, start, end):
+        """
+        Console output of one port between two times.
+        :param sn: serial number of the device
+        :param port: console port name
+        :param start: seconds since the epoch
+        :param end: seconds since the epoch
+        :return: bytes, the timestamped lines in the range
+        """
+        with self._lock:
+            segments = [s for s in self._streams.get((sn, port), [])
+                        if s.overlaps(start, end)]
+        return b''.join(self._lines_between(segments, start, end))
+
+    @staticmethod
+    def _lines_between(segments, start, end, text=None, needed=None):
+        """
+        Lines of a stream stamped between start and end.  Lines split across
+        chunks are joined again; the unstamped rest of a line whose start is
+        in a chunk outside the range is left out with it.
+        :param segments: segments of one stream, oldest first
+        :param text: if given, chunks without it are not split into lines
+        :param needed: if given, segments whose token index lacks any of these
+            tokens are skipped
+        :return: generator of bytes, one line each
+        """
+        first, last = format_stamp(start).encode(), format_stamp(end).encode()
+        keep = False
+        carry = b''
+        for segment in segments:
+            words = segment.tokens() if needed else None
+            if words is not None and not needed <= words:
+                carry = b''
+                keep = False
+                continue
+            for chunk in segment.chunks(start, end):
+                data = carry + chunk
+                complete, newline, carry = data.rpartition(b'\n')
+                if not newline:
+                    continue
+                if text is not None and text not in complete:
+                    # every complete line is stamped, so the rest of the
+                    # chunk does not depend on keep
+                    keep = False
+                    continue
+                for line in (complete + newline).splitlines(True):
+                    if STAMP.match(line):
+                        keep = first <= line[:STAMP_LENGTH] <= last
+                    if keep:
+                        yield line
+        if carry and STAMP.match(carry):
+            keep = first <= carry[:STAMP_LENGTH] <= last
+        if carry and keep and (text is None or text in carry):
+            yield carry
+
+    def search(self, text, start, end, limit=SEARCH_LIMIT):
+        """
+        Finds the lines containing text, across every console.
+        :param text: bytes to look for
+        :param start: seconds since the epoch
+        :param end: seconds since the epoch
+        :param limit: maximum number of lines returned
+        :return: list of (sn, port, line) tuples
+        """
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        needed = query_tokens(text)
+        with self._lock:
+            candidates = [(sn, port, [s for s in segments
+                                      if s.overlaps(start, end)])
+                          for (sn, port), segments in self._streams.items()]
+        results = list()
+        for sn, port, segments in candidates:
+            for line in self._lines_between(segments, start, end, text,
+                                            needed):
+                if text in line:
+                    results.append((sn, port, line.rstrip(b'\r\n')))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def expire(self, now=None):
+        """
+        Drops the segments holding only output older than the retention
+        period.
+        :param now: current time
+        :return: number of segments dropped
+        """
+        cutoff = (now or time.time()) - self.retention
+        dropped = 0
+        with self._lock:
+            for segments in self._streams.values():
+                while segments and segments[0].end is not None \
+                        and segments[0].end < cutoff:
+                    segments.pop(0).remove()
+                    dropped += 1
+        return dropped
+
+
+def parse_time(value):
+    """
+    Parses a time given as seconds since the epoch or as an ISO 8601 UTC
+    timestamp like the ones console lines are stamped with.
+    :param value: str()
+    :return: seconds since the epoch
+    """
+    try:
+        ts = float(value)
+    except ValueError:
+        ts = None
+    if ts is not None:
+        return check_time(ts)
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        t = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("not a time: %r" % (value, ))
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return check_time(t.timestamp())
+
+
+def parse_time_range(args, span=60 * 60):
+    """
+    Reads the start and end query parameters.  end defaults to now and start
+    to span seconds before end.
+    :param args: mapping of query parameters
+    :param span: default length of the range in seconds
+    :return: tuple of (start, end)
+    """
+    end = parse_time(args['end']) if args.get('end') else time.time()
+    start = parse_time(args['start']) if args.get('start') else end - span
+    if start > end:
+        raise ValueError("start is after end")
+    return start, end
+
+
+def parse_limit(args, default=SEARCH_LIMIT):
+    """
+    Reads the limit query parameter of a search.
+    :param args: mapping of query parameters
+    :param default: limit when none is given
+    :return: int, at least 1
+    """
+    try:
+        limit = int(args.get('limit', default))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    return limit
@@ -0,0 +1,155 @@
+import bisect
+import threading
+
+
+# request and query latencies are mostly sub-millisecond to tens of ms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Metric:
+    """
+    Base class for a metric family: one name, a fixed set of label names and
+    one value per combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key),
+                             repr(float(value)))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per-bucket counts (last one is +Inf), then sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) \
+                    + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def render_value(self, key, state):
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), state[:-1]):
+            cumulative += count
+            le = 'le="%s"' % (bound if bound == '+Inf' else repr(bound))
+            lines.append('%s_bucket%s %d' % (
+                self.name, format_labels(self.labels, key, le), cumulative))
+        labels = format_labels(self.labels, key)
+        lines.append('%s_sum%s %r' % (self.name, labels, state[-1]))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class RegistryMetrics:
+    """
+    Metrics exposed by the PiCon registry on /metrics in the Prometheus text
+    format.  Observations are a bisect and a dict update under a per-family
+    lock; fleet gauges are computed from the database only when scraped.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.requests = Histogram(
+            'picon_http_request_duration_seconds',
+            'Time spent serving HTTP requests', ('route', 'method', 'status'))
+        self.queries = Histogram(
+            'picon_db_method_duration_seconds',
+            'Time spent in DB methods', ('method', ))
+        self.registrations = Counter(
+            'picon_registrations_total',
+            'Device registrations, by whether the device was new',
+            ('kind', ))
+        self.buffered = Counter(
+            'picon_heartbeats_buffered_total',
+            'Registrations answered from the heartbeat buffer')
+        self.devices = Gauge(
+            'picon_devices', 'Registered devices by status', ('status', ))
+        self.tunnelports = Gauge(
+            'picon_tunnel_ports', 'Tunnel ports by state', ('state', ))
+        self.families = [self.requests, self.queries, self.registrations,
+                         self.buffered, self.devices, self.tunnelports]
+
+    def observe_request(self, route, method, status, seconds):
+        self.requests.observe(seconds, route, method, status)
+
+    def observe_db(self, method, seconds):
+        self.queries.observe(seconds, method)
+
+    def count_registration(self, response, buffered=False):
+        """
+        Counts one registration from its response.
+        :param response: response returned to the device
+        :param buffered: True if it was answered from the heartbeat buffer
+        :return: None
+        """
+        if response.get('status') != 'ok':
+            return
+        if buffered:
+            self.buffered.inc()
+        self.registrations.inc('new' if response.get('new') else 'refresh')
+
+    def render(self, db):
+        """
+        Renders all metrics, refreshing the fleet gauges first.
+        :param db: DB object to read fleet state from
+        :return: str() in the Prometheus text exposition format
+        """
+        for status, count in db.get_status_counts().items():
+            self.devices.set(count, status)
+        for state, count in db.get_tunnelport_usage().items():
+            self.tunnelports.set(count, state)
+        lines = list()
+        for family in self.families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,208 @@
+import hashlib
+import uuid
+import zlib
+
+
+PAGE_SIZE = 100
+PAGE_SIZE_MAX = 1000
+DEVICE_FIELDS = ('dev_id', 'hostname', 'sn', 'first_seen', 'last_updated',
+                 'holdtime', 'expires', 'status', 'tunnel_state',
+                 'interfaces', 'ports', 'console_ports', 'port_info')
+# fields that change with every heartbeat
+LIVENESS_FIELDS = ('last_updated', 'holdtime', 'expires', 'status')
+# /api/devices query parameter -> DB.get_device_details() argument
+DEVICE_FILTERS = {
+    'hostname': 'hostname',
+    'sn': 'sn',
+    'port': 'port_name',
+    'addr': 'addr'
+}
+# largest registration body accepted once decompressed
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+def decode_body(body, content_encoding=None, limit=MAX_BODY_SIZE):
+    """
+    Undoes the Content-Encoding of a request body.  Agents on metered links
+    may gzip their registrations; the decompressed size is bounded so a
+    small body cannot expand without limit.
+    :param body: raw request body
+    :param content_encoding: Content-Encoding header, if any
+    :param limit: largest decompressed size accepted
+    :return: decoded body
+    """
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        raise ValueError("unsupported Content-Encoding: %s" % encoding)
+    # wbits 47 accepts both zlib and gzip framing
+    decompressor = zlib.decompressobj(47)
+    try:
+        data = decompressor.decompress(body, limit)
+    except zlib.error as e:
+        raise ValueError("request body could not be decompressed: %s" % e)
+    if decompressor.unconsumed_tail:
+        raise ValueError("request body exceeds %d bytes decompressed" % limit)
+    return data
+
+
+class Registry:
+    """
+    Registration and device listing logic shared by the Flask app
+    (server.py) and the asyncio API server (asyncserver.py).  Methods that
+    need the database take a DB object borrowed by the caller; everything
+    else only touches memory, so callers on an event loop can run it inline.
+
+    Attributes:
+        heartbeats:     HeartbeatBuffer answering liveness-only registrations
+        page_size:      Default number of devices per /api/devices page
+        page_size_max:  Largest page a client may ask for
+        metrics:        Optional RegistryMetrics counting registrations
+    """
+    def __init__(self, heartbeats, page_size=PAGE_SIZE,
+                 page_size_max=PAGE_SIZE_MAX, metrics=None):
+        self.heartbeats = heartbeats
+        self.metrics = metrics
+        self.page_size = page_size
+        self.page_size_max = page_size_max
+        # ETags are derived from per-process state, so they are only
+        # comparable when issued by the same process
+        self._instance = uuid.uuid4().hex
+
+    def refresh(self, dev_data):
+        """
+        Answers a registration from memory if nothing changed.
+        :param dev_data: registration data from the device
+        :return: response for the device, or None if register() is needed
+        """
+        response = self.heartbeats.refresh(dev_data)
+        if response is not None and self.metrics is not None:
+            self.metrics.count_registration(response, buffered=True)
+        return response
+
+    def register(self, db, dev_data):
+        """
+        Registers one device, from memory if nothing changed.
+        :param db: DB object
+        :param dev_data: registration data from the device
+        :return: response for the device
+        """
+        response = self.refresh(dev_data)
+        if response is None:
+            response = db.update_device(dev_data)
+            self.heartbeats.remember(dev_data, response)
+            if self.metrics is not None:
+                self.metrics.count_registration(response)
+        return response
+
+    @staticmethod
+    def check_batch(data):
+        """
+        Validates a batch registration body.
+        :param data: decoded request body
+        :return: list of registration records
+        """
+        if not isinstance(data, dict) or not isinstance(data.get('devices'),
+                                                        list):
+            raise ValueError("expected a JSON object with a 'devices' list")
+        return data['devices']
+
+    def refresh_batch(self, dev_list):
+        """
+        Answers the unchanged registrations of a batch from memory.
+        :param dev_list: list of registration records
+        :return: list of responses, None where the database is needed
+        """
+        return [self.refresh(d) if isinstance(d, dict) else None
+                for d in dev_list]
+
+    def complete_batch(self, db, dev_list, results):
+        """
+        Writes the registrations refresh_batch() could not answer, in a
+        single transaction.
+        :param db: DB object
+        :param dev_list: list of registration records
+        :param results: list returned by refresh_batch()
+        :return: batch response body
+        """
+        pending = [d for d, r in zip(dev_list, results) if r is None]
+        if pending:
+            written = iter(db.update_devices(pending))
+            for i, result in enumerate(results):
+                if result is None:
+                    results[i] = next(written)
+                    if results[i]['status'] == 'ok':
+                        self.heartbeats.remember(dev_list[i], results[i])
+                    if self.metrics is not None:
+                        self.metrics.count_registration(results[i])
+        results = [dict(r, sn=d.get('sn') if isinstance(d, dict) else None)
+                   for d, r in zip(dev_list, results)]
+        return {"status": "ok", "results": results}
+
+    def parse_device_query(self, args):
+        """
+        Validates /api/devices query parameters.
+        :param args: mapping of query parameters
+        :return: dict() describing the query
+        """
+        query = dict()
+        status = args.get('status')
+        if status not in (None, 'alive', 'dead'):
+            raise ValueError("status must be 'alive' or 'dead'")
+        query['status'] = status
+        try:
+            limit = int(args.get('limit', self.page_size))
+            after = args.get('after')
+            query['after'] = int(after) if after is not None else None
+        except ValueError:
+            raise ValueError("limit and after must be integers")
+        query['limit'] = max(1, min(limit, self.page_size_max))
+        for param, argument in DEVICE_FILTERS.items():
+            query[argument] = args.get(param)
+        fields = args.get('fields')
+        query['fields'] = fields.split(',') if fields else None
+        if fields:
+            unknown = set(query['fields']) - set(DEVICE_FIELDS)
+            if unknown:
+                raise ValueError("unknown fields: " +
+                                 ', '.join(sorted(unknown)))
+        return query
+
+    def device_etag(self, db, query):
+        """
+        Computes the ETag of a device list without loading it.  Heartbeats
+        only change liveness, so they only change the ETag of lists that show
+        or filter on it.  Status filters run in SQL, so buffered heartbeats
+        are written out first.
+        :param db: DB object
+        :param query: dict() from parse_device_query()
+        :return: ETag string
+        """
+        if query['status'] is not None:
+            self.heartbeats.flush()
+        version, liveness, next_expiry = db.get_fleet_state()
+        state = [self._instance, version, sorted(query.items(), key=str)]
+        if (query['status'] is not None or not query['fields']
+                or set(query['fields']) & set(LIVENESS_FIELDS)):
+            state += [liveness, next_expiry, self.heartbeats.generation]
+        return hashlib.sha1(repr(state).encode('utf-8')).hexdigest()
+
+    def list_devices(self, db, query):
+        """
+        Loads one page of the device list.
+        :param db: DB object
+        :param query: dict() from parse_device_query()
+        :return: tuple of (devices, cursor of the next page or None)
+        """
+        arguments = dict((k, v) for k, v in query.items() if k != 'fields')
+        arguments['limit'] = query['limit'] + 1
+        devices = db.get_device_details(**arguments)
+        more = len(devices) > query['limit']
+        devices = self.heartbeats.merge(devices[:query['limit']])
+        if query['fields']:
+            devices = [dict((f, device[f]) for f in ['dev_id'] +
+                            query['fields'])
+                       for device in devices]
+        next_after = devices[-1]['dev_id'] if more else None
+        return devices, next_after
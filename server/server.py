@@ -1,71 +1,329 @@
-from datetime import datetime
-from flask import Flask, request, jsonify, g, render_template
+from flask import Flask, request, jsonify, g, render_template, url_for
 from werkzeug.exceptions import BadRequest, Unauthorized
+import argparse
 import collections
+import json
 import sqlite3
-from db import DB
+import threading
+import time
+from db import DB, DBPool, DBFILE, POOL_SIZE
+from heartbeat import HeartbeatBuffer, FLUSH_INTERVAL
+from history import (HistoryStore, parse_limit, parse_time,
+                     parse_time_range, RETENTION)
+from metrics import RegistryMetrics
+from registry import Registry, decode_body, PAGE_SIZE, PAGE_SIZE_MAX
 
 
 app = Flask(__name__)
+app.config.setdefault('DBFILE', DBFILE)
+app.config.setdefault('DB_POOL_SIZE', POOL_SIZE)
+app.config.setdefault('HEARTBEAT_FLUSH_INTERVAL', FLUSH_INTERVAL)
+
+# opt-in per-request SQL profiling: adds X-DB-Queries and X-DB-Time-Ms
+# headers, logs statements slower than SQL_SLOW_MS and explains the worst
+app.config.setdefault('SQL_PROFILE', False)
+app.config.setdefault('SQL_SLOW_MS', 50)
+app.config.setdefault('SQL_EXPLAIN_WORST', 3)
+app.config.setdefault('API_PAGE_SIZE', PAGE_SIZE)
+app.config.setdefault('API_PAGE_SIZE_MAX', PAGE_SIZE_MAX)
+# console output shipped by the agents
+app.config.setdefault('HISTORY_DIR', './history')
+app.config.setdefault('HISTORY_RETENTION', RETENTION)
+app.config.setdefault('HISTORY_TOKEN_INDEX', True)
+
+_pool = None
+_pool_lock = threading.RLock()
+_heartbeats = None
+_registry = None
+_history = None
+
+metrics = RegistryMetrics()
+DB.observer = metrics.observe_db
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = DBPool(app.config['DBFILE'],
+                               app.config['DB_POOL_SIZE'])
+    return _pool
+
+
+def get_heartbeats():
+    global _heartbeats
+    if _heartbeats is None:
+        with _pool_lock:
+            if _heartbeats is None:
+                buffer = HeartbeatBuffer(
+                    get_pool(), app.config['HEARTBEAT_FLUSH_INTERVAL'])
+                buffer.start()
+                _heartbeats = buffer
+    return _heartbeats
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _pool_lock:
+            if _registry is None:
+                _registry = Registry(get_heartbeats(),
+                                     app.config['API_PAGE_SIZE'],
+                                     app.config['API_PAGE_SIZE_MAX'],
+                                     metrics)
+    return _registry
+
+
+def get_history():
+    global _history
+    if _history is None:
+        with _pool_lock:
+            if _history is None:
+                _history = HistoryStore(
+                    app.config['HISTORY_DIR'],
+                    retention=app.config['HISTORY_RETENTION'],
+                    token_index=app.config['HISTORY_TOKEN_INDEX'])
+    return _history
 
 
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = DB()
+        db = g._database = get_pool().acquire()
+        if app.config['SQL_PROFILE']:
+            db.start_profile()
     return db
 
 
+@app.before_request
+def start_timer():
+    g._request_start = time.perf_counter()
+
+
+def observe_latency(status):
+    # each request is observed once, by whichever handler runs first
+    start = g.pop('_request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(route, request.method, status,
+                                time.perf_counter() - start)
+
+
+@app.after_request
+def observe_request(response):
+    observe_latency(response.status_code)
+    db = getattr(g, '_database', None)
+    profile = db.stop_profile() if db is not None else None
+    if profile is not None:
+        profile.finish(db, app.config['SQL_SLOW_MS'],
+                       app.config['SQL_EXPLAIN_WORST'])
+        response.headers['X-DB-Queries'] = str(profile.count)
+        response.headers['X-DB-Time-Ms'] = '%.3f' % (profile.seconds * 1000)
+    return response
+
+
+@app.teardown_request
+def observe_failed_request(exception):
+    # after_request handlers are skipped for unhandled exceptions, which
+    # Flask answers with a 500
+    observe_latency(500)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return app.response_class(metrics.render(get_db()),
+                              mimetype=metrics.content_type)
+
+
 @app.route("/")
 def hello():
     return render_template("index.html")
 
 
+def get_status_filter():
+    status = request.args.get('status')
+    if status not in (None, 'alive', 'dead'):
+        raise BadRequest("status must be 'alive' or 'dead'")
+    return status
+
+
+def list_devices(status=None):
+    """
+    Loads the device list and the alive and dead counts shown above it.
+    The counts and the status filter run in SQL, so they have to see
+    buffered heartbeats: those are written out first.
+    :return: tuple of (devices, counts)
+    """
+    heartbeats = get_heartbeats()
+    heartbeats.flush()
+    db = get_db()
+    devices = heartbeats.merge(db.get_device_details(status=status))
+    return devices, db.get_status_counts()
+
+
 @app.route("/devices")
 def devices():
-    db = get_db()
-    devices = db.get_device_details()
-    for device in devices:
-        last_updated = datetime.strptime(device['last_updated'],
-                                         "%Y-%m-%d %H:%M:%S.%f")
-        seen_ago = datetime.utcnow() - last_updated
-        device['seen_ago'] = "Status expires in {}s".format(
-            device['holdtime'] - seen_ago.seconds)
-        if seen_ago.seconds > device['holdtime']:
-            device['status'] = "dead"
-        else:
-            device['status'] = "alive"
-    return render_template("devices.html", devices=devices)
+    status = get_status_filter()
+    devices, counts = list_devices(status)
+    return render_template("devices.html", devices=devices, counts=counts,
+                           status=status)
 
 
 @app.route('/device/<int:dev_id>')
 def device(dev_id):
     db = get_db()
-    device = db.get_device_details(dev_id)
-    print(device)
+    device = get_heartbeats().merge(db.get_device_details(dev_id))
     return render_template('device.html', device=device[0])
 
 
+def get_json_body():
+    """
+    Decodes the JSON request body, gunzipping it first if the agent sent it
+    with Content-Encoding: gzip.
+    """
+    try:
+        body = decode_body(request.get_data(),
+                           request.headers.get('Content-Encoding'))
+        return json.loads(body.decode('utf-8'))
+    except ValueError as e:
+        raise BadRequest(str(e))
+
+
 @app.route('/api/register',methods=['POST'])
 def register():
-    db = get_db()
-    data = request.get_json()
-    print(data)
-    response = db.update_device(data)
-    return jsonify(response)
+    data = get_json_body()
+    app.logger.debug(data)
+    if not isinstance(data, dict):
+        raise BadRequest("expected a JSON object")
+    return jsonify(get_registry().register(get_db(), data))
+
+
+@app.route('/api/register/batch', methods=['POST'])
+def register_batch():
+    """
+    Registers many devices in one request, e.g. from a host fronting many
+    console lines.  The body is {"devices": [...]} with one registration
+    record per device; the response carries one result per record, in order.
+    """
+    registry = get_registry()
+    try:
+        dev_list = registry.check_batch(get_json_body())
+    except ValueError as e:
+        raise BadRequest(str(e))
+    results = registry.refresh_batch(dev_list)
+    return jsonify(registry.complete_batch(get_db(), dev_list, results))
+
 
 @app.route("/api/devices")
 def api_devices():
-    db = get_db()
-    devices = db.get_device_details()
-    return jsonify(devices)
+    """
+    Paginated device list.  Query parameters:
+        status:     'alive' or 'dead'
+        hostname:   hostname prefix
+        sn, port, addr: exact serial number, serial port or address match
+        fields:     comma separated fields to return (dev_id is always
+                    returned)
+        limit:      page size
+        after:      cursor, the dev_id of the last device already seen
+    The next page is linked from the Link header.  Responses carry an ETag
+    and If-None-Match is answered with 304 while the fleet is unchanged.
+    """
+    registry = get_registry()
+    try:
+        query = registry.parse_device_query(request.args)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    etag = registry.device_etag(get_db(), query)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    devices, next_after = registry.list_devices(get_db(), query)
+    response = jsonify(devices)
+    response.set_etag(etag)
+    if next_after is not None:
+        args = request.args.to_dict()
+        args['after'] = next_after
+        response.headers['Link'] = '<%s>; rel="next"' % url_for(
+            'api_devices', **args)
+    return response
+
+
+@app.route('/api/history/<sn>/<port>', methods=['POST'])
+def upload_history(sn, port):
+    """
+    Stores a chunk of console output from an agent: a gzip compressed body
+    of timestamped lines, with the times of the first and last line in the
+    start and end query parameters.
+    """
+    try:
+        get_history().append(sn, port, parse_time(request.args['start']),
+                             parse_time(request.args['end']),
+                             request.get_data())
+    except (KeyError, ValueError) as e:
+        raise BadRequest(str(e))
+    return jsonify({"status": "ok"})
+
+
+@app.route('/api/history/<sn>/<port>')
+def read_history(sn, port):
+    """
+    Console output of one port between start and end (seconds since the
+    epoch or ISO 8601, defaulting to the last hour), as text.
+    """
+    try:
+        start, end = parse_time_range(request.args)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    return app.response_class(get_history().read(sn, port, start, end),
+                              mimetype='text/plain')
+
+
+@app.route('/api/history/search')
+def search_history():
+    """
+    Lines containing the string q printed on any console between start and
+    end (defaulting to the last hour), at most limit of them.
+    """
+    q = request.args.get('q')
+    if not q:
+        raise BadRequest("q is required")
+    try:
+        start, end = parse_time_range(request.args)
+        limit = parse_limit(request.args)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    found = get_history().search(q.encode('utf-8'), start, end, limit)
+    return jsonify([{'sn': sn, 'port': port,
+                     'line': line.decode('utf-8', 'replace')}
+                    for sn, port, line in found])
+
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = get_db()
-    db.close()
+    db = getattr(g, '_database', None)
+    if db is not None:
+        g._database = None
+        get_pool().release(db)
 
 
 if __name__ == "__main__":
-    app.run(host="::", debug=True)
+    parser = argparse.ArgumentParser(
+        description='Run the PiCon registry web UI and API on the Flask '
+                    'development server.  See asyncserver.py for the '
+                    'production API server.')
+    parser.add_argument('--host', type=str, default='::',
+                        help='Address to listen on [default: ::]')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Port to listen on [default: 5000]')
+    parser.add_argument('--debug', action='store_true',
+                        help='Enable the Flask debugger and reloader')
+    parser.add_argument('--profile-sql', action='store_true',
+                        help='Profile the SQL run by each request')
+    args = parser.parse_args()
+    app.config['SQL_PROFILE'] = args.profile_sql
+    get_heartbeats()  # validate the schema before accepting requests
+    app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
 
@@ -0,0 +1,82 @@
+from unittest import TestCase
+from ..db import DB
+import datetime
+import os
+import tempfile
+
+
+class TestAssign_tunnelport(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.db = DB(os.path.join(tmpdir.name, 'ports.db'))
+        self.addCleanup(self.db.close)
+
+    def register(self, sn):
+        return self.db.update_device({
+            "hostname": sn,
+            "sn": sn,
+            "holdtime": 300,
+            "interfaces": {},
+            "ports": []
+        })['tunnel']['port']
+
+    def test_stored_port_is_returned(self):
+        first = self.register('sn1')
+        second = self.register('sn2')
+        self.assertEqual(first, self.db.listener_port_base)
+        self.assertEqual(second, first + 1)
+        self.assertEqual(self.register('sn1'), first)
+        dev_id = self.db.get_devid_by_sn('sn2')
+        self.assertEqual(self.db.get_tunnelport_by_devid(dev_id), second)
+
+    def test_reclaim_dead_devices(self):
+        self.db.listener_port_max = self.db.listener_port_base + 1
+        self.db.upgrade_schema()
+        self.register('sn1')
+        self.register('sn2')
+        with self.assertRaises(Exception):
+            self.register('sn3')
+        self.assertIsNone(self.db.get_devid_by_sn('sn3'))
+
+        long_ago = (datetime.datetime.utcnow() -
+                    datetime.timedelta(seconds=300 + self.db.reclaim_grace + 1))
+        with self.db.transaction() as c:
+            c.execute("update devices set last_updated=?, expires=? "
+                      "where sn='sn1';",
+                      [long_ago, long_ago + datetime.timedelta(seconds=300)])
+        self.assertEqual(self.register('sn3'), self.db.listener_port_base)
+        self.assertIsNone(self.db.get_tunnelport_by_devid(
+            self.db.get_devid_by_sn('sn1')))
+
+    def test_delete_returns_port(self):
+        port = self.register('sn1')
+        self.db.delete_device_by_devid(self.db.get_devid_by_sn('sn1'))
+        self.assertEqual(self.register('sn2'), port)
+
+    def test_serial_port_forwards(self):
+        base = self.db.listener_port_base
+        dev_data = {
+            "hostname": "sn1",
+            "sn": "sn1",
+            "holdtime": 300,
+            "interfaces": {},
+            "ports": ["ttyUSB0", "ttyUSB1"],
+            "forward_ports": True
+        }
+        tunnel = self.db.update_device(dev_data)['tunnel']
+        self.assertEqual(tunnel['port'], base)
+        self.assertEqual(tunnel['ports'], {"ttyUSB0": base + 1,
+                                           "ttyUSB1": base + 2})
+        self.assertEqual(self.db.get_tunnelport_usage()['allocated'], 3)
+
+        dev_data['ports'] = ["ttyUSB1", "ttyACM0"]
+        tunnel = self.db.update_device(dev_data)['tunnel']
+        self.assertEqual(tunnel['ports'], {"ttyUSB1": base + 2,
+                                           "ttyACM0": base + 1})
+        self.assertEqual(self.db.get_device_details()[0]['console_ports'],
+                         tunnel['ports'])
+
+        self.db.delete_device_by_devid(self.db.get_devid_by_sn('sn1'))
+        self.assertEqual(self.db.get_tunnelport_usage()['allocated'], 0)
+        self.assertEqual(self.register('sn2'), base)
@@ -0,0 +1,136 @@
+from aiohttp.test_utils import AioHTTPTestCase
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+# asyncserver.py runs as a script and imports its siblings by their own names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from asyncserver import create_app  # noqa: E402
+
+
+def dev_data(i, **extra):
+    data = {
+        "hostname": "picon-%02d" % i,
+        "sn": "sn%02d" % i,
+        "holdtime": 300,
+        "inventory_digest": "digest%d" % i,
+        "interfaces": {"eth0": {"state": True,
+                                "addrs": ["192.0.2.%d" % i]}},
+        "ports": ["ttyUSB0"]
+    }
+    data.update(extra)
+    return data
+
+
+class TestAsyncServer(AioHTTPTestCase):
+    async def get_application(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        return create_app(os.path.join(self.tmpdir.name, 'server.db'),
+                          pool_size=2, page_size=2,
+                          history_dir=os.path.join(self.tmpdir.name,
+                                                   'history'))
+
+    async def post_json(self, path, body, **kwargs):
+        return await self.client.post(path, data=json.dumps(body),
+                                      headers={'Content-Type':
+                                               'application/json'},
+                                      **kwargs)
+
+    async def test_register(self):
+        resp = await self.post_json('/api/register', dev_data(1))
+        self.assertEqual(resp.status, 200)
+        body = await resp.json()
+        self.assertEqual(body['status'], 'ok')
+        self.assertTrue(body['new'])
+        self.assertIn('tunnel', body)
+
+        # a heartbeat that changes nothing is answered from memory
+        heartbeat = dev_data(1)
+        del heartbeat['interfaces'], heartbeat['ports']
+        resp = await self.post_json('/api/register', heartbeat)
+        self.assertEqual(await resp.json(),
+                         {"status": "ok", "tunnel": body['tunnel']})
+
+        # and the device asked for its inventory when its digest changed
+        resp = await self.post_json('/api/register',
+                                    dict(heartbeat, inventory_digest='x'))
+        self.assertTrue((await resp.json())['send_inventory'])
+
+    async def test_register_gzip(self):
+        resp = await self.client.post(
+            '/api/register',
+            data=gzip.compress(json.dumps(dev_data(1)).encode('utf-8')),
+            headers={'Content-Type': 'application/json',
+                     'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual((await resp.json())['status'], 'ok')
+
+    async def test_register_rejects_bad_bodies(self):
+        resp = await self.client.post('/api/register', data=b'{not json')
+        self.assertEqual(resp.status, 400)
+        resp = await self.post_json('/api/register', [dev_data(1)])
+        self.assertEqual(resp.status, 400)
+
+    async def test_register_batch(self):
+        resp = await self.post_json('/api/register/batch', {
+            "devices": [dev_data(1), {"sn": "broken"}, dev_data(2)]})
+        self.assertEqual(resp.status, 200)
+        results = (await resp.json())['results']
+        self.assertEqual([r['sn'] for r in results],
+                         ['sn01', 'broken', 'sn02'])
+        self.assertEqual([r['status'] for r in results],
+                         ['ok', 'error', 'ok'])
+
+        # unchanged devices are answered from memory, changed ones written
+        heartbeat = dev_data(1)
+        del heartbeat['interfaces'], heartbeat['ports']
+        resp = await self.post_json('/api/register/batch', {
+            "devices": [heartbeat, dev_data(2, hostname='renamed')]})
+        results = (await resp.json())['results']
+        self.assertEqual([r['status'] for r in results], ['ok', 'ok'])
+
+        resp = await self.post_json('/api/register/batch', [dev_data(1)])
+        self.assertEqual(resp.status, 400)
+
+    async def test_api_devices(self):
+        for i in range(1, 4):
+            await self.post_json('/api/register', dev_data(i))
+        resp = await self.client.get('/api/devices')
+        self.assertEqual(resp.status, 200)
+        devices = await resp.json()
+        self.assertEqual([d['hostname'] for d in devices],
+                         ['picon-01', 'picon-02'])
+        self.assertEqual(devices[0]['ports'], ['ttyUSB0'])
+
+        # pages follow the Link header
+        link = resp.headers['Link']
+        self.assertIn('rel="next"', link)
+        resp = await self.client.get(link[1:link.index('>')])
+        self.assertEqual([d['hostname'] for d in await resp.json()],
+                         ['picon-03'])
+        self.assertNotIn('Link', resp.headers)
+
+        # an unchanged list is not sent again
+        etag = resp.headers['ETag']
+        resp = await self.client.get('/api/devices?after=2',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(resp.status, 304)
+
+        resp = await self.client.get('/api/devices?fields=hostname&sn=sn02')
+        self.assertEqual(await resp.json(),
+                         [{'dev_id': 2, 'hostname': 'picon-02'}])
+        resp = await self.client.get('/api/devices?status=unknown')
+        self.assertEqual(resp.status, 400)
+        resp = await self.client.get('/api/devices?fields=password')
+        self.assertEqual(resp.status, 400)
+
+    async def test_search_history_limit(self):
+        resp = await self.client.get('/api/history/search?q=panic&limit=0')
+        self.assertEqual(resp.status, 400)
+        resp = await self.client.get('/api/history/search?q=panic&limit=1')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(await resp.json(), [])
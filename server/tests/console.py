@@ -0,0 +1,102 @@
+from unittest import IsolatedAsyncioTestCase
+from ..console import ConsoleBroker
+import asyncio
+
+
+class TestConsoleBroker(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # stands in for a console forwarded by an agent: records input and
+        # lets the test push output to every connection
+        self.connections = []
+        self.received = bytearray()
+
+        async def handle(reader, writer):
+            self.connections.append(writer)
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                self.received += data
+            writer.close()
+
+        self.server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.broker = ConsoleBroker('127.0.0.1', viewer_buffer=16)
+
+    async def asyncTearDown(self):
+        self.broker.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def output(self, data):
+        for writer in self.connections:
+            writer.write(data)
+            await writer.drain()
+
+    async def test_fan_out_and_single_writer(self):
+        first, second = await asyncio.gather(
+            self.broker.attach(self.port, write=True),
+            self.broker.attach(self.port, write=True))
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual([first.writer, second.writer], [True, False])
+
+        await self.output(b'login: ')
+        self.assertEqual(await asyncio.wait_for(first.read(), 1), b'login: ')
+        self.assertEqual(await asyncio.wait_for(second.read(), 1), b'login: ')
+
+        await first.send(b'admin\r')
+        with self.assertRaises(PermissionError):
+            await second.send(b'reboot\r')
+        await asyncio.sleep(0.05)
+        self.assertEqual(bytes(self.received), b'admin\r')
+
+        first.detach()
+        third = await self.broker.attach(self.port, write=True)
+        self.assertTrue(third.writer)
+        second.detach()
+        third.detach()
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.broker._sessions, {})
+
+    async def test_slow_viewer_is_detached(self):
+        slow = await self.broker.attach(self.port)
+        fast = await self.broker.attach(self.port)
+        for chunk in (b'0123456789', b'abcdefghij'):
+            await self.output(chunk)
+            self.assertEqual(await asyncio.wait_for(fast.read(), 1), chunk)
+        self.assertIsNone(await asyncio.wait_for(slow.read(), 1))
+        self.assertTrue(slow.lagged)
+        await self.output(b'still here')
+        self.assertEqual(await asyncio.wait_for(fast.read(), 1),
+                         b'still here')
+
+    async def test_closed_session_is_not_joined(self):
+        connecting = asyncio.ensure_future(self.broker.attach(self.port))
+        # the console hangs up right after the connection is set up
+        while not self.broker._sessions:
+            await asyncio.sleep(0)
+        self.broker._sessions[self.port].close()
+        with self.assertRaises(ConnectionResetError):
+            await connecting
+        viewer = await self.broker.attach(self.port)
+        self.assertFalse(viewer.session.closed)
+        self.assertEqual(len(self.connections), 2)
+        viewer.detach()
+
+    async def test_cancelled_connect_closes_session(self):
+        attaching = asyncio.ensure_future(self.broker.attach(self.port))
+        await asyncio.sleep(0)
+        attaching.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await attaching
+        # the connection finishes setting up with nobody left to use it
+        for _ in range(100):
+            if self.connections and self.connections[0].is_closing():
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.broker._sessions, {})
+        self.assertEqual(self.broker._connecting, {})
+        self.assertEqual(self.broker._waiting, {})
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.connections), 1)
+        self.assertTrue(self.connections[0].is_closing())
@@ -0,0 +1,23 @@
+from unittest import TestCase
+from ..registry import decode_body
+import gzip
+import zlib
+
+
+class TestDecode_body(TestCase):
+    def test_identity(self):
+        self.assertEqual(decode_body(b'{}'), b'{}')
+        self.assertEqual(decode_body(b'{}', 'identity'), b'{}')
+
+    def test_gzip_and_deflate(self):
+        body = b'{"hostname": "pi"}'
+        self.assertEqual(decode_body(gzip.compress(body), 'gzip'), body)
+        self.assertEqual(decode_body(zlib.compress(body), 'deflate'), body)
+
+    def test_rejected_bodies(self):
+        with self.assertRaises(ValueError):
+            decode_body(b'{}', 'br')
+        with self.assertRaises(ValueError):
+            decode_body(b'not gzip', 'gzip')
+        with self.assertRaises(ValueError):
+            decode_body(gzip.compress(b'0' * 1000), 'gzip', limit=100)
@@ -0,0 +1,56 @@
+from unittest import TestCase
+from ..db import DBPool
+from ..heartbeat import HeartbeatBuffer
+from ..registry import Registry
+import os
+import tempfile
+
+
+class TestDevice_etag(TestCase):
+    def test_heartbeats_only_change_liveness_etags(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        pool = DBPool(os.path.join(tmpdir.name, 'etag.db'))
+        self.addCleanup(pool.close)
+        registry = Registry(HeartbeatBuffer(pool))
+        dev_data = {
+            "hostname": "test-hostname",
+            "sn": "testsn123",
+            "holdtime": 300,
+            "inventory_digest": "abc",
+            "interfaces": {"eth0": {"state": True, "addrs": ["192.0.2.1"]}},
+            "ports": ["ttyUSB0"]
+        }
+        db = pool.acquire()
+        self.addCleanup(pool.release, db)
+        registry.register(db, dev_data)
+        queries = dict((args, registry.parse_device_query(dict(args)))
+                       for args in [(), (('fields', 'hostname,ports'),),
+                                    (('fields', 'hostname,status'),),
+                                    (('status', 'alive'),
+                                     ('fields', 'hostname'))])
+        before = dict((args, registry.device_etag(db, query))
+                      for args, query in queries.items())
+
+        heartbeat = dict(dev_data)
+        del heartbeat['interfaces'], heartbeat['ports']
+        registry.register(db, heartbeat)
+        buffered = dict((args, registry.device_etag(db, query))
+                        for args, query in queries.items())
+        registry.heartbeats.flush()
+        flushed = dict((args, registry.device_etag(db, query))
+                       for args, query in queries.items())
+        for args in queries:
+            if args == (('fields', 'hostname,ports'),):
+                self.assertEqual(buffered[args], before[args])
+                self.assertEqual(flushed[args], before[args])
+            else:
+                self.assertNotEqual(buffered[args], before[args])
+                self.assertNotEqual(flushed[args], before[args])
+
+        # inventory changes invalidate every list
+        registry.register(db, dict(dev_data, inventory_digest='def',
+                                   ports=["ttyUSB0", "ttyUSB1"]))
+        for args, query in queries.items():
+            self.assertNotEqual(registry.device_etag(db, query),
+                                flushed[args])
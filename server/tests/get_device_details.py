@@ -0,0 +1,105 @@
+from unittest import TestCase
+from ..db import DB
+from ..benchmarks.device_details import seed_devices
+import os
+import tempfile
+
+
+class TestGet_device_details(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def count_queries(self, size):
+        db = DB(os.path.join(self.tmpdir.name, '%d.db' % size))
+        self.addCleanup(db.close)
+        seed_devices(db, size)
+        statements = []
+        db._conn.set_trace_callback(statements.append)
+        devices = db.get_device_details()
+        db._conn.set_trace_callback(None)
+        self.assertEqual(len(devices), size)
+        return len(statements), devices
+
+    def test_query_count_is_constant(self):
+        small, _ = self.count_queries(10)
+        large, devices = self.count_queries(1000)
+        self.assertEqual(small, large)
+        self.assertEqual(len(devices[0]['interfaces']), 3)
+        self.assertEqual(devices[0]['ports'], ['ttyUSB0', 'ttyUSB1'])
+
+    def test_single_device(self):
+        db = DB(os.path.join(self.tmpdir.name, 'single.db'))
+        self.addCleanup(db.close)
+        seed_devices(db, 5)
+        devices = db.get_device_details(3)
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0]['hostname'], 'picon-00003')
+        self.assertEqual(sorted(devices[0]['interfaces']),
+                         ['eth0', 'eth1', 'eth2'])
+
+    def test_status_filter(self):
+        db = DB(os.path.join(self.tmpdir.name, 'status.db'))
+        self.addCleanup(db.close)
+        for sn in ('alive1', 'alive2', 'dead1'):
+            db.update_device({"hostname": sn, "sn": sn, "holdtime": 300,
+                              "interfaces": {}, "ports": ["ttyUSB0"]})
+        with db.transaction() as c:
+            c.execute("update devices set expires=last_updated "
+                      "where sn='dead1';")
+        self.assertEqual(db.get_status_counts(), {'alive': 2, 'dead': 1})
+        dead = db.get_device_details(status='dead')
+        self.assertEqual([d['sn'] for d in dead], ['dead1'])
+        self.assertEqual(dead[0]['status'], 'dead')
+        self.assertEqual(dead[0]['ports'], ['ttyUSB0'])
+        alive = db.get_device_details(status='alive')
+        self.assertEqual([d['sn'] for d in alive], ['alive1', 'alive2'])
+
+    def test_port_info(self):
+        db = DB(os.path.join(self.tmpdir.name, 'probes.db'))
+        self.addCleanup(db.close)
+        dev_data = {"hostname": "probed", "sn": "probed", "holdtime": 300,
+                    "interfaces": {}, "ports": ["ttyS0", "ttyUSB0", "ttyUSB1"],
+                    "port_info": {"ttyS0": {"speed": None, "live": False},
+                                  "ttyUSB0": {"speed": 115200, "live": True}}}
+        db.update_device(dev_data)
+        self.assertEqual(db.get_device_details()[0]['port_info'], {
+            'ttyS0': {'speed': None, 'live': False},
+            'ttyUSB0': {'speed': 115200, 'live': True}})
+        # a later probe updates the ports the device still has
+        dev_data['port_info'] = {"ttyUSB1": {"speed": 9600, "live": True}}
+        db.update_device(dev_data)
+        self.assertEqual(db.get_device_details()[0]['port_info'], {
+            'ttyUSB1': {'speed': 9600, 'live': True}})
+
+    def test_sparse_filter_reads_only_page_children(self):
+        db = DB(os.path.join(self.tmpdir.name, 'sparse.db'))
+        self.addCleanup(db.close)
+        seed_devices(db, 25)
+        with db.transaction() as c:
+            c.execute("update devices set expires=last_updated "
+                      "where dev_id in (1, 25);")
+        profile = db.start_profile()
+        dead = db.get_device_details(status='dead')
+        db.stop_profile()
+        self.assertEqual([d['dev_id'] for d in dead], [1, 25])
+        # 3 interfaces and 2 ports each, not those of devices 2 to 24
+        self.assertEqual([q['rows'] for q in profile.queries], [2, 6, 4])
+
+    def test_pagination_and_filters(self):
+        db = DB(os.path.join(self.tmpdir.name, 'page.db'))
+        self.addCleanup(db.close)
+        seed_devices(db, 25)
+        first = db.get_device_details(limit=10)
+        self.assertEqual([d['dev_id'] for d in first], list(range(1, 11)))
+        second = db.get_device_details(after=first[-1]['dev_id'], limit=10)
+        self.assertEqual([d['dev_id'] for d in second], list(range(11, 21)))
+        self.assertEqual(len(second[-1]['interfaces']), 3)
+
+        prefix = db.get_device_details(hostname='picon-0001')
+        self.assertEqual([d['dev_id'] for d in prefix], list(range(10, 20)))
+        by_sn = db.get_device_details(sn='sn%014d' % 7)
+        self.assertEqual([d['dev_id'] for d in by_sn], [7])
+        by_addr = db.get_device_details(addr='10.1.0.12')
+        self.assertEqual([d['dev_id'] for d in by_addr], [12])
+        self.assertEqual(len(db.get_device_details(port_name='ttyUSB1')), 25)
@@ -0,0 +1,126 @@
+from unittest import TestCase
+from ..db import DB, DBPool
+from ..heartbeat import HeartbeatBuffer
+from unittest import mock
+import os
+import tempfile
+import threading
+
+
+class TestHeartbeatBuffer(TestCase):
+    def test_refresh_and_flush(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        pool = DBPool(os.path.join(tmpdir.name, 'heartbeat.db'))
+        self.addCleanup(pool.close)
+        buffer = HeartbeatBuffer(pool)
+        dev_data = {
+            "hostname": "test-hostname",
+            "sn": "testsn123",
+            "holdtime": 300,
+            "inventory_digest": "abc",
+            "interfaces": {"eth0": {"state": True, "addrs": ["192.0.2.1"]}},
+            "ports": ["ttyUSB0"]
+        }
+        self.assertIsNone(buffer.refresh(dev_data))
+        db = pool.acquire()
+        response = db.update_device(dev_data)
+        buffer.remember(dev_data, response)
+        before = db.get_device_details()[0]['last_updated']
+
+        heartbeat = dict(dev_data)
+        del heartbeat['interfaces'], heartbeat['ports']
+        self.assertTrue(response['new'])
+        self.assertEqual(buffer.refresh(heartbeat),
+                         {"status": "ok", "tunnel": response['tunnel']})
+        merged = buffer.merge(db.get_device_details())
+        self.assertGreater(merged[0]['last_updated'], before)
+        self.assertEqual(db.get_device_details()[0]['last_updated'], before)
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(db.get_device_details()[0]['last_updated'],
+                         merged[0]['last_updated'])
+        pool.release(db)
+
+        changed = dict(heartbeat, inventory_digest='def')
+        self.assertIsNone(buffer.refresh(changed))
+        reconnected = dict(heartbeat, tunnel_state={
+            "up": True, "up_since": "2016-06-01T00:00:00Z", "reconnects": 1})
+        self.assertIsNone(buffer.refresh(reconnected))
+
+    def registered_buffer(self):
+        """
+        Returns a buffer, a borrowed DB and the heartbeat of a device that
+        registered and sent one unchanged heartbeat since.
+        """
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        pool = DBPool(os.path.join(tmpdir.name, 'heartbeat.db'))
+        self.addCleanup(pool.close)
+        buffer = HeartbeatBuffer(pool)
+        dev_data = {
+            "hostname": "test-hostname",
+            "sn": "testsn123",
+            "holdtime": 300,
+            "inventory_digest": "abc",
+            "interfaces": {"eth0": {"state": True, "addrs": ["192.0.2.1"]}},
+            "ports": ["ttyUSB0"]
+        }
+        db = pool.acquire()
+        self.addCleanup(pool.release, db)
+        buffer.remember(dev_data, db.update_device(dev_data))
+        heartbeat = dict(dev_data)
+        del heartbeat['interfaces'], heartbeat['ports']
+        self.assertIsNotNone(buffer.refresh(heartbeat))
+        return buffer, db, heartbeat
+
+    def test_flush_waits_for_batch_in_flight(self):
+        buffer, db, heartbeat = self.registered_buffer()
+        before = db.get_device_details()[0]['last_updated']
+        touch_devices = DB.touch_devices
+        writing = threading.Event()
+        proceed = threading.Event()
+
+        def slow_touch_devices(self, heartbeats, c=None):
+            writing.set()
+            proceed.wait(5)
+            return touch_devices(self, heartbeats, c)
+
+        with mock.patch.object(DB, 'touch_devices', slow_touch_devices):
+            first = threading.Thread(target=buffer.flush)
+            first.start()
+            self.assertTrue(writing.wait(5))
+            # the batch being written is still merged into device lists
+            merged = buffer.merge(db.get_device_details())
+            self.assertGreater(merged[0]['last_updated'], before)
+            flushed = list()
+            second = threading.Thread(
+                target=lambda: flushed.append(buffer.flush()))
+            second.start()
+            second.join(0.2)
+            self.assertTrue(second.is_alive())
+            proceed.set()
+            first.join()
+            second.join()
+        self.assertEqual(flushed, [0])
+        self.assertEqual(db.get_device_details()[0]['last_updated'],
+                         merged[0]['last_updated'])
+
+    def test_flush_forgets_deleted_devices(self):
+        buffer, db, heartbeat = self.registered_buffer()
+        db.delete_device_by_devid(1)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(db.get_device_details(), [])
+        # the next heartbeat goes through the database, which asks for the
+        # inventory of a device it does not know
+        self.assertIsNone(buffer.refresh(heartbeat))
+        self.assertTrue(db.update_device(heartbeat)['send_inventory'])
+
+    def test_flush_forgets_reclaimed_devices(self):
+        buffer, db, heartbeat = self.registered_buffer()
+        with db.transaction() as c:
+            c.execute("update devices set expires='2016-06-01 00:00:00';")
+        self.assertEqual([sn for sn, port in db.reclaim_tunnelports(grace=0)],
+                         ['testsn123'])
+        self.assertEqual(buffer.flush(), 0)
+        self.assertIsNone(buffer.refresh(heartbeat))
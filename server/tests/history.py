@@ -0,0 +1,148 @@
+from unittest import TestCase
+from ..history import (HistoryStore, CHUNK_LIMIT, format_stamp, parse_limit,
+                       parse_time, query_tokens)
+import gzip
+import shutil
+import tempfile
+import time
+
+# recent enough not to be expired by the retention pass append() runs
+T0 = float(int(time.time()) - 60 * 60)
+
+
+def chunk(*lines):
+    """
+    Builds a shipped chunk from (time, text) pairs.
+    """
+    text = ''.join('%s %s\n' % (format_stamp(t), s) for t, s in lines)
+    return gzip.compress(text.encode())
+
+
+class TestHistoryStore(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = HistoryStore(self.root, segment_bytes=200)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read_time_range(self):
+        self.store.append('sn1', 'ttyUSB0', T0, T0 + 1,
+                          chunk((T0, 'booting'), (T0 + 1, 'kernel panic')))
+        self.store.append('sn1', 'ttyUSB0', T0 + 10, T0 + 11,
+                          chunk((T0 + 10, 'login:'), (T0 + 11, 'root')))
+        self.store.append('sn1', 'ttyUSB1', T0, T0, chunk((T0, 'other')))
+        out = self.store.read('sn1', 'ttyUSB0', T0 + 1, T0 + 10)
+        self.assertEqual(out.decode().splitlines(), [
+            format_stamp(T0 + 1) + ' kernel panic',
+            format_stamp(T0 + 10) + ' login:'])
+        self.assertEqual(self.store.read('sn1', 'ttyUSB0', T0 + 20, T0 + 30),
+                         b'')
+        self.assertEqual(self.store.read('sn2', 'ttyUSB0', T0, T0 + 30), b'')
+
+    def test_segments_roll_and_reload(self):
+        for i in range(10):
+            self.store.append('sn1', 'ttyUSB0', T0 + i, T0 + i,
+                              chunk((T0 + i, 'line %d' % i)))
+        self.assertGreater(len(self.store._streams[('sn1', 'ttyUSB0')]), 1)
+        reopened = HistoryStore(self.root, segment_bytes=200)
+        out = reopened.read('sn1', 'ttyUSB0', T0, T0 + 9)
+        self.assertEqual(len(out.splitlines()), 10)
+
+    def test_search(self):
+        self.store.append('sn1', 'ttyUSB0', T0, T0 + 1,
+                          chunk((T0, 'booting'), (T0 + 1, 'Kernel panic!')))
+        self.store.append('sn2', 'ttyUSB0', T0, T0, chunk((T0, 'all fine')))
+        found = self.store.search(b'panic', T0, T0 + 60)
+        line = format_stamp(T0 + 1).encode() + b' Kernel panic!'
+        self.assertEqual(found, [('sn1', 'ttyUSB0', line)])
+        # a word cut at the edge of the query still matches
+        self.assertEqual(len(self.store.search(b'ernel pan', T0, T0 + 60)), 1)
+        self.assertEqual(self.store.search(b'panic', T0 + 2, T0 + 60), [])
+
+    def test_split_line(self):
+        # the agent shipped part of a line, then the rest of it
+        stamp = format_stamp(T0).encode()
+        self.store.append('sn1', 'ttyUSB0', T0, T0, gzip.compress(
+            stamp + b' Router uptime is 3 wee'))
+        self.store.append('sn1', 'ttyUSB0', T0, T0 + 1, gzip.compress(
+            b'ks\n' + format_stamp(T0 + 1).encode() + b' Router#\n'))
+        self.assertEqual(self.store.read('sn1', 'ttyUSB0', T0, T0 + 1),
+                         stamp + b' Router uptime is 3 weeks\n' +
+                         format_stamp(T0 + 1).encode() + b' Router#\n')
+        self.assertEqual(self.store.search(b'uptime is 3 weeks', T0, T0 + 1),
+                         [('sn1', 'ttyUSB0',
+                           stamp + b' Router uptime is 3 weeks')])
+
+    def test_token_prefilter(self):
+        self.assertEqual(query_tokens(b'ernel panic at'), {b'panic'})
+        self.assertEqual(query_tokens(b' panic '), {b'panic'})
+        # _ is part of a word, so _foo may be the end of x_foo
+        self.assertEqual(query_tokens(b'_foo bar'), set())
+        self.store.append('sn1', 'ttyUSB1', T0, T0, chunk((T0, 'x_foo bar')))
+        self.assertEqual(len(self.store.search(b'_foo bar', T0, T0 + 60)), 1)
+        self.store.append('sn1', 'ttyUSB0', T0, T0, chunk((T0, 'booting')))
+        segment = self.store._streams[('sn1', 'ttyUSB0')][0]
+        self.assertEqual(segment.tokens(), {b'booting'})
+        # segments whose tokens rule the string out are not decompressed
+        segment.chunks = None
+        self.assertEqual(self.store.search(b' panic ', T0, T0 + 60), [])
+
+    def test_expire_drops_whole_segments(self):
+        for i in range(10):
+            self.store.append('sn1', 'ttyUSB0', T0 + i * 100, T0 + i * 100,
+                              chunk((T0 + i * 100, 'line %d' % i)))
+        segments = list(self.store._streams[('sn1', 'ttyUSB0')])
+        dropped = self.store.expire(T0 + 500 + self.store.retention)
+        self.assertGreater(dropped, 0)
+        remaining = self.store._streams[('sn1', 'ttyUSB0')]
+        self.assertEqual(remaining, segments[dropped:])
+        self.assertTrue(all(s.end >= T0 + 500 for s in remaining))
+        out = self.store.read('sn1', 'ttyUSB0', T0, T0 + 1000)
+        self.assertIn(b'line 9', out)
+
+    def test_segment_expired_while_reading(self):
+        for i in range(10):
+            self.store.append('sn1', 'ttyUSB0', T0 + i, T0 + i,
+                              chunk((T0 + i, 'line %d' % i)))
+        # expire() removes the oldest files after read() or search() listed
+        # the segments, but before it opened them
+        segments = self.store._streams[('sn1', 'ttyUSB0')]
+        segments[0].remove()
+        segments[0]._tokens = None
+        out = self.store.read('sn1', 'ttyUSB0', T0, T0 + 9)
+        self.assertIn(b'line 9', out)
+        self.assertNotIn(b'line 0', out)
+        self.assertEqual(len(self.store.search(b'line', T0, T0 + 9)),
+                         len(out.splitlines()))
+
+    def test_rejects_bad_chunks(self):
+        with self.assertRaises(ValueError):
+            self.store.append('sn1', 'ttyUSB0', T0, T0, b'not gzip')
+        with self.assertRaises(ValueError):
+            self.store.append('../sn1', 'ttyUSB0', T0, T0, chunk((T0, 'x')))
+        with self.assertRaises(ValueError):
+            self.store.append('sn1', 'ttyUSB0', float('nan'), T0,
+                              chunk((T0, 'x')))
+        # a small body may not expand without limit
+        bomb = gzip.compress(b'\0' * (CHUNK_LIMIT + 1))
+        with self.assertRaises(ValueError):
+            self.store.append('sn1', 'ttyUSB0', T0, T0, bomb)
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('1464739200'), 1464739200.0)
+        self.assertEqual(parse_time('2016-06-01T00:00:00.000Z'), 1464739200.0)
+        self.assertEqual(parse_time('2016-06-01T02:00:00+02:00'),
+                         1464739200.0)
+        for value in ('1e20', 'inf', 'nan', '-1', 'yesterday'):
+            with self.assertRaises(ValueError):
+                parse_time(value)
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit({}), 100)
+        self.assertEqual(parse_limit({'limit': '5'}), 5)
+        for value in ('0', '-1', 'many'):
+            with self.assertRaises(ValueError):
+                parse_limit({'limit': value})
+        with self.assertRaises(ValueError):
+            self.store.search(b'panic', T0, T0 + 60, limit=0)
@@ -1,30 +1,16 @@
 from unittest import TestCase
 from ..db import DB
 import os
+import tempfile
 
-test_file = r'./blank.db'
-original_file = None
 
 class TestInitialize(TestCase):
     def test_initialize(self):
-        db = DB()
-        global original_file
-        self.addCleanup(self.shutdown, db)
-        self.delete_test_file()
-        original_file = db.dbfile
-        db.dbfile = test_file
-        db.initialize()
+        # WAL journaling leaves -wal and -shm files next to the database, so
+        # it lives in a directory that is removed with everything in it
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'blank.db'))
+        self.addCleanup(db.close)
         devices = db.get_device_details()
-        self.assertEquals(len(devices), 0)
-
-    def delete_test_file(self):
-        try:
-            os.unlink(test_file)
-        except FileNotFoundError:
-            pass
-
-    def shutdown(self, db):
-        db.dbfile = original_file
-        db.initialize()
-        db.close()
-        self.delete_test_file()
+        self.assertEqual(len(devices), 0)
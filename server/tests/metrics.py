@@ -0,0 +1,32 @@
+from unittest import TestCase
+from ..db import DB
+from ..metrics import RegistryMetrics
+import os
+import tempfile
+
+
+class TestRegistryMetrics(TestCase):
+    def test_render(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        metrics = RegistryMetrics()
+        DB.observer = metrics.observe_db
+        self.addCleanup(setattr, DB, 'observer', None)
+        db = DB(os.path.join(tmpdir.name, 'metrics.db'))
+        self.addCleanup(db.close)
+        dev_data = {"hostname": "h", "sn": "sn1", "holdtime": 300,
+                    "interfaces": {}, "ports": []}
+        metrics.count_registration(db.update_device(dev_data))
+        metrics.count_registration(db.update_device(dev_data))
+        metrics.observe_request('/api/register', 'POST', 200, 0.003)
+
+        text = metrics.render(db)
+        self.assertIn('picon_registrations_total{kind="new"} 1.0', text)
+        self.assertIn('picon_registrations_total{kind="refresh"} 1.0', text)
+        self.assertIn('picon_devices{status="alive"} 1', text)
+        self.assertIn('picon_tunnel_ports{state="allocated"} 1', text)
+        self.assertIn('picon_http_request_duration_seconds_bucket{'
+                      'route="/api/register",method="POST",status="200",'
+                      'le="0.005"} 1', text)
+        self.assertIn('picon_db_method_duration_seconds_count{'
+                      'method="update_device"} 2', text)
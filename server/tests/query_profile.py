@@ -0,0 +1,30 @@
+from unittest import TestCase
+from ..db import DB
+import os
+import tempfile
+
+
+class TestQueryProfile(TestCase):
+    def test_profile(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'profile.db'))
+        self.addCleanup(db.close)
+        db.update_device({"hostname": "h", "sn": "sn1", "holdtime": 300,
+                          "interfaces": {"eth0": {"state": True,
+                                                  "addrs": ["192.0.2.1"]}},
+                          "ports": ["ttyUSB0", "ttyUSB1"]})
+
+        profile = db.start_profile()
+        devices = db.get_device_details()
+        self.assertIs(db.stop_profile(), profile)
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(profile.count, 3)
+        self.assertEqual([q['rows'] for q in profile.queries], [1, 1, 2])
+        self.assertEqual(profile.queries[0]['params'], 1)
+
+        with self.assertLogs(level='WARNING') as logs:
+            profile.finish(db, slow_ms=0, explain_worst=1)
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(len([q for q in profile.queries if 'plan' in q]), 1)
+        self.assertFalse([q for q in profile.queries if 'args' in q])
@@ -1,15 +1,21 @@
 from unittest import TestCase
-from .. import DB
+from ..db import DB
 import json
+import os
+import tempfile
 
 
 class TestUpdate_device(TestCase):
     def test_update_device(self):
-        db = DB()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'update.db'))
+        self.addCleanup(db.close)
         json_str = """
         {
             "hostname": "test-hostname",
             "sn": "testsn123",
+            "holdtime": 300,
             "interfaces": {
                 "lo": {
                     "state": true,
@@ -36,3 +42,78 @@ class TestUpdate_device(TestCase):
         dev_detail = db.get_device_details()
         db.delete_device_by_devid(dev_id)
         self.assertIsNotNone(dev_id)
+
+    def test_update_device_is_atomic(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'atomic.db'))
+        self.addCleanup(db.close)
+        dev_data = {
+            "hostname": "test-hostname",
+            "sn": "testsn456",
+            "holdtime": 300,
+            "interfaces": {"eth0": {"state": True}},
+            "ports": ["ttyUSB0"]
+        }
+        with self.assertRaises(KeyError):
+            db.update_device(dev_data)
+        self.assertIsNone(db.get_devid_by_sn('testsn456'))
+
+        dev_data['interfaces']['eth0']['addrs'] = ['192.0.2.1']
+        db.update_device(dev_data)
+        db.update_device(dev_data)
+        devices = db.get_device_details()
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0]['ports'], ['ttyUSB0'])
+
+    def test_update_device_digest(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'digest.db'))
+        self.addCleanup(db.close)
+        heartbeat = {
+            "hostname": "test-hostname",
+            "sn": "testsn789",
+            "holdtime": 300,
+            "inventory_digest": "abc"
+        }
+        resp = db.update_device(heartbeat)
+        self.assertTrue(resp.get('send_inventory'))
+
+        full = dict(heartbeat, interfaces={
+            "eth0": {"state": True, "addrs": ["192.0.2.1"]}
+        }, ports=["ttyUSB0"])
+        resp = db.update_device(full)
+        self.assertNotIn('send_inventory', resp)
+
+        statements = []
+        db._conn.set_trace_callback(statements.append)
+        resp = db.update_device(heartbeat)
+        db._conn.set_trace_callback(None)
+        self.assertNotIn('send_inventory', resp)
+        self.assertFalse([s for s in statements if 'interfaces' in s])
+        self.assertEqual(db.get_device_details()[0]['ports'], ['ttyUSB0'])
+
+    def test_update_device_tunnel_state(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'tunnel.db'))
+        self.addCleanup(db.close)
+        dev_data = {
+            "hostname": "test-hostname",
+            "sn": "testsn321",
+            "holdtime": 300,
+            "interfaces": {},
+            "ports": []
+        }
+        db.update_device(dev_data)
+        self.assertIsNone(db.get_device_details()[0]['tunnel_state'])
+
+        state = {"up": True, "up_since": "2016-06-01T00:00:00Z",
+                 "reconnects": 2}
+        db.update_device(dict(dev_data, tunnel_state=state))
+        self.assertEqual(db.get_device_details()[0]['tunnel_state'], state)
+
+        # agents that do not report it leave the last state alone
+        db.update_device(dev_data)
+        self.assertEqual(db.get_device_details()[0]['tunnel_state'], state)
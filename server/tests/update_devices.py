@@ -0,0 +1,47 @@
+from unittest import TestCase
+from ..db import DB
+import os
+import tempfile
+
+
+class TestUpdate_devices(TestCase):
+    def test_update_devices(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'batch.db'))
+        self.addCleanup(db.close)
+        dev_list = [{
+            "hostname": "line%d" % i,
+            "sn": "proxy-line%d" % i,
+            "holdtime": 300,
+            "interfaces": {},
+            "ports": ["line%d" % i]
+        } for i in range(3)]
+        del dev_list[1]['holdtime']
+
+        results = db.update_devices(dev_list)
+        self.assertEqual([r['sn'] for r in results],
+                         ['proxy-line0', 'proxy-line1', 'proxy-line2'])
+        self.assertEqual([r['status'] for r in results], ['ok', 'error', 'ok'])
+        self.assertNotEqual(results[0]['tunnel']['port'],
+                            results[2]['tunnel']['port'])
+        self.assertIsNone(db.get_devid_by_sn('proxy-line1'))
+        self.assertEqual([d['ports'] for d in db.get_device_details()],
+                         [['line0'], ['line2']])
+
+    def test_proxied_lines_hold_no_tunnel_port(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        db = DB(os.path.join(tmpdir.name, 'proxied.db'))
+        self.addCleanup(db.close)
+        line = {"hostname": "line0", "sn": "proxy-line0", "holdtime": 300,
+                "interfaces": {}, "ports": ["line0"]}
+        self.assertIn('tunnel', db.update_devices([line])[0])
+        usage = db.get_tunnelport_usage()
+        line['proxied'] = True
+        result = db.update_devices([line])[0]
+        self.assertEqual(result['status'], 'ok')
+        self.assertNotIn('tunnel', result)
+        self.assertNotEqual(db.get_tunnelport_usage(), usage)
+        self.assertIsNone(db.get_tunnelport_by_devid(
+            db.get_devid_by_sn('proxy-line0')))
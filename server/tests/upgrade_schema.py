@@ -0,0 +1,67 @@
+from unittest import TestCase
+from ..db import DB
+import os
+import sqlite3
+import tempfile
+
+
+class TestUpgrade_schema(TestCase):
+    def test_upgrade_legacy_database(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dbfile = os.path.join(tmpdir.name, 'legacy.db')
+        conn = sqlite3.connect(dbfile)
+        conn.executescript("""
+            create table serialports (dev_id integer, port_name text);
+            create table interfaces (dev_id integer, int_name text,
+                state integer, addr text, ip_version integer);
+            create table devices (dev_id integer primary key, hostname text,
+                sn text, first_seen datetime, last_updated datetime,
+                holdtime int);
+            insert into devices values
+                (1, 'old', 'sn1', '2016-06-01 00:00:00.000000',
+                 '2016-06-01 00:00:00.000000', 300),
+                (2, 'new', 'sn1', '2016-06-02 00:00:00.000000',
+                 '2016-06-02 00:00:00.000000', 300),
+                (3, 'fresh', 'sn2', '2016-06-01 00:00:00.000000',
+                 '2016-06-05 00:00:00.000000', 300),
+                (4, 'stale', 'sn2', '2016-06-02 00:00:00.000000',
+                 '2016-06-03 00:00:00.000000', 300),
+                (5, 'unnamed', null, '2016-06-01 00:00:00.000000',
+                 '2016-06-01 00:00:00.000000', 300),
+                (6, 'unnamed', null, '2016-06-01 00:00:00.000000',
+                 '2016-06-01 00:00:00.000000', 300);
+            insert into serialports values (1, 'ttyUSB0'), (2, 'ttyUSB1');
+        """)
+        conn.close()
+
+        db = DB(dbfile)
+        self.addCleanup(db.close)
+        self.assertEqual(db.get_schema_version(), len(DB.MIGRATIONS))
+        devices = db.get_device_details()
+        # the device updated last wins, whatever its dev_id
+        self.assertEqual([(d['dev_id'], d['hostname'], d['ports'])
+                          for d in devices],
+                         [(2, 'new', ['ttyUSB1']), (3, 'fresh', []),
+                          (5, 'unnamed', []), (6, 'unnamed', [])])
+        self.assertEqual(devices[0]['status'], 'dead')
+
+        db.update_device({"hostname": "new", "sn": "sn1", "holdtime": 300,
+                          "interfaces": {}, "ports": ["ttyUSB0"]})
+        with db.transaction() as c:
+            c.execute("delete from devices;")
+            c.execute("select count(*) from serialports;")
+            self.assertEqual(c.fetchone()[0], 0)
+
+    def test_newer_schema_is_refused(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dbfile = os.path.join(tmpdir.name, 'future.db')
+        DB(dbfile).close()
+        conn = sqlite3.connect(dbfile)
+        conn.execute("insert into schema_version values (?, 'future', null);",
+                     [len(DB.MIGRATIONS) + 1])
+        conn.commit()
+        conn.close()
+        with self.assertRaises(Exception):
+            DB(dbfile)